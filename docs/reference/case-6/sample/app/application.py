@@ -1,13 +1,83 @@
-from fastapi import FastAPI
+import asyncio
+import os
+import secrets
+from contextlib import asynccontextmanager
+from typing import List, Literal
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Query
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
+from src.api.app.diagnostics import diagnostics, object_counts
+from src.api.app.prediction_log import PredictionLogWriter
 from src.api.app.service import Service
+from src.api.app.shadow import ShadowScorer
+from src.api.domain import SURVIVED_SEX, Boston, Survived, drift_monitors, path
+
+
+CANDIDATE_FILES = {
+    'survived': ['survived.pkl', 'survived_features.json'],
+    'boston': ['boston.pkl', 'boston_scx.pkl', 'boston_scy.pkl', 'boston_features.json'],
+}
+
+
+def create_shadows(directory=path + '/model/candidate'):
+    """候補モデルのファイルがすべて置かれていれば、本番モデルと比較するShadowScorerを作成
+
+    Bostonはモデルごとに目的変数の標準化が異なるため、それぞれのスケーラーで戻した価格で比較する。
+    """
+    def published(name):
+        return all(os.path.exists(f'{directory}/{file}') for file in CANDIDATE_FILES[name])
+
+    shadows = {}
+    if published('survived'):
+        survived = Survived(directory=directory)
+        shadows['survived'] = ShadowScorer(survived.predict, dtype=object)
+    if published('boston'):
+        boston = Boston(directory=directory)
+        shadows['boston'] = ShadowScorer(
+            lambda x: boston.predict_price(*x.T), kind='regression', tolerance=1.0)
+    return shadows
+
+
+shadows = create_shadows()
+monitors = drift_monitors()
+prediction_log = PredictionLogWriter(
+    directory=os.environ.get('PREDICTION_LOG_DIR', path + '/logs'),
+    format=os.environ.get('PREDICTION_LOG_FORMAT', 'jsonl'))
+
+
+warmup = {'ready': False, 'report': None, 'error': None}
+
+
+async def run_warm_up():
+    """起動時に全モデルを予測してからreadinessを有効にする"""
+    try:
+        warmup['report'] = await asyncio.to_thread(service.warm_up)
+        warmup['ready'] = True
+    except Exception as e:
+        warmup['error'] = repr(e)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    for shadow in shadows.values():
+        shadow.start()
+    prediction_log.start()
+    task = asyncio.create_task(run_warm_up())
+    yield
+    task.cancel()
+    prediction_log.stop()
+    for shadow in shadows.values():
+        shadow.stop()
+
 
 app = FastAPI(
     title="スッキリわかるPythonによる機械学習入門 API",
     description="スッキリわかるPythonによる機械学習入門の機械学習モデルをAPI化したものです",
     version="0.1.0",
     openapi_url="/api/v1/openapi.json",
+    lifespan=lifespan,
 )
 service = Service()
 
@@ -32,7 +102,8 @@ class SurvivedModel(BaseModel):
     SlibSp: int
     Parch: int
     Fare: float
-    Sex: int
+    # 1が男性、0が女性
+    Sex: Literal[0, 1]
 
 
 class BostonModel(BaseModel):
@@ -48,7 +119,21 @@ async def read_root():
     }
 
 
+@app.get("/health/live", tags=["Health"], description="プロセスが応答できるか（liveness）")
+async def liveness():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready", tags=["Health"], description="ウォームアップが終わり予測を受け付けられるか（readiness）")
+async def readiness():
+    if not warmup['ready']:
+        status = "failed" if warmup['error'] else "warming_up"
+        return JSONResponse(status_code=503, content={"status": status, "error": warmup['error']})
+    return {"status": "ready", "warmup": warmup['report']}
+
+
 @app.post("/iris", tags=["Iris"], description="分類1:アヤメの判別")
+@diagnostics.track("iris")
 async def predict_iris(
     model: IrisModle,
 ):
@@ -58,11 +143,14 @@ async def predict_iris(
         model.petal_length,
         model.petal_width
     ]]
+    monitors['iris'].update(x)
     resutl = service.predict_iris(x)
+    await prediction_log.alog('iris', x[0], resutl[0])
     return resutl[0]
 
 
 @app.post("/cinema", tags=["Cinema"], description="回帰1:映画の興行収入の予測")
+@diagnostics.track("cinema")
 async def predict_cinema(
     model: CinemaModel,
 ):
@@ -72,11 +160,14 @@ async def predict_cinema(
         model.actor,
         model.original
     ]]
+    monitors['cinema'].update(x)
     resutl = service.predict_cinema(x)
+    await prediction_log.alog('cinema', x[0], resutl[0])
     return resutl[0]
 
 
 @app.post("/survived", tags=["Survived"], description="分類2:客船沈没事故での生存予測")
+@diagnostics.track("survived")
 async def predict_survived(
     model: SurvivedModel,
 ):
@@ -88,13 +179,150 @@ async def predict_survived(
         model.Fare,
         model.Sex
     ]]
-    result = service.predict_survived(x)
+    monitors['survived'].update(x)
+    rows = survived_rows([model])
+    result = service.predict_survived(rows)
+    await prediction_log.alog('survived', x[0], result[0])
+    if 'survived' in shadows:
+        shadows['survived'].submit(rows[0], result[0])
     return int(result[0])
 
 
 @app.post("/boston", tags=["Boston"], description="回帰2:住宅の平均価格の予測")
+@diagnostics.track("boston")
 async def predict_boston(
     model: BostonModel,
 ):
+    monitors['boston'].update([model.rm, model.lstat, model.ptratio])
     result = service.predict_boston(model.rm, model.lstat, model.ptratio)
+    await prediction_log.alog('boston', [model.rm, model.lstat, model.ptratio], result[0][0])
+    if 'boston' in shadows:
+        price = service.model('boston').model_scy.inverse_transform(result)[0][0]
+        shadows['boston'].submit([model.rm, model.lstat, model.ptratio], price)
     return result[0][0]
+
+
+@app.get("/drift", tags=["Drift"], description="学習データと比べた入力の分布のずれ（特徴量ごとのPSI）")
+async def drift():
+    return {name: monitor.scores() for name, monitor in monitors.items()}
+
+
+@app.get("/shadow", tags=["Shadow"], description="候補モデルと本番モデルの予測の比較")
+async def shadow_stats():
+    return {name: shadow.stats() for name, shadow in shadows.items()}
+
+
+def explanations(frame):
+    """寄与のデータフレームを行ごとの{bias, contributions, prediction}に変換"""
+    features = frame.drop(columns='bias')
+    return [{
+        'bias': float(bias),
+        'contributions': dict(zip(features.columns, map(float, row))),
+        'prediction': float(bias + row.sum()),
+    } for bias, row in zip(frame['bias'], features.to_numpy())]
+
+
+def cinema_rows(models):
+    return [[m.SNS1, m.SNS2, m.actor, m.original] for m in models]
+
+
+def survived_rows(models):
+    """特徴量の仕様の入力（Pclass, Age, SibSp, Parch, Fare, Sex）の順の行"""
+    return [[m.Pclass, m.Age, m.SlibSp, m.Parch, m.Fare, SURVIVED_SEX[m.Sex]] for m in models]
+
+
+@app.post("/cinema/explain", tags=["Cinema"], description="興行収入の予測に対する特徴量ごとの寄与")
+async def explain_cinema(model: CinemaModel):
+    return explanations(service.explain_cinema(cinema_rows([model])))[0]
+
+
+@app.post("/cinema/explain/batch", tags=["Cinema"])
+async def explain_cinema_batch(models: List[CinemaModel]):
+    return explanations(service.explain_cinema(cinema_rows(models)))
+
+
+@app.post("/survived/explain", tags=["Survived"], description="生存の確率に対する特徴量ごとの寄与")
+async def explain_survived(model: SurvivedModel):
+    return explanations(service.explain_survived(survived_rows([model])))[0]
+
+
+@app.post("/survived/explain/batch", tags=["Survived"])
+async def explain_survived_batch(models: List[SurvivedModel]):
+    return explanations(service.explain_survived(survived_rows(models)))
+
+
+@app.post("/boston/explain", tags=["Boston"], description="住宅価格の予測に対する特徴量ごとの寄与")
+async def explain_boston(model: BostonModel):
+    return explanations(service.explain_boston(model.rm, model.lstat, model.ptratio))[0]
+
+
+@app.post("/boston/explain/batch", tags=["Boston"])
+async def explain_boston_batch(models: List[BostonModel]):
+    result = service.explain_boston([m.rm for m in models], [m.lstat for m in models],
+                                    [m.ptratio for m in models])
+    return explanations(result)
+
+
+def require_admin(x_admin_token: str = Header(None)):
+    """環境変数ADMIN_TOKENと一致するトークンのリクエストだけ許可（未設定なら無効）"""
+    token = os.environ.get('ADMIN_TOKEN')
+    # 一致するまでの時間からトークンを推測されないよう定数時間で比較する
+    if not token or not secrets.compare_digest((x_admin_token or '').encode(), token.encode()):
+        raise HTTPException(status_code=403, detail="forbidden")
+
+
+MODEL_CLASSES = ['Iris', 'Cinema', 'Survived', 'Boston', 'DecisionTreeClassifier',
+                 'LinearRegression', 'StandardScaler', 'FeaturePipeline',
+                 'IrisModle', 'CinemaModel', 'SurvivedModel', 'BostonModel']
+
+
+@app.get("/admin/memory", tags=["Admin"], dependencies=[Depends(require_admin)],
+         description="エンドポイント・処理段階別のメモリ割り当てとモデルのオブジェクト数")
+async def memory_report():
+    return {
+        'sample_rate': diagnostics.sample_rate,
+        'tracing': diagnostics.tracing,
+        'overlapped': diagnostics.overlapped,
+        'stages': diagnostics.report(),
+        'objects': object_counts(MODEL_CLASSES),
+    }
+
+
+@app.get("/admin/prediction_log", tags=["Admin"], dependencies=[Depends(require_admin)],
+         description="予測ログの書き込み件数・破棄件数・スループット・遅延")
+async def prediction_log_stats():
+    return prediction_log.stats()
+
+
+@app.put("/admin/memory/sample_rate", tags=["Admin"], dependencies=[Depends(require_admin)])
+async def set_sample_rate(sample_rate: float = Query(ge=0.0, le=1.0)):
+    diagnostics.sample_rate = sample_rate
+    return {'sample_rate': diagnostics.sample_rate}
+
+
+@app.post("/admin/memory/snapshots", tags=["Admin"], dependencies=[Depends(require_admin)],
+          description="tracemallocのスナップショットを取得（初回でトレースを開始）")
+async def take_snapshot(limit: int = 20):
+    snapshot_id = diagnostics.snapshot()
+    return {'id': snapshot_id, 'top': diagnostics.top(snapshot_id, limit=limit)}
+
+
+# tracemallocのSnapshot.compare_toで集計できる単位
+SNAPSHOT_KEYS = ('filename', 'lineno', 'traceback')
+
+
+@app.get("/admin/memory/snapshots/{old}/diff/{new}", tags=["Admin"],
+         dependencies=[Depends(require_admin)], description="2つのスナップショットの差分")
+async def diff_snapshots(old: int, new: int, key: str = 'lineno', limit: int = 20):
+    if old not in diagnostics.snapshots or new not in diagnostics.snapshots:
+        raise HTTPException(status_code=404, detail="snapshot not found")
+    if key not in SNAPSHOT_KEYS:
+        raise HTTPException(status_code=422, detail=f"unknown key: {key}")
+    return diagnostics.diff(old, new, key=key, limit=limit)
+
+
+@app.delete("/admin/memory/snapshots", tags=["Admin"], dependencies=[Depends(require_admin)],
+            description="トレースを止めてスナップショットを破棄")
+async def stop_tracing():
+    diagnostics.stop_tracing()
+    return {'tracing': diagnostics.tracing}
@@ -0,0 +1,192 @@
+import contextvars
+import functools
+import gc
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class MemoryDiagnostics:
+    """メモリ使用量の診断（エンドポイント・処理段階別の割り当て量とスナップショットの比較）
+
+    リクエストの割り当て量はsample_rateの割合のリクエストだけtracemallocで計測する。
+    計測中でなければtracemallocは止めておくため、計測しないリクエストの負荷はほぼない。
+    計測中のリクエストの状態はContextVarに持つため、awaitで他のリクエストに切り替わっても混ざらない。
+    tracemallocはプロセス全体の割り当てを数えるため、同時に計測するリクエストは1つだけにし、
+    計測中に他のリクエストが実行されたときはリクエスト全体（request）の値を記録せずoverlappedに数える。
+    awaitを含まない処理段階（stage）の値はそのリクエストの割り当てとして記録する。
+    """
+
+    def __init__(self, sample_rate=0.01, frames=1, max_snapshots=10) -> None:
+        self.sample_rate = sample_rate
+        self.frames = frames
+        self.max_snapshots = max_snapshots
+        self.lock = threading.Lock()
+        self.current = contextvars.ContextVar('memory_request', default=None)
+        self.stats = {}
+        self.snapshots = {}
+        self.next_id = 1
+        self.tracing = False
+        # トレースの開始・停止の回数（計測中に変わった値は使わない）
+        self.epoch = 0
+        self.inflight = 0
+        self.arrivals = 0
+        self.sampling = False
+        self.overlapped = 0
+
+    def track(self, endpoint):
+        """ハンドラをエンドポイント名で計測するデコレータ"""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.lock:
+                    self.inflight += 1
+                    self.arrivals += 1
+                    sample = (not self.sampling and self.current.get() is None
+                              and random.random() < self.sample_rate)
+                    if sample:
+                        self.sampling = True
+                try:
+                    if not sample:
+                        return await func(*args, **kwargs)
+                    with self._request(endpoint):
+                        return await func(*args, **kwargs)
+                finally:
+                    with self.lock:
+                        self.inflight -= 1
+                        if sample:
+                            self.sampling = False
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def _request(self, endpoint):
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(self.frames)
+        with self.lock:
+            alone = self.inflight == 1
+            arrivals = self.arrivals
+        state = {'endpoint': endpoint, 'peak': 0, 'record_request': True}
+        token = self.current.set(state)
+        try:
+            with self._stage('request'):
+                try:
+                    yield
+                finally:
+                    with self.lock:
+                        state['record_request'] = alone and self.arrivals == arrivals
+                        if not state['record_request']:
+                            self.overlapped += 1
+        finally:
+            self.current.reset(token)
+            if started and not self.tracing and tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name):
+        """計測中のリクエストの処理段階（モデルの読み込み、予測など）を計測"""
+        if self.current.get() is None:
+            yield
+            return
+        with self._stage(name):
+            yield
+
+    @contextmanager
+    def _stage(self, name):
+        state = self.current.get()
+        epoch = self.epoch
+        before, peak = tracemalloc.get_traced_memory()
+        # 外側の段階の最大値を退避し、この段階の最大値を計測し直す
+        outer = max(state['peak'], peak)
+        state['peak'] = before
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            after, peak = tracemalloc.get_traced_memory()
+            peak = max(state['peak'], peak)
+            state['peak'] = max(outer, peak)
+            # 計測中にトレースを止めた（または開始し直した）場合は差が意味を持たない
+            valid = epoch == self.epoch and tracemalloc.is_tracing()
+            if valid and (name != 'request' or state['record_request']):
+                self._record(state['endpoint'], name, after - before, max(peak - before, 0),
+                             time.perf_counter() - start)
+
+    def _record(self, endpoint, stage, net, peak, seconds):
+        with self.lock:
+            stats = self.stats.setdefault((endpoint, stage), {
+                'count': 0, 'net_bytes': 0, 'max_net_bytes': 0, 'max_peak_bytes': 0, 'seconds': 0.0})
+            stats['count'] += 1
+            stats['net_bytes'] += net
+            stats['max_net_bytes'] = max(stats['max_net_bytes'], net)
+            stats['max_peak_bytes'] = max(stats['max_peak_bytes'], peak)
+            stats['seconds'] += seconds
+
+    def report(self):
+        """エンドポイント・処理段階ごとの平均の割り当て量（リクエスト終了時に残った量と最大量）"""
+        with self.lock:
+            items = sorted(self.stats.items())
+        return [{
+            'endpoint': endpoint,
+            'stage': stage,
+            'count': s['count'],
+            'mean_net_bytes': s['net_bytes'] / s['count'],
+            'max_net_bytes': s['max_net_bytes'],
+            'max_peak_bytes': s['max_peak_bytes'],
+            'mean_ms': s['seconds'] / s['count'] * 1000,
+        } for (endpoint, stage), s in items]
+
+    def start_tracing(self):
+        """スナップショット用に常時のトレースを開始"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.epoch += 1
+        self.tracing = True
+
+    def stop_tracing(self):
+        self.tracing = False
+        tracemalloc.stop()
+        self.epoch += 1
+        self.snapshots.clear()
+
+    def snapshot(self):
+        """スナップショットを取得してIDを返す（古いものからmax_snapshots件を超えた分を捨てる）"""
+        self.start_tracing()
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        with self.lock:
+            snapshot_id = self.next_id
+            self.next_id += 1
+            self.snapshots[snapshot_id] = snapshot
+            while len(self.snapshots) > self.max_snapshots:
+                del self.snapshots[min(self.snapshots)]
+        return snapshot_id
+
+    def top(self, snapshot_id, key='lineno', limit=20):
+        stats = self.snapshots[snapshot_id].statistics(key)[:limit]
+        return [{'location': str(s.traceback), 'size': s.size, 'count': s.count} for s in stats]
+
+    def diff(self, old, new, key='lineno', limit=20):
+        """2つのスナップショットの間で増えた割り当ての上位"""
+        stats = self.snapshots[new].compare_to(self.snapshots[old], key)[:limit]
+        return [{'location': str(s.traceback), 'size_diff': s.size_diff, 'size': s.size,
+                 'count_diff': s.count_diff, 'count': s.count} for s in stats]
+
+
+def object_counts(names):
+    """生存しているオブジェクトのうちクラス名がnamesに含まれるものの個数"""
+    counts = dict.fromkeys(names, 0)
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        if name in counts:
+            counts[name] += 1
+    return counts
+
+
+diagnostics = MemoryDiagnostics()
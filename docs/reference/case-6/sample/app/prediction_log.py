@@ -0,0 +1,192 @@
+import asyncio
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+
+
+def _default(obj):
+    # numpyのスカラーや配列をJSONに変換
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
+
+
+class PredictionLogWriter:
+    """予測の入力と結果を別スレッドでまとめてファイルに書き出す
+
+    logはキューに入れるだけで、書き込みは別スレッドがbatch_size件またはflush_interval秒ごとに行う。
+    キューが一杯のとき、policy='drop'なら捨て、'block'なら空くまで（最大block_timeout秒）待つ。
+    'block'では上限のblock_timeoutが必須で、非同期のハンドラーからはイベントループを止めないalogを使う。
+    ファイルはgzip圧縮のJSONL（format='jsonl'）またはParquet（format='parquet'）で、
+    max_records件ごとに新しいファイルに切り替える。
+    """
+
+    def __init__(self, directory, format='jsonl', max_queue=10000, batch_size=500,
+                 flush_interval=1.0, max_records=100000, policy='drop', block_timeout=None) -> None:
+        if format not in ('jsonl', 'parquet'):
+            raise ValueError(f'unknown format: {format}')
+        if policy not in ('drop', 'block'):
+            raise ValueError(f'unknown policy: {policy}')
+        if policy == 'block' and block_timeout is None:
+            raise ValueError("policy='block' requires block_timeout")
+        self.directory = directory
+        self.format = format
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_records = max_records
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.file = None
+        self.writer = None
+        self.file_records = 0
+        self.counts = {'enqueued': 0, 'dropped': 0, 'written': 0, 'batches': 0, 'files': 0, 'errors': 0}
+        self.write_seconds = 0.0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self.started = None
+
+    def start(self):
+        if self.thread is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.stopping.clear()
+            self.started = time.time()
+            self.thread = threading.Thread(target=self._run, name='prediction-log', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        """キューに残った分を書き出してファイルを閉じる"""
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+            self._close()
+
+    def log(self, endpoint, inputs, prediction):
+        """記録をキューに入れる（書き込めなかった場合はFalseを返す）"""
+        record = {'timestamp': time.time(), 'endpoint': endpoint,
+                  'inputs': inputs, 'prediction': prediction}
+        try:
+            if self.policy == 'drop':
+                self.queue.put_nowait(record)
+            else:
+                self.queue.put(record, timeout=self.block_timeout)
+        except queue.Full:
+            with self.lock:
+                self.counts['dropped'] += 1
+            return False
+        with self.lock:
+            self.counts['enqueued'] += 1
+        return True
+
+    async def alog(self, endpoint, inputs, prediction):
+        """logの非同期版（'block'のときはキューが空くのを別スレッドで待つ）"""
+        if self.policy == 'drop':
+            return self.log(endpoint, inputs, prediction)
+        return await asyncio.to_thread(self.log, endpoint, inputs, prediction)
+
+    def _run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                if self.stopping.is_set() and self.queue.empty():
+                    break
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        part = []
+        try:
+            while batch:
+                if self.file_records >= self.max_records:
+                    self._close()
+                if self.file is None:
+                    self._open()
+                n = self.max_records - self.file_records
+                part, batch = batch[:n], batch[n:]
+                if self.format == 'jsonl':
+                    self.file.write(''.join(json.dumps(r, default=_default) + '\n' for r in part))
+                    self.file.flush()
+                else:
+                    self._write_parquet(part)
+                self.file_records += len(part)
+                self._written(part, time.perf_counter() - start)
+                part = []
+                start = time.perf_counter()
+        except Exception:
+            with self.lock:
+                self.counts['errors'] += len(batch) + len(part)
+
+    def _written(self, part, seconds):
+        lag = time.time() - part[0]['timestamp']
+        with self.lock:
+            self.counts['written'] += len(part)
+            self.counts['batches'] += 1
+            self.write_seconds += seconds
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+
+    def _write_parquet(self, part):
+        import pyarrow as pa
+
+        table = pa.table({
+            'timestamp': [r['timestamp'] for r in part],
+            'endpoint': [r['endpoint'] for r in part],
+            'inputs': [json.dumps(r['inputs'], default=_default) for r in part],
+            'prediction': [json.dumps(r['prediction'], default=_default) for r in part],
+        })
+        self.writer.write_table(table)
+
+    def _open(self):
+        name = time.strftime('predictions-%Y%m%d-%H%M%S') + f"-{self.counts['files'] + 1:06d}"
+        if self.format == 'jsonl':
+            self.file = gzip.open(os.path.join(self.directory, name + '.jsonl.gz'), 'wt', encoding='utf-8')
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            schema = pa.schema([('timestamp', pa.float64()), ('endpoint', pa.string()),
+                                ('inputs', pa.string()), ('prediction', pa.string())])
+            self.file = os.path.join(self.directory, name + '.parquet')
+            self.writer = pq.ParquetWriter(self.file, schema, compression='zstd')
+        self.file_records = 0
+        with self.lock:
+            self.counts['files'] += 1
+
+    def _close(self):
+        if self.writer is not None:
+            self.writer.close()
+        elif self.file is not None:
+            self.file.close()
+        self.file = None
+        self.writer = None
+
+    def stats(self):
+        """件数、キューの長さ、書き込みのスループット（件/秒）と遅延（秒）"""
+        with self.lock:
+            stats = dict(self.counts)
+            elapsed = time.time() - self.started if self.started else 0.0
+            stats.update({
+                'queued': self.queue.qsize(),
+                'records_per_sec': stats['written'] / elapsed if elapsed else 0.0,
+                'write_records_per_sec': stats['written'] / self.write_seconds if self.write_seconds else None,
+                'last_lag': self.last_lag,
+                'max_lag': self.max_lag,
+            })
+        return stats
@@ -1,7 +1,19 @@
+import os
+import time
 
 import pandas as pd
 
 
+def database_url():
+    host = 'localhost'
+    port = '5432'
+    db = 'test'
+    username = 'root'
+    password = 'root'
+
+    return f'postgresql://{username}:{password}@{host}:{port}/{db}'
+
+
 class CSVRepository:
     def __init__(self, file) -> None:
         self.file = file
@@ -11,17 +23,183 @@ class CSVRepository:
 
 
 class SQLRepository:
-    def __init__(self, table) -> None:
+    def __init__(self, table, url=None) -> None:
         self.table = table
+        self.url = url or database_url()
 
     def get_data(self):
         from sqlalchemy import create_engine
-        host = 'localhost'
-        port = '5432'
-        db = 'test'
-        username = 'root'
-        password = 'root'
-
-        engine = create_engine(
-            f'postgresql://{username}:{password}@{host}:{port}/{db}')
+
+        engine = create_engine(self.url)
         return pd.read_sql_table(self.table, engine)
+
+
+def _dtype_name(dtype):
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'boolean'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'Int64'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'float64'
+    return 'object'
+
+
+def _widen(a, b):
+    """2つの型の値をどちらも表せる型"""
+    if a is None or a == b:
+        return b
+    if {a, b} == {'Int64', 'float64'}:
+        return 'float64'
+    return 'object'
+
+
+class SQLBulkLoader:
+    """CSVデータをSQLテーブルへ一括投入する
+
+    PostgreSQLではCOPY、SQLiteではトランザクション内のexecutemanyを使い、
+    CSVはチャンク単位で読み込むためメモリに収まらないファイルも扱える。
+    """
+
+    def __init__(self, url=None, chunksize=100000) -> None:
+        self.url = url or database_url()
+        self.chunksize = chunksize
+
+    def load(self, file, table, replace=True):
+        """CSVファイルを型付きのテーブルへ投入し、件数と秒間行数を返す"""
+        dtypes = self.infer_dtypes(file)
+        return self.load_frames(pd.read_csv(file, dtype=dtypes, chunksize=self.chunksize),
+                                table, dtypes, replace)
+
+    def load_frames(self, chunks, table, dtypes, replace=True):
+        """DataFrameのチャンクを列の型dtypesのテーブルへ順に投入"""
+        from sqlalchemy import create_engine
+
+        engine = create_engine(self.url)
+        sql_table = self.table(table, dtypes)
+
+        start = time.perf_counter()
+        connection = engine.raw_connection()
+        try:
+            rows = self.write(connection, engine.dialect, sql_table, chunks, replace)
+        finally:
+            connection.close()
+        engine.dispose()
+        seconds = time.perf_counter() - start
+
+        return {
+            'table': table,
+            'rows': rows,
+            'seconds': seconds,
+            'rows_per_sec': rows / seconds if seconds > 0 else float('inf'),
+        }
+
+    def load_all(self, directory):
+        """ディレクトリ内の全CSVをファイル名に対応するテーブルへ投入"""
+        reports = []
+        for name in sorted(os.listdir(directory)):
+            stem, ext = os.path.splitext(name)
+            if ext != '.csv':
+                continue
+            table = stem[0].upper() + stem[1:]
+            reports.append(self.load(os.path.join(directory, name), table))
+        return reports
+
+    def infer_dtypes(self, file, nrows=None):
+        """ファイル全体（nrowsを指定すると先頭nrows行）をチャンク単位で走査して列の型を推定
+
+        チャンクごとに推定した型が異なる列は、すべての値を表せる型に広げる
+        （整数と小数はfloat64、真偽値と数値や文字列が混在すればobject）。
+        整数列は欠損を許容する型にし、全て欠損のチャンクは型の推定に使わない。
+        欠損のために小数として読まれた整数だけの列も整数列とみなす。
+        """
+        dtypes = {}
+        for chunk in pd.read_csv(file, nrows=nrows, chunksize=self.chunksize):
+            for c, dtype in chunk.dtypes.items():
+                if c not in dtypes:
+                    dtypes[c] = None
+                values = chunk[c]
+                if values.isna().all():
+                    continue
+                name = _dtype_name(dtype)
+                # 欠損があるために小数になった整数列
+                if name == 'float64' and values.hasnans and (values.dropna() % 1 == 0).all():
+                    name = 'Int64'
+                dtypes[c] = _widen(dtypes[c], name)
+        # 全ての値が欠損の列は文字列として扱う
+        return {c: dtype or 'object' for c, dtype in dtypes.items()}
+
+    def table(self, table, dtypes):
+        """列の型に対応するテーブルの定義"""
+        from sqlalchemy import BigInteger, Boolean, Column, Float, MetaData, Table, Text
+
+        types = {'boolean': Boolean, 'Int64': BigInteger,
+                 'float64': Float, 'object': Text}
+        return Table(table, MetaData(), *[
+            Column(c, types[dtype]) for c, dtype in dtypes.items()])
+
+    def write(self, connection, dialect, sql_table, chunks, replace):
+        """テーブルの作成（replaceなら作り直し）から全チャンクの投入までを1つのトランザクションで行う
+
+        途中で失敗したときはロールバックし、元のテーブルはそのまま残る。
+        """
+        from sqlalchemy.schema import CreateTable, DropTable
+
+        cursor = connection.cursor()
+        try:
+            if dialect.name == 'sqlite':
+                # sqlite3はDDLの前にトランザクションを始めないため明示的に始める
+                cursor.execute('BEGIN')
+            if replace:
+                cursor.execute(str(DropTable(sql_table, if_exists=True).compile(dialect=dialect)))
+            cursor.execute(str(CreateTable(sql_table, if_not_exists=not replace).compile(dialect=dialect)))
+            rows = 0
+            for chunk in chunks:
+                self.insert(cursor, dialect, sql_table, chunk)
+                rows += len(chunk)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        return rows
+
+    def insert(self, cursor, dialect, sql_table, chunk):
+        """バックエンドごとの最速の方法でチャンクを投入"""
+        if dialect.name == 'postgresql':
+            self.copy(cursor, dialect, sql_table, chunk)
+        else:
+            self.executemany(cursor, dialect, sql_table, chunk)
+
+    def copy(self, cursor, dialect, sql_table, chunk):
+        import io
+
+        preparer = dialect.identifier_preparer
+        cols = ', '.join(preparer.quote(c.name) for c in sql_table.columns)
+        # csv形式のCOPYは引用符のない空欄をNULLにするため、欠損は値に現れない記号で表し
+        # 空文字列はexecutemanyと同じく空文字列のまま投入する
+        null = '\\N'
+        strings = chunk.select_dtypes('object')
+        while (strings == null).any(axis=None):
+            null += 'N'
+        buffer = io.StringIO()
+        chunk.to_csv(buffer, index=False, header=False, na_rep=null)
+        buffer.seek(0)
+        cursor.copy_expert(
+            f"COPY {preparer.format_table(sql_table)} ({cols}) FROM STDIN WITH (FORMAT csv, NULL '{null}')",
+            buffer)
+
+    def executemany(self, cursor, dialect, sql_table, chunk):
+        statement = str(sql_table.insert().compile(dialect=dialect))
+        values = chunk.astype(object).where(chunk.notna(), None)
+        rows = values.itertuples(index=False, name=None)
+        if dialect.paramstyle not in ('qmark', 'format'):
+            cols = [c.name for c in sql_table.columns]
+            rows = (dict(zip(cols, row)) for row in rows)
+        cursor.executemany(statement, list(rows))
+
+
+if __name__ == '__main__':
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for report in SQLBulkLoader().load_all(path + '/data'):
+        print('{table}: {rows}行 {seconds:.2f}秒 ({rows_per_sec:.0f}行/秒)'.format(**report))
@@ -1,22 +1,95 @@
-from src.api.domain import Boston, Cinema, Iris, Survived
+import threading
+import time
+
+import numpy as np
+
+from src.api.app.diagnostics import diagnostics
+from src.api.app.repository import CSVRepository
+from src.api.domain import SURVIVED_FEATURES, Boston, Cinema, Iris, Survived, path
+
+
+MODELS = {'iris': Iris, 'cinema': Cinema, 'survived': Survived, 'boston': Boston}
 
 
 class Service:
-    def __init__(self) -> None:
-        pass
+    """4つのモデルを初回だけ読み込み、以降の予測と寄与の計算では同じインスタンスを使う"""
+
+    def __init__(self, directory=None) -> None:
+        self.directory = directory
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def model(self, name):
+        model = self.models.get(name)
+        if model is None:
+            # ウォームアップのスレッドとリクエストが同時に読み込まないようにする
+            with self.lock:
+                if name not in self.models:
+                    with diagnostics.stage('load'):
+                        self.models[name] = MODELS[name](directory=self.directory)
+                model = self.models[name]
+        return model
 
     def predict_iris(self, x):
-        iris = Iris()
-        return iris.predict(x)
+        with diagnostics.stage('predict'):
+            return self.model('iris').predict(x)
 
     def predict_cinema(self, x):
-        cinema = Cinema()
-        return cinema.predict(x)
+        with diagnostics.stage('predict'):
+            return self.model('cinema').predict(x)
 
     def predict_survived(self, x):
-        servived = Survived()
-        return servived.predict(x)
+        with diagnostics.stage('predict'):
+            return self.model('survived').predict(x)
 
     def predict_boston(self, rm, lstat, ptratio):
-        boston = Boston()
-        return boston.predict(rm, lstat, ptratio)
+        with diagnostics.stage('predict'):
+            return self.model('boston').predict(rm, lstat, ptratio)
+
+    def explain_cinema(self, x):
+        with diagnostics.stage('explain'):
+            return self.model('cinema').explain(x)
+
+    def explain_survived(self, x):
+        with diagnostics.stage('explain'):
+            return self.model('survived').explain(x)
+
+    def explain_boston(self, rm, lstat, ptratio):
+        with diagnostics.stage('explain'):
+            return self.model('boston').explain(rm, lstat, ptratio)
+
+    def warm_up(self, rows=32, repeat=3):
+        """data/*.csvの代表的な行で4つのモデルを予測し、モデルごとの所要時間を返す
+
+        モデルの読み込みと初回の予測で発生する入力チェックの初期化をリクエストより前に済ませる。
+        1行ずつの予測とrows行まとめての予測、寄与の計算を行う。
+        """
+        def load(name):
+            df = CSVRepository(file=f'{path}/data/{name}.csv').get_data()
+            df.columns = df.columns.str.replace('\ufeff', '')
+            return df
+
+        iris = load('iris')[['sepal_length', 'sepal_width', 'petal_length', 'petal_width']].dropna()
+        cinema = load('cinema')[['SNS1', 'SNS2', 'actor', 'original']].dropna()
+        survived = load('Survived')
+        survived['Age'] = survived['Age'].fillna(survived['Age'].median())
+        boston = load('Boston')[['RM', 'LSTAT', 'PTRATIO']].dropna()
+        inputs = {
+            'iris': ([self.predict_iris], iris.to_numpy()[:rows]),
+            'cinema': ([self.predict_cinema, self.explain_cinema], cinema.to_numpy()[:rows]),
+            'survived': ([self.predict_survived, self.explain_survived],
+                         survived[SURVIVED_FEATURES.inputs].to_numpy(dtype=object)[:rows]),
+            'boston': ([lambda x: self.predict_boston(*np.asarray(x).T),
+                        lambda x: self.explain_boston(*np.asarray(x).T)], boston.to_numpy()[:rows]),
+        }
+
+        report = {}
+        for name, (functions, x) in inputs.items():
+            start = time.perf_counter()
+            self.model(name)
+            for _ in range(repeat):
+                for function in functions:
+                    function(x[:1].tolist())
+                    function(x.tolist())
+            report[name] = time.perf_counter() - start
+        return report
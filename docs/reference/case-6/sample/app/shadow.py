@@ -0,0 +1,113 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class ShadowScorer:
+    """候補モデルで本番のリクエストを裏で予測し、本番モデルとの差を集計する
+
+    リクエストの特徴量は上限付きのキューに入れ、別スレッドでまとめて予測する。
+    キューが一杯のときは待たずに捨てるため、本番の応答時間には影響しない。
+    分類では予測の不一致、回帰では差がtoleranceを超えたものを不一致として数える。
+    文字列を含む入力はdtype=objectのまま候補モデルに渡す。
+    """
+
+    def __init__(self, predict, kind='classification', tolerance=0.0,
+                 maxsize=1000, batch_size=64, timeout=0.1, dtype=float) -> None:
+        self.predict = predict
+        self.dtype = dtype
+        self.kind = kind
+        self.tolerance = tolerance
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        self.counts = {'submitted': 0, 'dropped': 0, 'scored': 0, 'batches': 0,
+                       'errors': 0, 'disagreements': 0}
+        self.abs_error_sum = 0.0
+        self.abs_error_max = 0.0
+        self.seconds = 0.0
+
+    def start(self):
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name='shadow', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        """キューに残った分を予測してから止める"""
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, x, result):
+        """入力1行と本番モデルの予測を投入（キューが一杯なら捨ててFalseを返す）"""
+        try:
+            self.queue.put_nowait((x, result))
+        except queue.Full:
+            with self.lock:
+                self.counts['dropped'] += 1
+            return False
+        with self.lock:
+            self.counts['submitted'] += 1
+        return True
+
+    def _run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=self.timeout)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._score(batch)
+
+    def _score(self, batch):
+        x = np.array([b[0] for b in batch], dtype=self.dtype)
+        expected = np.array([b[1] for b in batch])
+        start = time.perf_counter()
+        try:
+            result = np.asarray(self.predict(x)).reshape(len(batch))
+        except Exception:
+            with self.lock:
+                self.counts['errors'] += len(batch)
+                self.counts['batches'] += 1
+            return
+        elapsed = time.perf_counter() - start
+
+        if self.kind == 'classification':
+            disagreements = int(np.count_nonzero(result != expected))
+            abs_error = np.zeros(len(batch))
+        else:
+            abs_error = np.abs(result.astype(float) - expected.astype(float))
+            disagreements = int(np.count_nonzero(abs_error > self.tolerance))
+        with self.lock:
+            self.counts['scored'] += len(batch)
+            self.counts['batches'] += 1
+            self.counts['disagreements'] += disagreements
+            self.abs_error_sum += float(abs_error.sum())
+            self.abs_error_max = max(self.abs_error_max, float(abs_error.max()))
+            self.seconds += elapsed
+
+    def stats(self):
+        """投入・破棄・予測件数と、不一致率・誤差・予測時間の集計"""
+        with self.lock:
+            stats = dict(self.counts)
+            scored = stats['scored']
+            stats['queued'] = self.queue.qsize()
+            stats['disagreement_rate'] = stats['disagreements'] / scored if scored else None
+            if self.kind == 'regression':
+                stats['mean_abs_error'] = self.abs_error_sum / scored if scored else None
+                stats['max_abs_error'] = self.abs_error_max
+            stats['mean_batch_size'] = scored / stats['batches'] if stats['batches'] else None
+            stats['seconds'] = self.seconds
+        return stats
@@ -0,0 +1,285 @@
+import asyncio
+import copy
+import glob
+import gzip
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+path = os.path.dirname(os.path.abspath(__file__))
+logs = tempfile.TemporaryDirectory()
+os.environ['PREDICTION_LOG_DIR'] = logs.name
+
+# アプリはこのディレクトリをsrc.apiパッケージとして読み込む
+if 'src.api' not in sys.modules:
+    sys.modules['src'] = types.ModuleType('src')
+    sys.modules['src'].__path__ = []
+    sys.modules['src.api'] = types.ModuleType('src.api')
+    sys.modules['src.api'].__path__ = [path]
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from src.api.app import application  # noqa: E402
+from src.api.app.prediction_log import PredictionLogWriter  # noqa: E402
+from src.api.domain import SURVIVED_FEATURES, Boston, Survived, drift_monitors  # noqa: E402
+
+
+def tearDownModule():
+    logs.cleanup()
+
+
+class TestCreateShadows(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def publish(self, files):
+        for file in files:
+            shutil.copy(f'{path}/model/{file}', self.tmp.name)
+
+    def test_incomplete(self):
+        self.publish(['boston.pkl', 'boston_scx.pkl', 'survived.pkl', 'survived_features.json'])
+        self.assertEqual(list(application.create_shadows(self.tmp.name)), ['survived'])
+
+    def test_price_scale(self):
+        self.publish(application.CANDIDATE_FILES['boston'])
+        live = Boston()
+        x = [[6.5, 5.0, 15.0], [5.9, 12.3, 20.2]]
+        prices = [live.predict_price(*row)[0] for row in x]
+
+        shadow = application.create_shadows(self.tmp.name)['boston'].start()
+        for row, price in zip(x, prices):
+            shadow.submit(row, price)
+        shadow.stop()
+        self.assertEqual(shadow.stats()['disagreements'], 0)
+
+        # 標準化した予測は同じでも目的変数のスケーラーが異なれば価格は異なる
+        scy = copy.deepcopy(live.model_scy)
+        scy.mean_ = scy.mean_ + 5
+        with open(self.tmp.name + '/boston_scy.pkl', 'wb') as f:
+            pickle.dump(scy, f)
+        shadow = application.create_shadows(self.tmp.name)['boston'].start()
+        for row, price in zip(x, prices):
+            shadow.submit(row, price)
+        shadow.stop()
+        stats = shadow.stats()
+        self.assertEqual(stats['disagreements'], 2)
+        self.assertAlmostEqual(stats['mean_abs_error'], 5.0)
+
+
+class TestShadowEndpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for file in application.CANDIDATE_FILES['survived'] + application.CANDIDATE_FILES['boston']:
+            shutil.copy(f'{path}/model/{file}', self.tmp.name)
+        self.shadows = application.create_shadows(self.tmp.name)
+        patcher = mock.patch.object(application, 'shadows', self.shadows)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = TestClient(application.app)
+
+    def test_stats(self):
+        for shadow in self.shadows.values():
+            shadow.start()
+        for sex in (0, 1):
+            self.client.post('/survived', json={'Pclass': 1, 'Age': 38, 'SlibSp': 1, 'Parch': 0,
+                                                'Fare': 71.28, 'Sex': sex})
+        self.client.post('/boston', json={'rm': 6.5, 'lstat': 5.0, 'ptratio': 15.0})
+        for shadow in self.shadows.values():
+            shadow.stop()
+        result = self.client.get('/shadow').json()
+        self.assertEqual(result['survived']['scored'], 2)
+        self.assertEqual(result['survived']['errors'], 0)
+        self.assertEqual(result['survived']['disagreements'], 0)
+        self.assertEqual(result['boston']['scored'], 1)
+        self.assertAlmostEqual(result['boston']['max_abs_error'], 0.0)
+
+    def test_without_candidates(self):
+        with mock.patch.object(application, 'shadows', {}):
+            self.assertEqual(self.client.get('/shadow').json(), {})
+
+
+class TestSurvivedParity(unittest.TestCase):
+
+    def test_request_fields(self):
+        # APIのリクエストから作った入力と学習時の特徴量で同じ予測になる
+        df = pd.read_csv(f'{path}/data/Survived.csv')
+        df['Age'] = df['Age'].fillna(df['Age'].median()).astype(int)
+        models = [application.SurvivedModel(Pclass=r.Pclass, Age=r.Age, SlibSp=r.SibSp, Parch=r.Parch,
+                                            Fare=r.Fare, Sex=int(r.Sex == 'male'))
+                  for r in df.itertuples()]
+        survived = Survived()
+        expected = survived.model.predict(SURVIVED_FEATURES.frame(df))
+        result = application.service.predict_survived(application.survived_rows(models))
+        np.testing.assert_array_equal(result, expected)
+
+
+class TestHealth(unittest.TestCase):
+
+    def setUp(self):
+        self.client = TestClient(application.app)
+        state = dict(application.warmup)
+        self.addCleanup(application.warmup.update, state)
+        application.warmup.update({'ready': False, 'report': None, 'error': None})
+
+    def test_live(self):
+        self.assertEqual(self.client.get('/health/live').json(), {'status': 'ok'})
+
+    def test_ready(self):
+        response = self.client.get('/health/ready')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['status'], 'warming_up')
+        asyncio.run(application.run_warm_up())
+        response = self.client.get('/health/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()['warmup']), {'iris', 'cinema', 'survived', 'boston'})
+
+    def test_failed(self):
+        with mock.patch.object(application.service, 'warm_up', side_effect=RuntimeError('broken')):
+            asyncio.run(application.run_warm_up())
+        response = self.client.get('/health/ready')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['status'], 'failed')
+        self.assertIn('broken', response.json()['error'])
+
+
+class TestExplain(unittest.TestCase):
+
+    def setUp(self):
+        self.client = TestClient(application.app)
+
+    def test_survived(self):
+        body = {'Pclass': 3, 'Age': 22, 'SlibSp': 1, 'Parch': 0, 'Fare': 7.25, 'Sex': 1}
+        result = self.client.post('/survived/explain', json=body).json()
+        self.assertEqual(list(result['contributions']), ['Pclass', 'Age', 'SibSp', 'Parch', 'Fare', 'male'])
+        survived = Survived()
+        probability = survived.model.predict_proba(survived.transform([[3, 22, 1, 0, 7.25, 'male']]))[0, 1]
+        self.assertAlmostEqual(result['prediction'], probability)
+        self.assertAlmostEqual(result['bias'] + sum(result['contributions'].values()), result['prediction'])
+        batch = self.client.post('/survived/explain/batch', json=[body, dict(body, Sex=0)]).json()
+        self.assertEqual(len(batch), 2)
+        self.assertAlmostEqual(batch[0]['prediction'], result['prediction'])
+
+    def test_cinema(self):
+        body = {'SNS1': 291, 'SNS2': 1044, 'actor': 8808, 'original': 0}
+        result = self.client.post('/cinema/explain', json=body).json()
+        self.assertAlmostEqual(result['prediction'], self.client.post('/cinema', json=body).json())
+        self.assertEqual(len(self.client.post('/cinema/explain/batch', json=[body] * 3).json()), 3)
+
+    def test_boston(self):
+        body = {'rm': 6.5, 'lstat': 5.0, 'ptratio': 15.0}
+        result = self.client.post('/boston/explain', json=body).json()
+        self.assertAlmostEqual(result['prediction'], self.client.post('/boston', json=body).json())
+        batch = self.client.post('/boston/explain/batch', json=[body, dict(body, rm=5.9)]).json()
+        self.assertAlmostEqual(batch[0]['prediction'], result['prediction'])
+        self.assertEqual(len(batch), 2)
+
+
+class TestDrift(unittest.TestCase):
+
+    def setUp(self):
+        self.client = TestClient(application.app)
+        patcher = mock.patch.dict(application.monitors, drift_monitors())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_scores(self):
+        result = self.client.get('/drift').json()
+        self.assertEqual(set(result), {'iris', 'cinema', 'survived', 'boston'})
+        self.assertEqual(result['survived']['Age']['count'], 0)
+        body = {'Pclass': 3, 'Age': 22, 'SlibSp': 1, 'Parch': 0, 'Fare': 7.25, 'Sex': 1}
+        for _ in range(5):
+            self.client.post('/survived', json=body)
+        self.client.post('/boston', json={'rm': 6.5, 'lstat': 5.0, 'ptratio': 15.0})
+        result = self.client.get('/drift').json()
+        self.assertEqual(list(result['survived']), ['Pclass', 'Age', 'SibSp', 'Parch', 'Fare', 'male'])
+        self.assertEqual(result['survived']['male']['count'], 5)
+        self.assertGreater(result['survived']['Age']['psi'], 0)
+        self.assertEqual(result['boston']['RM']['count'], 1)
+        self.assertEqual(result['iris']['sepal_length']['count'], 0)
+
+
+class TestPredictionLog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.writer = PredictionLogWriter(self.tmp.name, flush_interval=0.01)
+        for patcher in (mock.patch.object(application, 'prediction_log', self.writer),
+                        mock.patch.dict(os.environ, {'ADMIN_TOKEN': 'secret'})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = TestClient(application.app)
+
+    def test_records(self):
+        self.writer.start()
+        self.client.post('/iris', json={'sepal_length': 1, 'sepal_width': 2, 'petal_length': 4, 'petal_width': 2})
+        self.client.post('/survived', json={'Pclass': 3, 'Age': 22, 'SlibSp': 1, 'Parch': 0, 'Fare': 7.25, 'Sex': 1})
+        self.client.post('/boston', json={'rm': 6.5, 'lstat': 5.0, 'ptratio': 15.0})
+        self.writer.stop()
+        stats = self.client.get('/admin/prediction_log', headers={'X-Admin-Token': 'secret'}).json()
+        self.assertEqual(stats['enqueued'], 3)
+        self.assertEqual(stats['written'], 3)
+        self.assertEqual(self.client.get('/admin/prediction_log').status_code, 403)
+
+        records = []
+        for file in glob.glob(self.tmp.name + '/*.jsonl.gz'):
+            with gzip.open(file, 'rt') as f:
+                records += [json.loads(line) for line in f]
+        self.assertEqual([r['endpoint'] for r in records], ['iris', 'survived', 'boston'])
+        self.assertEqual(records[1]['inputs'], [3, 22, 1, 0, 7.25, 1])
+        self.assertEqual(records[1]['prediction'], 0)
+
+
+class TestAdmin(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {'ADMIN_TOKEN': 'secret'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = TestClient(application.app)
+        self.headers = {'X-Admin-Token': 'secret'}
+        self.addCleanup(lambda: self.client.delete('/admin/memory/snapshots', headers=self.headers))
+
+    def test_token(self):
+        self.assertEqual(self.client.get('/admin/memory').status_code, 403)
+        self.assertEqual(self.client.get('/admin/memory', headers={'X-Admin-Token': 'secreT'}).status_code, 403)
+        self.assertEqual(self.client.get('/admin/memory', headers=self.headers).status_code, 200)
+        with mock.patch.dict(os.environ, {'ADMIN_TOKEN': ''}):
+            self.assertEqual(self.client.get('/admin/memory', headers={'X-Admin-Token': ''}).status_code, 403)
+
+    def test_sample_rate(self):
+        rate = application.diagnostics.sample_rate
+        self.addCleanup(setattr, application.diagnostics, 'sample_rate', rate)
+        response = self.client.put('/admin/memory/sample_rate?sample_rate=0.5', headers=self.headers)
+        self.assertEqual(response.json(), {'sample_rate': 0.5})
+        for value in (-0.1, 1.5):
+            response = self.client.put(f'/admin/memory/sample_rate?sample_rate={value}', headers=self.headers)
+            self.assertEqual(response.status_code, 422)
+        self.assertEqual(application.diagnostics.sample_rate, 0.5)
+
+    def test_snapshot_diff(self):
+        old = self.client.post('/admin/memory/snapshots?limit=3', headers=self.headers).json()['id']
+        new = self.client.post('/admin/memory/snapshots?limit=3', headers=self.headers).json()['id']
+        url = f'/admin/memory/snapshots/{old}/diff/{new}'
+        self.assertEqual(self.client.get(url + '?key=filename&limit=3', headers=self.headers).status_code, 200)
+        self.assertEqual(self.client.get(url + '?key=module', headers=self.headers).status_code, 422)
+        self.assertEqual(self.client.get(f'/admin/memory/snapshots/{old}/diff/{new + 100}',
+                                         headers=self.headers).status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,14 +13,19 @@ import unittest
 import doctest
 import os
 
-from domain import convert_categoricals, CategoricalData, DataVisualization
+from domain import convert_categoricals, CategoricalData, DataVisualization, BOSTON_FEATURES, OutlierFilter
 from app.repository import CSVRepository, SQLRepository
-from domain import learn_with_std as learn
+from domain import learn_with_std, export_onnx, TrainingCache, TrainingPipeline
 
-VISUALIZTION = True
+# 環境変数VISUALIZATION=0でグラフの描画を省略する
+VISUALIZTION = os.environ.get('VISUALIZATION', '1') != '0'
 path = os.path.dirname(os.path.abspath(__file__))
+# 部屋数が少ないのに価格が高い物件を外れ値として除外する
+OUTLIER_RULES = [{'name': 'RMが小さくPRICEが高い', 'method': 'expr', 'expr': 'RM < 6 and PRICE > 40'}]
 # repo = SQLRepository(table='Boston')
 repo = CSVRepository(file=path + '/data/Boston.csv')
+cache = TrainingCache()
+learn = cache.cached(learn_with_std)
 # %% [markdown]
 # ## データの内容
 # | 列名 | 内容 |
@@ -96,7 +101,8 @@ crime = CategoricalData(df, 'CRIME')
 crime.show()
 
 # %%
-crime.plot()
+if VISUALIZTION:
+    crime.plot()
 
 # %% [markdown]
 # ### CRIMEカテゴリの数値変換
@@ -105,7 +111,8 @@ crime.plot()
 categorical_cols = ['CRIME']
 df_conv = convert_categoricals(df, categorical_cols)
 conv_species = CategoricalData(df_conv, 'CRIME')
-conv_species.plot()
+if VISUALIZTION:
+    conv_species.plot()
 
 # %% [markdown]
 # ### ダミー変数化
@@ -157,8 +164,9 @@ train_val2['low'] = train_val2['low'].astype(int)
 train_val2['very_low'] = train_val2['very_low'].astype(int)
 
 colname = train_val2.columns
-for name in colname:
-    train_val2.plot(kind='scatter', x=name, y='PRICE')
+if VISUALIZTION:
+    for name in colname:
+        train_val2.plot(kind='scatter', x=name, y='PRICE')
 
 # %% [markdown]
 # ### 各手法を必要に応じて実施
@@ -254,11 +262,9 @@ train_val, test = train_test_split(df2, test_size=0.2, random_state=0)
 train_val_mean = train_val.mean()
 train_val2 = train_val.fillna(train_val_mean)
 
-out_line1 = train_val2[(train_val2['RM'] < 6) &
-                       (train_val2['PRICE'] > 40)].index
-out_line2 = train_val2[(train_val2['PTRATIO'] > 18) &
-                       (train_val2['PRICE'] > 40)].index
-train_val3 = train_val2.drop([76], axis=0)
+outliers = OutlierFilter(OUTLIER_RULES)
+train_val3 = outliers.fit_transform(train_val2)
+print(outliers.report())
 
 col = ['INDUS', 'NOX', 'RM', 'PTRATIO', 'LSTAT', 'PRICE']
 train_val4 = train_val3[col]
@@ -328,15 +334,61 @@ print(s1, s2)
 # - PTRATIO列のデータを2乗した新しい列を追加
 # - 交差作用特徴量を追加
 # %%
-x = train_val3.loc[:, ['RM', 'LSTAT', 'PTRATIO']]
+x = BOSTON_FEATURES.frame(train_val3)
 t = train_val3[['PRICE']]
-x['RM2'] = x['RM'] ** 2
-x['LSTAT2'] = x['LSTAT'] ** 2
-x['PTRATIO2'] = x['PTRATIO'] ** 2
-x['RM * LSTAT'] = x['RM'] * x['LSTAT']
 s1, s2 = learn(x, t)
 print(s1, s2)
 
+# %% [markdown]
+# ### パイプラインによるTake1〜Take5の比較
+# - 読み込み→欠損値処理→外れ値除外→特徴量→学習・評価を段階として宣言する
+# - 変更した段階以降だけを再計算し、Takeごとの分岐は並列に実行する
+# %%
+
+
+def load_train_val(file):
+    df = CSVRepository(file=file).get_data()
+    crime = pd.get_dummies(df['CRIME'], drop_first=True)
+    df2 = pd.concat([df, crime], axis=1).drop('CRIME', axis=1)
+    train_val, test = train_test_split(df2, test_size=0.2, random_state=0)
+    return train_val
+
+
+def impute_mean(train_val):
+    return train_val.fillna(train_val.mean())
+
+
+def drop_outliers(train_val, rules):
+    return OutlierFilter(rules).fit_transform(train_val)
+
+
+def take_features(train_val, cols):
+    x = BOSTON_FEATURES.frame(train_val)[cols]
+    return x, train_val[['PRICE']]
+
+
+def fit_evaluate(data):
+    return learn_with_std(*data)
+
+
+takes = {
+    'Take1': ['RM', 'LSTAT', 'PTRATIO'],
+    'Take2': ['RM', 'LSTAT', 'PTRATIO', 'RM2'],
+    'Take3': ['RM', 'LSTAT', 'PTRATIO', 'RM2', 'LSTAT2'],
+    'Take4': ['RM', 'LSTAT', 'PTRATIO', 'RM2', 'LSTAT2', 'PTRATIO2'],
+    'Take5': BOSTON_FEATURES.names,
+}
+pipeline = TrainingPipeline()
+pipeline.stage('load', load_train_val, file=path + '/data/Boston.csv')
+pipeline.stage('impute', impute_mean, after='load')
+pipeline.stage('outlier', drop_outliers, after='impute', rules=OUTLIER_RULES)
+for name, cols in takes.items():
+    pipeline.stage(f'{name}_features', take_features, after='outlier', cols=cols)
+    pipeline.stage(name, fit_evaluate, after=f'{name}_features')
+for name, (s1, s2) in pipeline.run().items():
+    print(name, s1, s2)
+print(pipeline.status)
+
 # %% [markdown]
 # ### OK:最終性能評価（テストデータで評価）
 # %% [markdown]
@@ -353,20 +405,13 @@ sc_x = sc_model_x2.transform(x)
 sc_model_y2 = StandardScaler()
 sc_model_y2.fit(t)
 sc_y = sc_model_y2.transform(t)
-model = LinearRegression()
-model.fit(sc_x, sc_y)
+model = cache.fit(LinearRegression(), sc_x, sc_y)
 
 # %%
 test2 = test.fillna(train_val.mean())
-x_test = test2.loc[:, ['RM', 'LSTAT', 'PTRATIO']]
+x_test = BOSTON_FEATURES.frame(test2)
 y_test = test2[['PRICE']]
 
-x_test['RM2'] = x_test['RM'] ** 2
-x_test['LSTAT2'] = x_test['LSTAT'] ** 2
-x_test['PTRATIO2'] = x_test['PTRATIO'] ** 2
-
-x_test['RM * LSTAT'] = x_test['RM'] * x_test['LSTAT']
-
 sc_x_test = sc_model_x2.transform(x_test)
 sc_y_test = sc_model_y2.transform(y_test)
 
@@ -380,6 +425,10 @@ with open(path + '/model/boston_scx.pkl', mode='wb') as fp:
     pickle.dump(sc_model_x2, fp)
 with open(path + '/model/boston_scy.pkl', mode='wb') as fp:
     pickle.dump(sc_model_y2, fp)
+BOSTON_FEATURES.save(path + '/model/boston_features.json')
+outliers.save(path + '/model/boston_outliers.json')
+export_onnx('boston')
+print(cache.report())
 
 # %%
 doctest.testmod(verbose=True)
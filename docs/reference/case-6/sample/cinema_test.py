@@ -10,9 +10,11 @@ from sklearn.model_selection import train_test_split
 import unittest
 import doctest
 import os
-from domain import CategoricalData, DataVisualization, convert_categoricals
+from domain import CategoricalData, DataVisualization, OutlierFilter, convert_categoricals, export_onnx
 from app.repository import CSVRepository, SQLRepository
 
+# 環境変数VISUALIZATION=0でグラフの描画を省略する
+VISUALIZTION = os.environ.get('VISUALIZATION', '1') != '0'
 path = os.path.dirname(os.path.abspath(__file__))
 # repo = SQLRepository(table='Cinema')
 repo = CSVRepository(file=path + '/data/cinema.csv')
@@ -78,7 +80,8 @@ original = CategoricalData(df, 'original')
 original.show()
 
 # %%
-original.plot()
+if VISUALIZTION:
+    original.plot()
 
 # %% [markdown]
 # ### 種類カテゴリの数値変換
@@ -87,7 +90,8 @@ original.plot()
 categorical_cols = ['original']
 df_conv = convert_categoricals(df, categorical_cols)
 conv_species = CategoricalData(df_conv, 'sales')
-conv_species.plot()
+if VISUALIZTION:
+    conv_species.plot()
 
 # %% [markdown]
 # ### ピボットテーブルによる集計
@@ -118,8 +122,9 @@ df.select_dtypes(include='object').columns
 # ### データの可視化
 
 # %%
-dv = DataVisualization(df)
-dv.df_all('sales')
+if VISUALIZTION:
+    dv = DataVisualization(df)
+    dv.df_all('sales')
 
 # %% [markdown]
 # ## データの前処理
@@ -137,11 +142,12 @@ df2 = df.fillna(df.mean())
 df2.isnull().any(axis=0)
 
 # %%
-for name in df2.columns:
-    if name == 'cinema_id' or name == 'sales':
-        continue
+if VISUALIZTION:
+    for name in df2.columns:
+        if name == 'cinema_id' or name == 'sales':
+            continue
 
-    df2.plot.scatter(x=name, y='sales')
+        df2.plot.scatter(x=name, y='sales')
 
 # %% [markdown]
 # ### 各手法を必要に応じて実施
@@ -212,8 +218,10 @@ repo = CSVRepository(file=path + '/data/cinema.csv')
 
 df = repo.get_data()
 df2 = df.fillna(df.mean())
-no = df2[(df2['SNS2'] > 1000) & (df2['sales'] < 8500)].index
-df3 = df2.drop(no, axis=0)
+outliers = OutlierFilter([
+    {'name': 'SNS2が多く売上が少ない', 'method': 'expr', 'expr': 'SNS2 > 1000 and sales < 8500'}])
+df3 = outliers.fit_transform(df2)
+print(outliers.report())
 
 # モデルの作成と学習
 x = df3[['SNS1', 'SNS2', 'actor', 'original']]
@@ -241,6 +249,8 @@ print(f'平均絶対誤差: {mae}')
 # モデルの保存
 with open(path + '/model/cinema.pkl', 'wb') as f:
     pickle.dump(model, f)
+outliers.save(path + '/model/cinema_outliers.json')
+export_onnx('cinema')
 
 # %% [markdown]
 # ## 回帰式による影響度の分析
@@ -0,0 +1,107 @@
+import asyncio
+import tracemalloc
+import unittest
+
+from app.diagnostics import MemoryDiagnostics, object_counts
+from domain import Iris
+
+
+class TestMemoryDiagnostics(unittest.TestCase):
+
+    def test_track(self):
+        diagnostics = MemoryDiagnostics(sample_rate=1.0)
+        kept = []
+
+        @diagnostics.track('iris')
+        async def handler():
+            with diagnostics.stage('load'):
+                iris = Iris()
+            with diagnostics.stage('predict'):
+                kept.append(bytearray(100000))
+                return iris.predict([[1.4, 2.3, 4.4, 2.3]])[0]
+
+        self.assertEqual(asyncio.run(handler()), 'Iris-virginica')
+        self.assertFalse(tracemalloc.is_tracing())
+        report = {row['stage']: row for row in diagnostics.report()}
+        self.assertEqual(set(report), {'load', 'predict', 'request'})
+        self.assertGreaterEqual(report['predict']['max_net_bytes'], 100000)
+        self.assertGreaterEqual(report['request']['max_peak_bytes'], report['predict']['max_peak_bytes'])
+
+    def test_sampling(self):
+        diagnostics = MemoryDiagnostics(sample_rate=0.0)
+
+        @diagnostics.track('iris')
+        async def handler():
+            with diagnostics.stage('load'):
+                return tracemalloc.is_tracing()
+
+        self.assertFalse(asyncio.run(handler()))
+        self.assertEqual(diagnostics.report(), [])
+
+    def test_concurrent_requests(self):
+        # 計測中のリクエストがawaitしている間に他のリクエストが実行されても状態が混ざらない
+        diagnostics = MemoryDiagnostics(sample_rate=1.0)
+        kept = []
+        suspended = asyncio.Event()
+
+        @diagnostics.track('slow')
+        async def slow():
+            suspended.set()
+            await asyncio.sleep(0.01)
+            with diagnostics.stage('predict'):
+                kept.append(bytearray(1000))
+
+        @diagnostics.track('fast')
+        async def fast():
+            await suspended.wait()
+            with diagnostics.stage('predict'):
+                kept.append(bytearray(1000000))
+
+        async def main():
+            await asyncio.gather(slow(), fast())
+
+        asyncio.run(main())
+        self.assertFalse(tracemalloc.is_tracing())
+        report = {(row['endpoint'], row['stage']): row for row in diagnostics.report()}
+        # fastは計測中のslowと重なったため計測せず、slowのrequest全体の値は記録しない
+        self.assertEqual(set(report), {('slow', 'predict')})
+        self.assertLess(report[('slow', 'predict')]['max_net_bytes'], 1000000)
+        self.assertEqual(diagnostics.overlapped, 1)
+
+    def test_stop_tracing_during_request(self):
+        diagnostics = MemoryDiagnostics(sample_rate=1.0)
+
+        @diagnostics.track('iris')
+        async def handler():
+            with diagnostics.stage('predict'):
+                diagnostics.stop_tracing()
+
+        asyncio.run(handler())
+        self.assertEqual(diagnostics.report(), [])
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_snapshot_diff(self):
+        diagnostics = MemoryDiagnostics(max_snapshots=2)
+        try:
+            first = diagnostics.snapshot()
+            kept = [bytearray(1000) for _ in range(100)]
+            second = diagnostics.snapshot()
+            diff = diagnostics.diff(first, second, limit=5)
+            self.assertGreaterEqual(sum(d['size_diff'] for d in diff), 100000)
+            diagnostics.snapshot()
+            self.assertEqual(sorted(diagnostics.snapshots), [second, second + 1])
+            self.assertEqual(len(kept), 100)
+        finally:
+            diagnostics.stop_tracing()
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_object_counts(self):
+        iris = Iris()
+        counts = object_counts(['Iris', 'DecisionTreeClassifier'])
+        self.assertGreaterEqual(counts['Iris'], 1)
+        self.assertGreaterEqual(counts['DecisionTreeClassifier'], 1)
+        self.assertIsNotNone(iris)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,33 +1,59 @@
+import functools
+import hashlib
+import inspect
+import json
 import pickle
+import shutil
+import tempfile
+import time
+import warnings
+from concurrent.futures import Future, ProcessPoolExecutor
+import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import seaborn as sns
+import sklearn
+from scipy.special import ndtr, ndtri
 from sklearn import tree
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.compose import TransformedTargetRegressor
+from sklearn.ensemble import HistGradientBoostingRegressor
 from sklearn.linear_model import LinearRegression
+from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
+from sklearn.utils.class_weight import compute_sample_weight
+from sklearn.model_selection import (ParameterGrid, RepeatedKFold, RepeatedStratifiedKFold,
+                                     cross_validate, train_test_split)
 import os
 path = os.path.dirname(os.path.abspath(__file__))
 
 
 class CategoricalData:
-    def __init__(self, df, col) -> None:
+    def __init__(self, df, col, max_categories=50) -> None:
         self.df = df
         self.col = col
+        self.max_categories = max_categories
+        self.sampling = None
 
     def show(self):
         """カテゴリーデータの値の数を確認"""
         return self.df[self.col].value_counts()
 
     def plot(self):
-        """カテゴリーデータの値の数を棒グラフで確認"""
-        return self.df[self.col].value_counts().plot(kind='bar')
+        """カテゴリーデータの値の数を棒グラフで確認（値の種類が多い場合は上位のみ表示）"""
+        counts = self.df[self.col].value_counts()
+        if len(counts) > self.max_categories:
+            others = counts.iloc[self.max_categories:].sum()
+            counts = counts.iloc[:self.max_categories]
+            counts['その他'] = others
+            self.sampling = {'plot': 'bar', 'method': 'top', 'categories': len(counts) - 1,
+                             'others': int(others)}
+        return counts.plot(kind='bar')
 
     def convert(self):
         """カテゴリーデータを数値に変換"""
-        from sklearn.preprocessing import LabelEncoder
-
-        encoder = LabelEncoder()
-        return encoder.fit_transform(self.df[self.col])
+        encoder = CategoricalEncoder([self.col])
+        return encoder.fit(self.df).encode(self.df[self.col], self.col)
 
     def pivot(self, index, value):
         """ピボットテーブルによる集計"""
@@ -39,8 +65,47 @@ class CategoricalData:
 
 
 class DataVisualization:
-    def __init__(self, df) -> None:
+    """データフレームの可視化
+
+    散布図・ペアプロットは行数がmax_rowsを超えるとhue列で層化（hueがない場合や
+    値の種類が多い場合は無作為）した標本を描き、dense_rowsを超えると全行を
+    ビンに集計した図（hexbin、2次元ヒストグラム）に切り替える。
+    適用した方法はsamplingに記録する。
+    """
+
+    def __init__(self, df, max_rows=10000, dense_rows=1000000, random_state=0) -> None:
         self.df = df
+        self.max_rows = max_rows
+        self.dense_rows = dense_rows
+        self.random_state = random_state
+        self.sampling = []
+
+    def _sample(self, plot, hue=None, max_strata=50):
+        """描画する行をmax_rows以下に減らす"""
+        rows = len(self.df)
+        if rows <= self.max_rows:
+            return self.df
+        if hue is not None and self.df[hue].nunique(dropna=False) <= max_strata:
+            frac = self.max_rows / rows
+            groups = self.df.groupby(hue, dropna=False, sort=False)
+            sample = pd.concat([
+                g.sample(n=min(len(g), max(1, round(len(g) * frac))),
+                         random_state=self.random_state)
+                for _, g in groups]).sort_index()
+            method = 'stratified'
+        else:
+            sample = self.df.sample(n=self.max_rows, random_state=self.random_state).sort_index()
+            method = 'random'
+        self.sampling.append({'plot': plot, 'method': method, 'rows': rows,
+                              'sampled': len(sample), 'hue': hue})
+        return sample
+
+    def _is_dense(self, plot):
+        if len(self.df) <= self.dense_rows:
+            return False
+        self.sampling.append({'plot': plot, 'method': 'binned', 'rows': len(self.df),
+                              'sampled': len(self.df), 'hue': None})
+        return True
 
     def df_hist(self):
         """データフレームのヒストグラム表示"""
@@ -48,7 +113,23 @@ class DataVisualization:
 
     def df_scatter(self):
         """データフレームの散布図表示"""
-        return pd.plotting.scatter_matrix(self.df, figsize=(12, 12))
+        if self._is_dense('scatter'):
+            return self._hexbin_matrix()
+        return pd.plotting.scatter_matrix(self._sample('scatter'), figsize=(12, 12))
+
+    def _hexbin_matrix(self, gridsize=40):
+        numeric = self.df.select_dtypes(include='number')
+        k = len(numeric.columns)
+        figure, axes = plt.subplots(k, k, figsize=(12, 12), squeeze=False)
+        for i, row in enumerate(numeric.columns):
+            for j, col in enumerate(numeric.columns):
+                if i == j:
+                    axes[i, j].hist(numeric[col].dropna(), bins=gridsize)
+                else:
+                    axes[i, j].hexbin(numeric[col], numeric[row], gridsize=gridsize, mincnt=1)
+                axes[i, j].set_xlabel(col if i == k - 1 else '')
+                axes[i, j].set_ylabel(row if j == 0 else '')
+        return axes
 
     def df_box(self):
         """データフレームの箱ひげ図表示"""
@@ -56,7 +137,9 @@ class DataVisualization:
 
     def df_pairplot(self, hue=None):
         """データフレームのペアプロット表示"""
-        return sns.pairplot(self.df, hue=hue)
+        if self._is_dense('pairplot'):
+            return sns.pairplot(self.df, kind='hist')
+        return sns.pairplot(self._sample('pairplot', hue), hue=hue)
 
     def df_all(self, hue):
         """データフレームの全ての表示"""
@@ -65,19 +148,867 @@ class DataVisualization:
         self.df_box()
         self.df_pairplot(hue)
 
+    def render_all(self, hue, directory, formats=('png',), workers=None):
+        """全てのグラフを別プロセスで描画してファイルに保存
+
+        描画の完了を待たずに{グラフの種類: 保存したファイルのリストを返すFuture}を返す。
+        データと設定が同じでファイルが既にあるグラフは描画しない。
+        """
+        os.makedirs(directory, exist_ok=True)
+        digest = hashlib.sha256()
+        _digest_update(digest, self.df)
+        handles = {}
+        tasks = {}
+        for kind in ('hist', 'scatter', 'box', 'pairplot'):
+            settings = f'{kind}:{hue}:{self.max_rows}:{self.dense_rows}:{self.random_state}'
+            key = hashlib.sha256(f'{digest.hexdigest()}:{settings}'.encode()).hexdigest()
+            files = [f'{directory}/{kind}-{key[:16]}.{fmt}' for fmt in formats]
+            if all(os.path.exists(file) for file in files):
+                handles[kind] = Future()
+                handles[kind].set_result(files)
+            else:
+                tasks[kind] = files
+
+        if tasks:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            for kind, files in tasks.items():
+                handles[kind] = executor.submit(_render_plot, self, kind, hue, files)
+            executor.shutdown(wait=False)
+        return handles
+
+
+def _render_plot(dv, kind, hue, files):
+    plt.switch_backend('Agg')
+    if kind == 'pairplot':
+        figure = dv.df_pairplot(hue).figure
+    else:
+        getattr(dv, f'df_{kind}')()
+        figure = plt.gcf()
+    for file in files:
+        figure.savefig(file + '.tmp', format=os.path.splitext(file)[1][1:])
+        os.replace(file + '.tmp', file)
+    plt.close('all')
+    return files
+
+
+class GroupImputer:
+    """グループ代表値による欠損値埋め
+
+    キーの組み合わせごとの代表値（median, mean, mode）を一度のgroupbyで求め、
+    欠損値をまとめて埋める。チャンク単位のデータにもそのまま適用できる。
+    truncate=Trueなら代表値の小数点以下を切り捨てる（整数で埋める場合）。
+    keysが空なら全体の代表値で埋める。
+    """
+
+    def __init__(self, keys, cols, stat='median', truncate=False) -> None:
+        if stat not in ('median', 'mean', 'mode'):
+            raise ValueError(f'unknown stat: {stat}')
+        if truncate and stat == 'mode':
+            raise ValueError('truncate requires median or mean')
+        self.keys = list(keys)
+        self.cols = list(cols)
+        self.stat = stat
+        self.truncate = truncate
+
+    def fit(self, df):
+        """グループ別と全体の代表値を求める"""
+        if not self.keys:
+            self.values = None
+            self.default = {c: df[c].mode().iloc[0] for c in self.cols} if self.stat == 'mode' \
+                else df[self.cols].agg(self.stat)
+            if self.truncate:
+                self.default = np.trunc(self.default)
+            self.default = dict(self.default)
+        elif self.stat == 'mode':
+            self.values = pd.DataFrame({c: self._mode(df, c) for c in self.cols})
+            self.default = {c: df[c].mode().iloc[0] for c in self.cols}
+        else:
+            self.values = df.groupby(self.keys)[self.cols].agg(self.stat)
+            self.default = df[self.cols].agg(self.stat)
+            if self.truncate:
+                self.values = np.trunc(self.values)
+                self.default = np.trunc(self.default)
+            self.default = self.default.to_dict()
+        return self
+
+    def _mode(self, df, col):
+        counts = df.groupby(self.keys + [col]).size()
+        counts = counts.sort_values(ascending=False, kind='stable')
+        top = counts[~counts.index.droplevel(col).duplicated()]
+        return pd.Series(top.index.get_level_values(col), index=top.index.droplevel(col))
+
+    def transform(self, df):
+        """欠損値を代表値で埋めたデータフレームを返す（未知のグループは全体の代表値）"""
+        if not self.keys:
+            return df.assign(**{c: df[c].fillna(self.default[c]) for c in self.cols})
+        if len(self.keys) == 1:
+            index = pd.Index(df[self.keys[0]])
+        else:
+            index = pd.MultiIndex.from_frame(df[self.keys])
+        values = self.values.reindex(index)
+        values.index = df.index
+        return df.assign(**{
+            c: df[c].fillna(values[c]).fillna(self.default[c]) for c in self.cols})
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+    def save(self, file):
+        _dump(self, file)
+
+    @staticmethod
+    def load(file):
+        with open(file=file, mode='rb') as f:
+            return pickle.load(f)
+
+
+class CategoricalEncoder:
+    """カテゴリーデータを整数コードに変換する
+
+    語彙は値の昇順（欠損値は末尾）でLabelEncoderと同じコードになる。
+    fitしたものと別のデータを変換すると、語彙にない値はunknownに変換する。
+    """
+
+    def __init__(self, cols, unknown=-1) -> None:
+        self.cols = list(cols)
+        self.unknown = unknown
+
+    def fit(self, df):
+        """列ごとの語彙を求める（全体の並べ替えではなく一意な値だけを並べ替える）"""
+        self.vocabularies = {}
+        for c in self.cols:
+            uniques = pd.unique(df[c])
+            isnull = pd.isnull(uniques)
+            vocabulary = sorted(uniques[~isnull])
+            if isnull.any():
+                vocabulary.append(np.nan)
+            self.vocabularies[c] = pd.Index(vocabulary)
+        return self
+
+    def encode(self, values, col):
+        """1列を整数コードに変換"""
+        vocabulary = self.vocabularies[col]
+        codes = vocabulary.get_indexer(values)
+        if vocabulary.hasnans:
+            codes[np.asarray(pd.isnull(values))] = len(vocabulary) - 1
+        if self.unknown != -1:
+            codes[codes == -1] = self.unknown
+        return codes
+
+    def transform(self, df):
+        """変換した列だけを差し替えたデータフレームを返す（他の列はコピーしない）"""
+        df_conv = df.copy(deep=False)
+        for c in self.cols:
+            df_conv[c] = self.encode(df[c], c)
+        return df_conv
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+
+class OutlierFilter:
+    """外れ値の行を除外する
+
+    ルールは{name, method, ...}の宣言で定義し、JSONでモデルと一緒に保存する。
+    methodはiqr（四分位範囲のk倍の外側）、mad（中央値から中央絶対偏差のk倍より外側）、
+    expr（DataFrame.evalの条件式）。iqrとmadの境界はfitで学習データから求める。
+    半数以上が同じ値で中央絶対偏差が0の列は四分位範囲を尺度にし、それも0ならルールを適用しない。
+    除外はルールごとのマスクの論理和で、ルールごとの除外件数を集計する。
+    """
+
+    methods = ('iqr', 'mad', 'expr')
+
+    def __init__(self, rules) -> None:
+        self.rules = [dict(r) for r in rules]
+        for r in self.rules:
+            if r['method'] not in self.methods:
+                raise ValueError(f"unknown method: {r['method']}")
+            r.setdefault('name', r['expr'] if r['method'] == 'expr' else f"{r['method']}({r['col']})")
+        self.reset()
+
+    def reset(self):
+        self.rows = 0
+        self.dropped = {r['name']: 0 for r in self.rules}
+        self.dropped_total = 0
+
+    def fit(self, df):
+        """iqrとmadのルールの境界を求める（分位点と中央値は列をまとめて計算）"""
+        iqr = [r['col'] for r in self.rules if r['method'] == 'iqr']
+        mad = [r['col'] for r in self.rules if r['method'] == 'mad']
+        quantiles = df[list(dict.fromkeys(iqr + mad))].quantile([0.25, 0.75]) if iqr or mad else None
+        if mad:
+            median = df[mad].median()
+            deviation = (df[mad] - median).abs().median()
+        for r in self.rules:
+            k = r.get('k', 1.5 if r['method'] == 'iqr' else 3.5)
+            if r['method'] == 'iqr':
+                q1, q3 = quantiles[r['col']]
+                r['lower'], r['upper'] = float(q1 - k * (q3 - q1)), float(q3 + k * (q3 - q1))
+            elif r['method'] == 'mad':
+                # 正規分布の標準偏差に合わせるため1.4826（四分位範囲なら1/1.349）を掛ける
+                q1, q3 = quantiles[r['col']]
+                scale = 1.4826 * deviation[r['col']] or (q3 - q1) / 1.349
+                if scale > 0:
+                    r['lower'] = float(median[r['col']] - k * scale)
+                    r['upper'] = float(median[r['col']] + k * scale)
+                else:
+                    # 尺度が0だと中央値以外がすべて外れ値になる
+                    r['lower'] = r['upper'] = None
+        return self
+
+    def masks(self, df):
+        """ルールごとの外れ値のマスク（欠損値は外れ値としない）"""
+        result = {}
+        for r in self.rules:
+            if r['method'] == 'expr':
+                mask = df.eval(r['expr']).to_numpy(dtype=bool)
+            elif r['lower'] is None:
+                mask = np.zeros(len(df), dtype=bool)
+            else:
+                values = df[r['col']].to_numpy(dtype=float)
+                mask = (values < r['lower']) | (values > r['upper'])
+            result[r['name']] = mask
+        return result
+
+    def transform(self, df):
+        """外れ値の行を除いたデータフレームを返す（チャンクごとに呼ぶと件数を累積する）"""
+        masks = self.masks(df)
+        drop = np.zeros(len(df), dtype=bool)
+        for name, mask in masks.items():
+            self.dropped[name] += int(mask.sum())
+            drop |= mask
+        self.rows += len(df)
+        self.dropped_total += int(drop.sum())
+        return df[~drop]
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+    def transform_chunks(self, chunks):
+        """チャンクの列（read_csvのchunksizeなど）を順に除外して返す"""
+        for chunk in chunks:
+            yield self.transform(chunk)
+
+    def report(self):
+        """ルールごとの除外件数（1行が複数のルールに該当した場合はそれぞれで数える）"""
+        return {'rows': self.rows, 'dropped': dict(self.dropped), 'dropped_total': self.dropped_total}
+
+    def save(self, file):
+        with open(file=file, mode='w') as f:
+            json.dump({'rules': self.rules}, f, ensure_ascii=False, indent=2)
+
+    @staticmethod
+    def load(file):
+        with open(file=file, mode='r') as f:
+            return OutlierFilter(json.load(f)['rules'])
+
 
 def convert_categoricals(df, cols):
-    df_conv = df.copy()
-    for c in cols:
-        df_conv[c] = CategoricalData(df_conv, c).convert()
-    return df_conv
+    return CategoricalEncoder(cols).fit_transform(df)
+
+
+class DatasetProfile:
+    """データの概要（info, describe, value_counts, corr相当）を一度の走査で集計する
+
+    チャンクごとにpartial_fitで集計し、別に集計した結果はmergeで結合できる。
+    分位点は無作為標本、上位の値はMisra-Gries要約、値の種類数はHyperLogLogによる近似。
+    """
+
+    def __init__(self, sample_size=10000, top_k=20, precision=12, random_state=0) -> None:
+        self.sample_size = sample_size
+        self.capacity = top_k * 10
+        self.top_k = top_k
+        self.precision = precision
+        self.rng = np.random.default_rng(random_state)
+        self.columns = None
+
+    def partial_fit(self, df):
+        """チャンクの統計量を集計に加える"""
+        if self.columns is None:
+            self._init(df)
+        self.rows += len(df)
+        numeric = np.column_stack([
+            pd.to_numeric(df[c], errors='coerce').to_numpy(dtype=float)
+            for c in self.numeric]) if self.numeric else np.empty((len(df), 0))
+        present = ~np.isnan(numeric)
+        mask = present.astype(float)
+        # 列ごとの件数・平均・偏差平方和・最小・最大
+        for i, c in enumerate(self.numeric):
+            values = numeric[present[:, i], i]
+            self._moments(c, len(values), values.mean() if len(values) else 0.0,
+                          ((values - values.mean()) ** 2).sum() if len(values) else 0.0,
+                          values.min(initial=np.inf), values.max(initial=-np.inf))
+        # 相関係数用に列の組ごとの件数・平均・偏差平方和・共変動を集計（両方が欠損でない行のみ）
+        # 桁落ちを防ぐため、チャンク内の平均を引いてから和を取る
+        shift = np.array([numeric[present[:, i], i].mean() if present[:, i].any() else 0.0
+                          for i in range(len(self.numeric))])
+        centered = np.where(present, numeric - shift, 0.0)
+        n = mask.T @ mask
+        total = centered.T @ mask
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, total / n, 0.0)
+        self._pairs(n, mean + shift[:, None], (centered ** 2).T @ mask - total * mean,
+                    centered.T @ centered - total * mean.T)
+        # 分位点用の標本（一様乱数のキーが小さい順にsample_size件を残す）
+        keys = self.rng.random(len(df))
+        self._keep_sample(np.concatenate([self.sample_keys, keys]),
+                          np.concatenate([self.sample, numeric]))
+
+        for c in self.columns:
+            self.nulls[c] += int(df[c].isnull().sum())
+            self._count(c, df[c].value_counts(dropna=True))
+            self._register(c, df[c].dropna())
+        return self
+
+    def _init(self, df):
+        self.columns = list(df.columns)
+        self.dtypes = {c: str(df[c].dtype) for c in self.columns}
+        self.numeric = list(df.select_dtypes(include='number').columns)
+        k = len(self.numeric)
+        self.rows = 0
+        self.nulls = {c: 0 for c in self.columns}
+        self.moments = {c: (0, 0.0, 0.0, np.inf, -np.inf) for c in self.numeric}
+        # [i, j]は列iとjが両方欠損でない行での列iの平均・偏差平方和と、列iとjの共変動
+        self.pair_n = np.zeros((k, k))
+        self.pair_mean = np.zeros((k, k))
+        self.pair_m2 = np.zeros((k, k))
+        self.pair_comoment = np.zeros((k, k))
+        self.sample_keys = np.empty(0)
+        self.sample = np.empty((0, k))
+        self.counts = {c: pd.Series(dtype=float) for c in self.columns}
+        self.registers = {c: np.zeros(2 ** self.precision, dtype=np.uint8) for c in self.columns}
+
+    def _moments(self, c, n, mean, m2, low, high):
+        n_a, mean_a, m2_a, low_a, high_a = self.moments[c]
+        total = n_a + n
+        if total == 0:
+            return
+        delta = mean - mean_a
+        self.moments[c] = (total, mean_a + delta * n / total,
+                           m2_a + m2 + delta ** 2 * n_a * n / total,
+                           min(low_a, low), max(high_a, high))
+
+    def _pairs(self, n, mean, m2, comoment):
+        # StreamingRegressionと同じく平均の差で偏差平方和と共変動を補正して結合
+        total = self.pair_n + n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(total > 0, n / total, 0.0)
+            cross = np.where(total > 0, self.pair_n * n / total, 0.0)
+        delta = mean - self.pair_mean
+        self.pair_mean = self.pair_mean + delta * weight
+        self.pair_m2 = self.pair_m2 + m2 + delta ** 2 * cross
+        self.pair_comoment = self.pair_comoment + comoment + delta * delta.T * cross
+        self.pair_n = total
+
+    def _keep_sample(self, keys, sample):
+        if len(keys) > self.sample_size:
+            keep = np.argpartition(keys, self.sample_size)[:self.sample_size]
+            keys, sample = keys[keep], sample[keep]
+        self.sample_keys, self.sample = keys, sample
+
+    def _count(self, c, counts):
+        merged = self.counts[c].add(counts, fill_value=0)
+        if len(merged) > self.capacity:
+            # 容量を超えた分だけ全体を減らし、0以下になった値を捨てる
+            threshold = merged.nlargest(self.capacity + 1).iloc[-1]
+            merged = merged[merged > threshold] - threshold
+        self.counts[c] = merged
+
+    def _register(self, c, values):
+        p = self.precision
+        hashes = pd.util.hash_array(values.to_numpy())
+        index = (hashes >> np.uint64(64 - p)).astype(np.int64)
+        rest = (hashes << np.uint64(p)) | np.uint64(1 << (p - 1))
+        rank = (64 - np.floor(np.log2(rest.astype(float)))).astype(np.uint8)
+        np.maximum.at(self.registers[c], index, rank)
+
+    def merge(self, other):
+        """別に集計した結果を結合する"""
+        if other.columns is None:
+            return self
+        if self.columns is None:
+            self._init(pd.DataFrame({c: pd.Series(dtype=other.dtypes[c]) for c in other.columns}))
+        self.rows += other.rows
+        for c in self.numeric:
+            self._moments(c, *other.moments[c])
+        self._pairs(other.pair_n, other.pair_mean, other.pair_m2, other.pair_comoment)
+        self._keep_sample(np.concatenate([self.sample_keys, other.sample_keys]),
+                          np.concatenate([self.sample, other.sample]))
+        for c in self.columns:
+            self.nulls[c] += other.nulls[c]
+            self._count(c, other.counts[c])
+            np.maximum(self.registers[c], other.registers[c], out=self.registers[c])
+        return self
+
+    def cardinality(self, c):
+        """値の種類数の推定値"""
+        registers = self.registers[c]
+        m = len(registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m ** 2 / np.sum(2.0 ** -registers.astype(float))
+        zeros = np.count_nonzero(registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+    def info(self):
+        """df.info()相当の列ごとの型・欠損数・値の種類数"""
+        return pd.DataFrame({
+            'dtype': [self.dtypes[c] for c in self.columns],
+            'non_null': [self.rows - self.nulls[c] for c in self.columns],
+            'null': [self.nulls[c] for c in self.columns],
+            'cardinality': [self.cardinality(c) for c in self.columns],
+        }, index=self.columns)
+
+    def describe(self):
+        """df.describe()相当の統計量（分位点は標本からの近似）"""
+        rows = {}
+        for i, c in enumerate(self.numeric):
+            n, mean, m2, low, high = self.moments[c]
+            values = self.sample[:, i]
+            q = np.nanquantile(values, [0.25, 0.5, 0.75]) if n else [np.nan] * 3
+            rows[c] = [n, mean if n else np.nan, np.sqrt(m2 / (n - 1)) if n > 1 else np.nan,
+                       low if n else np.nan, *q, high if n else np.nan]
+        return pd.DataFrame(rows, index=['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max'])
+
+    def value_counts(self, c):
+        """上位top_k件の値の出現数（capacityより種類が多い場合は下限値）"""
+        return self.counts[c].sort_values(ascending=False, kind='stable')[:self.top_k].astype(int)
+
+    def corr(self):
+        """数値列の相関係数行列（列の組ごとに両方が欠損でない行で計算）"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = self.pair_comoment / np.sqrt(self.pair_m2 * self.pair_m2.T)
+            corr[self.pair_n < 2] = np.nan
+        return pd.DataFrame(corr, index=self.numeric, columns=self.numeric)
+
+
+def _profile_chunk(task):
+    chunk, settings = task
+    return DatasetProfile(**settings).partial_fit(chunk)
+
+
+def profile_csv(file, chunksize=100000, workers=1, **settings):
+    """CSVファイルをチャンク単位で集計する（workersが2以上ならチャンクを並列に集計して結合）
+
+    並列のときも読み込んで処理中のチャンクは並列数の2倍までに抑え、メモリに収まらないファイルも扱える。
+    """
+    chunks = pd.read_csv(file, chunksize=chunksize)
+    profile = DatasetProfile(**settings)
+    if workers == 1:
+        for chunk in chunks:
+            profile.partial_fit(chunk)
+        return profile
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for i, chunk in enumerate(chunks):
+            futures.append(executor.submit(_profile_chunk, (chunk, dict(settings, random_state=i))))
+            if len(futures) >= 2 * (workers or os.cpu_count()):
+                profile.merge(futures.pop(0).result())
+        for future in futures:
+            profile.merge(future.result())
+    return profile
+
+
+def _decimals(values, max_decimals=6):
+    # 値が丸められている小数点以下の桁数（丸められていなければNone）
+    for d in range(max_decimals + 1):
+        if np.allclose(values, np.round(values, d), rtol=0, atol=1e-9):
+            return d
+    return None
+
+
+def _interval_scores(cumulative):
+    # 累積確率で区切った区間ごとの標準正規分布の条件付き平均
+    bounds = ndtri(np.concatenate([[0.0], np.asarray(cumulative, dtype=float)]))
+    bounds[-1] = np.inf
+    density = np.exp(-bounds ** 2 / 2) / np.sqrt(2 * np.pi)
+    return (density[:-1] - density[1:]) / np.maximum(np.diff(ndtr(bounds)), 1e-300)
+
+
+class SyntheticData:
+    """データセットの分布を学習し、同じ列と型の合成データを任意の行数で生成する
+
+    列ごとの周辺分布（数値は分位点、カテゴリや値の種類が少ない列は出現頻度）と欠損率を求め、
+    列の間の相関はガウスコピュラ（正規スコアの相関行列）で再現する。欠損の有無もコピュラの次元に含めるため、
+    欠損と他の列との関係（AgeやCabinの欠損と客室等級など）も保たれる。
+    連番の列（PassengerIdなど）は行番号から求める。
+    生成はチャンク単位で、乱数はseedとチャンクの先頭行から作るため、同じseedとchunksizeなら
+    並列数によらず同じデータになる。
+    """
+
+    def __init__(self, max_categories=20, max_values=10000, quantiles=1001) -> None:
+        self.max_categories = max_categories
+        self.max_values = max_values
+        self.quantiles = quantiles
+
+    def fit(self, df):
+        self.columns = []
+        scores = []
+        for c in df.columns:
+            s = df[c]
+            values = s.dropna()
+            column = {'name': c, 'dtype': str(s.dtype), 'missing': float(s.isnull().mean())}
+            diffs = np.diff(values.to_numpy()) if pd.api.types.is_integer_dtype(s) else None
+            if diffs is not None and len(values) > 2 and (diffs == diffs[0]).all() and diffs[0] != 0:
+                column.update(kind='id', first=int(values.iloc[0]), step=int(diffs[0]))
+                self.columns.append(column)
+                continue
+            score = np.full(len(s), np.nan)
+            if pd.api.types.is_numeric_dtype(s) and values.nunique() > self.max_categories:
+                column.update(kind='numeric',
+                              values=np.quantile(values, np.linspace(0, 1, min(self.quantiles, len(values)))),
+                              integer=bool(np.allclose(values, np.round(values))),
+                              decimals=_decimals(values.to_numpy(dtype=float)))
+                # 順位から正規スコアを求める
+                score[s.notnull().to_numpy()] = ndtri((values.rank().to_numpy() - 0.5) / len(values))
+            else:
+                counts = values.value_counts().iloc[:self.max_values]
+                try:
+                    # 値の順に並べ、数値の大小と相関する列（Pclassなど）の関係を保つ
+                    counts = counts.sort_index()
+                except TypeError:
+                    pass
+                cumulative = np.cumsum(counts.to_numpy()) / counts.sum()
+                column.update(kind='category', values=counts.index.to_numpy(), cumulative=cumulative)
+                codes = pd.Categorical(values, categories=counts.index).codes
+                known = codes >= 0
+                score[np.flatnonzero(s.notnull().to_numpy())[known]] = _interval_scores(cumulative)[codes[known]]
+            column['index'] = len(scores)
+            scores.append(score)
+            if 0 < column['missing'] < 1:
+                column['missing_index'] = len(scores)
+                scores.append(_interval_scores([column['missing'], 1.0])[s.notnull().to_numpy().astype(int)])
+            self.columns.append(column)
+
+        # 離散の列の正規スコアは分散が1より小さく相関が弱まるため、標準偏差で割って補正する
+        scores = pd.DataFrame(np.array(scores).T)
+        scale = scores.std(ddof=0).fillna(1.0).to_numpy()
+        corr = (scores.corr().fillna(0.0).to_numpy() / np.outer(scale, scale)).clip(-0.99, 0.99)
+        np.fill_diagonal(corr, 1.0)
+        # 相関行列を正定値に補正してコレスキー分解する
+        eigenvalues, eigenvectors = np.linalg.eigh(corr)
+        corr = eigenvectors @ np.diag(np.maximum(eigenvalues, 1e-6)) @ eigenvectors.T
+        scale = np.sqrt(np.diag(corr))
+        self.correlation = corr / np.outer(scale, scale)
+        self.cholesky = np.linalg.cholesky(self.correlation)
+        return self
+
+    def sample(self, n, seed=0, start=0):
+        """先頭行がstartのチャンクをn行生成"""
+        rng = np.random.default_rng([seed, start])
+        u = ndtr(rng.standard_normal((n, len(self.cholesky))) @ self.cholesky.T)
+        data = {}
+        for column in self.columns:
+            if column['kind'] == 'id':
+                values = column['first'] + column['step'] * np.arange(start, start + n)
+            elif column['kind'] == 'numeric':
+                ui = u[:, column['index']]
+                values = np.interp(ui, np.linspace(0, 1, len(column['values'])), column['values'])
+                if column['integer']:
+                    values = np.round(values)
+                elif column['decimals'] is not None:
+                    values = np.round(values, column['decimals'])
+            else:
+                codes = np.searchsorted(column['cumulative'], u[:, column['index']], side='right')
+                values = column['values'][np.minimum(codes, len(column['values']) - 1)]
+            if 'missing_index' in column:
+                missing = u[:, column['missing_index']] < column['missing']
+                values = values.astype(object if column['dtype'] == 'object' else float)
+                values[missing] = np.nan
+            data[column['name']] = pd.Series(values).astype(column['dtype'])
+        return pd.DataFrame(data)
+
+    def dtypes(self):
+        """列の型（SQLBulkLoader.infer_dtypesと同じ表記）"""
+        types = {}
+        for column in self.columns:
+            dtype = column['dtype']
+            types[column['name']] = ('Int64' if dtype.startswith('int') else
+                                     'float64' if dtype.startswith('float') else
+                                     'boolean' if dtype == 'bool' else 'object')
+        return types
 
+    def chunks(self, rows, seed=0, chunksize=100000, workers=1, format=None):
+        """rows行をチャンクごとのDataFrameとして順に返す（format='csv'ならヘッダなしのCSV文字列）
 
-def learn(x, t, depth=3):
+        workersが2以上ならチャンクを並列に生成し、処理中のチャンクは並列数の2倍までに抑える。
+        """
+        tasks = ((start, min(chunksize, rows - start), seed, format) for start in range(0, rows, chunksize))
+        if workers == 1:
+            _init_synthetic(self)
+            try:
+                yield from map(_synthetic_chunk, tasks)
+            finally:
+                _synthetic_data.clear()
+            return
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_synthetic,
+                                 initargs=(self,)) as executor:
+            futures = []
+            for task in tasks:
+                futures.append(executor.submit(_synthetic_chunk, task))
+                if len(futures) >= 2 * (workers or os.cpu_count()):
+                    yield futures.pop(0).result()
+            for future in futures:
+                yield future.result()
+
+    def write(self, file, rows, seed=0, chunksize=100000, workers=1, format='csv'):
+        """合成データをCSVまたはParquetのファイルに書き出し、件数と秒間行数を返す"""
+        if format not in ('csv', 'parquet'):
+            raise ValueError(f'unknown format: {format}')
+        start = time.perf_counter()
+        if format == 'csv':
+            with open(file + '.tmp', 'w', newline='') as f:
+                f.write(self.sample(0).to_csv(index=False))
+                for text in self.chunks(rows, seed, chunksize, workers, format='csv'):
+                    f.write(text)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            writer = None
+            try:
+                for chunk in self.chunks(rows, seed, chunksize, workers):
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(file + '.tmp', table.schema, compression='zstd')
+                    writer.write_table(table)
+            finally:
+                if writer is not None:
+                    writer.close()
+        os.replace(file + '.tmp', file)
+        seconds = time.perf_counter() - start
+        return {
+            'file': file,
+            'rows': rows,
+            'seconds': seconds,
+            'rows_per_sec': rows / seconds if seconds > 0 else float('inf'),
+        }
+
+    def save(self, file):
+        _dump(self, file)
+
+    @staticmethod
+    def load(file):
+        with open(file=file, mode='rb') as f:
+            return pickle.load(f)
+
+
+_synthetic_data = {}
+
+
+def _init_synthetic(synthetic):
+    _synthetic_data['synthetic'] = synthetic
+
+
+def _synthetic_chunk(task):
+    start, n, seed, format = task
+    chunk = _synthetic_data['synthetic'].sample(n, seed, start)
+    return chunk.to_csv(index=False, header=False) if format == 'csv' else chunk
+
+
+class DriftMonitor:
+    """入力の分布を学習データと比較する（特徴量ごとに固定の区間のヒストグラムを更新）
+
+    区間は学習データの分位点（値の種類が少ない列は値ごと）で決め、欠損は別の区間で数える。
+    更新は区間の検索と加算だけで、メモリは区間数で決まりリクエスト数によらない。
+    ずれの大きさはPSI（Population Stability Index）で表す。
+    """
+
+    def __init__(self, names, bins=10) -> None:
+        self.names = list(names)
+        self.bins = bins
+
+    def fit(self, x):
+        """学習データから区間と基準の度数を作成"""
+        x = np.asarray(x, dtype=float)
+        self.edges = FeatureBins(self.bins).fit(x).edges
+        self.baseline = [self._histogram(x[:, i], i) for i in range(len(self.names))]
+        self.reset()
+        return self
+
+    def _histogram(self, values, i):
+        # 最後の区間が欠損
+        codes = np.where(np.isnan(values), len(self.edges[i]) + 1,
+                         np.searchsorted(self.edges[i], values, side='left'))
+        return np.bincount(codes, minlength=len(self.edges[i]) + 2).astype(float)
+
+    def reset(self):
+        self.counts = [np.zeros_like(b) for b in self.baseline]
+
+    def update(self, x):
+        """入力（1行または複数行）を度数に加える"""
+        x = np.asarray(x, dtype=float)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        for i, counts in enumerate(self.counts):
+            counts += self._histogram(x[:, i], i)
+
+    def scores(self, epsilon=1e-4):
+        """特徴量ごとの件数・欠損率・PSI（0.1未満は安定、0.25以上は大きな変化が目安）"""
+        result = {}
+        for name, baseline, counts in zip(self.names, self.baseline, self.counts):
+            n = counts.sum()
+            expected = np.maximum(baseline / baseline.sum(), epsilon)
+            actual = np.maximum(counts / n, epsilon) if n else expected
+            result[name] = {
+                'count': int(n),
+                'missing_rate': float(counts[-1] / n) if n else None,
+                'baseline_missing_rate': float(baseline[-1] / baseline.sum()),
+                'psi': float(np.sum((actual - expected) * np.log(actual / expected))) if n else None,
+            }
+        return result
+
+
+def drift_monitors(bins=10):
+    """data/*.csvを基準にした各モデルの入力（APIで受け取る特徴量の順）のDriftMonitor
+
+    APIの入力は欠損しないため、基準は学習時と同じく欠損を埋めたデータにする
+    （欠損を含めると欠損の区間だけで常に大きなずれになる）。
+    """
+    iris = pd.read_csv(path + '/data/iris.csv', encoding='utf-8-sig')
+    iris = iris.fillna(iris.mean(numeric_only=True))
+    cinema = pd.read_csv(path + '/data/cinema.csv')
+    cinema = cinema.fillna(cinema.mean())
+    survived = pd.read_csv(path + '/data/Survived.csv')
+    survived = GroupImputer(keys=['Pclass', 'Survived'], cols=['Age'], stat='mean',
+                            truncate=True).fit_transform(survived)
+    boston = pd.read_csv(path + '/data/Boston.csv')
+    boston = boston.fillna(boston.mean(numeric_only=True))
+    inputs = {
+        'iris': iris[['sepal_length', 'sepal_width', 'petal_length', 'petal_width']],
+        'cinema': cinema_features(cinema)[0],
+        'survived': SURVIVED_FEATURES.frame(survived),
+        'boston': boston[['RM', 'LSTAT', 'PTRATIO']],
+    }
+    return {name: DriftMonitor(x.columns, bins).fit(x) for name, x in inputs.items()}
+
+
+def _cross_validate(model, x, t, splitter, n_jobs, ndigits=None):
+    """分割ごとの学習を並列に実行し、スコアの平均とばらつき、分割ごとのテストスコアを返す"""
+    # データフレームは配列にしてから渡す（標準化などの前処理はmodelのパイプライン内で分割ごとに行う）
+    x = x.to_numpy() if hasattr(x, 'to_numpy') else x
+    t = t.to_numpy() if hasattr(t, 'to_numpy') else t
+    start = time.perf_counter()
+    result = cross_validate(model, x, t, cv=splitter, n_jobs=n_jobs,
+                            return_train_score=True)
+    elapsed = time.perf_counter() - start
+
+    def summary(value):
+        return value if ndigits is None else round(value, ndigits)
+
+    return {
+        'train_score': summary(result['train_score'].mean()),
+        'train_score_std': summary(result['train_score'].std()),
+        'test_score': summary(result['test_score'].mean()),
+        'test_score_std': summary(result['test_score'].std()),
+        'test_scores': result['test_score'].tolist(),
+        'n_splits': len(result['test_score']),
+        'time': elapsed,
+    }
+
+
+class FeatureBins:
+    """特徴量を分位点で最大max_bins個の区間に分割し、区間番号に変換する（欠損はNaNのまま）"""
+
+    def __init__(self, max_bins=255) -> None:
+        self.max_bins = max_bins
+        self.edges = None
+
+    def fit(self, x):
+        x = np.asarray(x, dtype=float)
+        self.edges = []
+        for column in x.T:
+            values = np.unique(column[~np.isnan(column)])
+            if len(values) > self.max_bins:
+                # 値の種類が多い列は分位点を区切りにする
+                quantiles = np.linspace(0, 100, self.max_bins + 1)[1:-1]
+                values = np.unique(np.percentile(column[~np.isnan(column)], quantiles))
+                self.edges.append(values)
+            else:
+                self.edges.append((values[:-1] + values[1:]) / 2)
+        return self
+
+    def transform(self, x):
+        x = np.asarray(x, dtype=float)
+        codes = np.empty(x.shape, dtype=np.float32)
+        for i, edges in enumerate(self.edges):
+            codes[:, i] = np.searchsorted(edges, x[:, i], side='left')
+            codes[np.isnan(x[:, i]), i] = np.nan
+        return codes
+
+    def fit_transform(self, x):
+        return self.fit(x).transform(x)
+
+
+class HistTreeClassifier(ClassifierMixin, BaseEstimator):
+    """区間番号に変換した特徴量で学習する2値分類の決定木
+
+    ヒストグラムで分割点を探すため行数が多くても速く、学習はOpenMPで並列に実行される。
+    クラス比率の二乗誤差で分割するため、2値分類ではジニ不純度による決定木と同じ基準になる。
+
+    学習にはHistGradientBoostingRegressorを使うため、FeatureBinsの区間番号はfitのたびに
+    その内部の_BinMapperでもう一度区間に変換される（再利用できない）。
+    行数が20万を超えると_BinMapperは標本から区切りを求めるため、標本に現れない少数の区間番号は
+    隣の区間とまとめられることがある。
+    """
+
+    def __init__(self, max_depth=3, max_bins=255, class_weight='balanced', threads=None, bins=None) -> None:
+        self.max_depth = max_depth
+        self.max_bins = max_bins
+        self.class_weight = class_weight
+        self.threads = threads
+        self.bins = bins
+
+    def fit(self, x, t):
+        bins = self.bins or FeatureBins(self.max_bins).fit(x)
+        return self.fit_binned(bins.transform(x), t, bins)
+
+    def fit_binned(self, codes, t, bins):
+        """変換済みの区間番号で学習（FeatureBinsの変換は使い回すが、内部の区間への変換は毎回行う）"""
+        from threadpoolctl import threadpool_limits
+
+        t = np.asarray(t)
+        self.classes_ = np.unique(t)
+        if len(self.classes_) != 2:
+            raise ValueError('HistTreeClassifierは2値分類のみ対応しています')
+        self.bins_ = bins
+        self.model_ = HistGradientBoostingRegressor(
+            learning_rate=1.0, max_iter=1, max_depth=self.max_depth, max_leaf_nodes=None,
+            min_samples_leaf=1, l2_regularization=0.0, early_stopping=False, random_state=0)
+        weight = compute_sample_weight(self.class_weight, t) if self.class_weight else None
+        with threadpool_limits(limits=self.threads, user_api='openmp'):
+            self.model_.fit(codes, (t == self.classes_[1]).astype(float), sample_weight=weight)
+        return self
+
+    def predict_proba(self, x):
+        from threadpoolctl import threadpool_limits
+
+        with threadpool_limits(limits=self.threads, user_api='openmp'):
+            p = np.clip(self.model_.predict(self.bins_.transform(x)), 0.0, 1.0)
+        return np.column_stack([1 - p, p])
+
+    def predict(self, x):
+        return self.classes_[(self.predict_proba(x)[:, 1] > 0.5).astype(int)]
+
+
+def _tree_model(learner, depth, ccp_alpha):
+    if learner == 'hist':
+        if ccp_alpha:
+            raise ValueError('learner="hist"ではccp_alphaを指定できません')
+        return HistTreeClassifier(max_depth=depth)
+    return tree.DecisionTreeClassifier(
+        max_depth=depth, random_state=0, class_weight='balanced',
+        ccp_alpha=ccp_alpha)
+
+
+def learn(x, t, depth=3, ccp_alpha=0.0, learner='exact'):
+    """決定木の学習
+
+    learner='hist'で区間に分割した特徴量によるHistTreeClassifierを使う。
+    """
+    model = _tree_model(learner, depth, ccp_alpha)
     x_train, x_test, y_train, y_test = train_test_split(
         x, t, test_size=0.2, random_state=0)
-    model = tree.DecisionTreeClassifier(
-        max_depth=depth, random_state=0, class_weight='balanced')
     model.fit(x_train, y_train)
 
     score = model.score(x_train, y_train)
@@ -85,6 +1016,195 @@ def learn(x, t, depth=3):
     return round(score, 3), round(score2, 3), model
 
 
+def cross_validate_learn(x, t, depth=3, ccp_alpha=0.0, cv=5, n_repeats=1, n_jobs=-1, learner='exact'):
+    """learnと同じ決定木を分割数cvの層化交差検証で評価し、スコアの平均とばらつきを返す"""
+    model = _tree_model(learner, depth, ccp_alpha)
+    splitter = RepeatedStratifiedKFold(
+        n_splits=cv, n_repeats=n_repeats, random_state=0)
+    return _cross_validate(model, x, t, splitter, n_jobs, ndigits=3)
+
+
+def learn_depths(x, t, depths=range(1, 15), threads=None):
+    """深さごとにHistTreeClassifierを学習（FeatureBinsの変換は一度だけ行う）
+
+    HistGradientBoostingRegressor内部の区間への変換は深さごとに行われる。
+
+    深さ、訓練データ・テストデータの正解率、モデルのタプルのリストを返す。
+    """
+    x_train, x_test, y_train, y_test = train_test_split(
+        x, t, test_size=0.2, random_state=0)
+    bins = FeatureBins().fit(x_train)
+    codes = bins.transform(x_train)
+
+    results = []
+    for depth in depths:
+        model = HistTreeClassifier(max_depth=depth, threads=threads).fit_binned(codes, y_train, bins)
+        score = model.score(x_train, y_train)
+        score2 = model.score(x_test, y_test)
+        results.append((depth, round(score, 3), round(score2, 3), model))
+    return results
+
+
+def compare_tree_learners(x, t, sizes=(10000, 100000, 1000000), depth=9, threads=None):
+    """訓練データを復元抽出で行数sizesに増やし、決定木とHistTreeClassifierの学習時間と正解率を比べる"""
+    x_train, x_test, y_train, y_test = train_test_split(
+        x, t, test_size=0.2, random_state=0)
+    rng = np.random.default_rng(0)
+    rows = []
+    for size in sizes:
+        index = rng.integers(0, len(x_train), size)
+        x_large = np.asarray(x_train, dtype=float)[index]
+        y_large = np.asarray(y_train)[index]
+        for learner in ['exact', 'hist']:
+            model = _tree_model(learner, depth, 0.0)
+            if learner == 'hist':
+                model.set_params(threads=threads)
+            start = time.perf_counter()
+            model.fit(x_large, y_large)
+            rows.append({
+                'rows': size,
+                'learner': learner,
+                'fit_time': time.perf_counter() - start,
+                'train_score': model.score(x_large, y_large),
+                'test_score': model.score(np.asarray(x_test, dtype=float), y_test),
+            })
+    return pd.DataFrame(rows)
+
+
+def _pruning_steps(tree_):
+    """最小コスト複雑度枝刈りで各ステップに葉にするノードを求める
+
+    sklearnの枝刈り（DecisionTreeClassifier.cost_complexity_pruning_path）と同じ順序で
+    同じ浮動小数点の演算を行うため、ステップごとのαはパスのccp_alphasと一致する。
+    """
+    left = tree_.children_left
+    right = tree_.children_right
+    n = tree_.node_count
+    internal = left != -1
+    parent = np.full(n, -1)
+    parent[left[internal]] = np.flatnonzero(internal)
+    parent[right[internal]] = np.flatnonzero(internal)
+
+    weight = tree_.weighted_n_node_samples
+    r_node = weight * tree_.impurity / weight[0]
+    # 葉の番号順に祖先へ部分木のリスクと葉の数を足し上げる
+    r_branch = np.where(internal, 0.0, r_node)
+    n_leaves = np.zeros(n, dtype=int)
+    for leaf in np.flatnonzero(~internal):
+        i = parent[leaf]
+        while i != -1:
+            r_branch[i] += r_node[leaf]
+            n_leaves[i] += 1
+            i = parent[i]
+
+    steps = []
+    candidate = internal.copy()
+    while candidate[0]:
+        g = np.full(n, np.inf)
+        g[candidate] = (r_node[candidate] - r_branch[candidate]) / (n_leaves[candidate] - 1)
+        node = int(np.argmin(g))
+        steps.append(node)
+
+        # 葉にしたノード以下の内部ノードは候補から外す
+        stack = [node]
+        while stack:
+            i = stack.pop()
+            candidate[i] = False
+            if internal[i]:
+                stack.extend([left[i], right[i]])
+        n_pruned = n_leaves[node] - 1
+        r_diff = r_node[node] - r_branch[node]
+        r_branch[node] = r_node[node]
+        i = parent[node]
+        while i != -1:
+            n_leaves[i] -= n_pruned
+            r_branch[i] += r_diff
+            i = parent[i]
+
+    return np.array(steps, dtype=int), parent
+
+
+def _pruned_scores(model, pruned_at, prefixes, x, t):
+    """各部分木の正解率を決定パスの一回の走査から求める
+
+    pruned_atはノードを葉にするステップの番号（葉にしないノードは∞）で、
+    先頭kステップで枝刈りした部分木では経路上で最初にpruned_at < kとなるノードが葉になる。
+    """
+    indicator = model.decision_path(x)
+    indicator.sort_indices()
+    lengths = np.diff(indicator.indptr)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(indicator.nnz) - np.repeat(indicator.indptr[:-1], lengths)
+    # 決定パスを葉で埋めた行列にし、経路上のステップ番号の累積最小値を取る
+    paths = np.repeat(indicator.indices[indicator.indptr[1:] - 1][:, None],
+                      lengths.max(), axis=1)
+    paths[rows, cols] = indicator.indices
+    reach = np.minimum.accumulate(pruned_at[paths], axis=1)
+
+    node_class = model.classes_[np.argmax(model.tree_.value[:, 0, :], axis=1)]
+    t = np.asarray(t)
+    scores = []
+    for k in prefixes:
+        # 経路上に枝刈りしたノードがなければ元の葉（最後の列）
+        hit = reach < k
+        depth = np.where(hit.any(axis=1), np.argmax(hit, axis=1), paths.shape[1] - 1)
+        pred = node_class[paths[np.arange(len(paths)), depth]]
+        scores.append(round(np.mean(pred == t), 3))
+    return scores
+
+
+def learn_pruning_path(x, t):
+    """全深さの決定木を一度だけ学習し、枝刈りした全部分木の正解率を表で返す
+
+    ccp_alphaはcost_complexity_pruning_pathの値で、learn(x, t, depth=None, ccp_alpha=...)に
+    そのまま渡すと同じ部分木を再現できる。
+    """
+    x_train, x_test, y_train, y_test = train_test_split(
+        x, t, test_size=0.2, random_state=0)
+    model = tree.DecisionTreeClassifier(
+        max_depth=None, random_state=0, class_weight='balanced')
+    model.fit(x_train, y_train)
+
+    # 先頭は枝刈り前の木のα（0）なので除き、残りを各ステップのαとする
+    path_alphas = model.cost_complexity_pruning_path(x_train, y_train).ccp_alphas[1:]
+    steps, parent = _pruning_steps(model.tree_)
+    # ccp_alphaで学習すると、αがccp_alphaを超える最初のステップの手前まで枝刈りされる
+    alphas = np.concatenate([[0.0], np.unique(path_alphas[path_alphas > 0])])
+    exceeds = path_alphas[None, :] > alphas[1:, None]
+    prefixes = np.concatenate([[0], np.where(exceeds.any(axis=1), np.argmax(exceeds, axis=1),
+                                            len(path_alphas))])
+    # 丸め誤差で同じ部分木になるαは最小のものだけ残す
+    prefixes, first = np.unique(prefixes, return_index=True)
+    alphas = alphas[first]
+
+    pruned_at = np.full(len(parent), len(steps) + 1)
+    pruned_at[steps] = np.arange(len(steps))
+    # ノードを消すステップ（祖先が葉になるステップの最小値）と深さ
+    removed = np.full(len(parent), len(steps) + 1)
+    node_depth = np.zeros(len(parent), dtype=int)
+    for i in range(1, len(parent)):
+        removed[i] = min(removed[parent[i]], pruned_at[parent[i]])
+        node_depth[i] = node_depth[parent[i]] + 1
+    leaf = model.tree_.children_left == -1
+
+    table = pd.DataFrame({'ccp_alpha': alphas})
+    table['depth'] = [node_depth[removed >= k].max() for k in prefixes]
+    table['n_leaves'] = [int(np.sum((removed >= k) & (leaf | (pruned_at < k)))) for k in prefixes]
+    table['train_score'] = _pruned_scores(model, pruned_at, prefixes, x_train, y_train)
+    table['test_score'] = _pruned_scores(model, pruned_at, prefixes, x_test, y_test)
+    return table
+
+
+def cross_validate_learn_with_std(x, t, cv=5, n_repeats=1, n_jobs=-1):
+    """learn_with_stdと同じ標準化した線形回帰を分割数cvの交差検証で評価し、スコアの平均とばらつきを返す"""
+    # 標準化は分割ごとに訓練データだけで行う（決定係数は標準化の有無で変わらない）
+    model = TransformedTargetRegressor(
+        regressor=make_pipeline(StandardScaler(), LinearRegression()),
+        transformer=StandardScaler())
+    splitter = RepeatedKFold(n_splits=cv, n_repeats=n_repeats, random_state=0)
+    return _cross_validate(model, x, t, splitter, n_jobs)
+
+
 def learn_with_std(x, t):
     x_train, x_val, y_train, y_val = train_test_split(
         x, t, test_size=0.2, random_state=0)
@@ -109,61 +1229,983 @@ def learn_with_std(x, t):
     return train_score, val_score
 
 
-class Iris:
+class StreamingRegression:
+    """データをチャンク単位で一度だけ走査して学習する線形回帰
+
+    件数・平均・偏差積和（中心化したXᵀX、Xᵀy）を逐次更新し、
+    並列に集計した統計量はmergeで結合できる。
+    """
+
     def __init__(self) -> None:
+        self.n = 0
+        self.mean = None
+        self.comoment = None
+        self.columns = None
+        self.targets = None
+
+    def partial_fit(self, x, t):
+        """チャンクの統計量を集計に加える"""
+        if self.columns is None:
+            self.columns = list(x.columns) if hasattr(x, 'columns') else None
+            self.targets = np.ndim(t)
+        z = np.column_stack([np.asarray(x, dtype=float), np.asarray(t, dtype=float)])
+        # 欠損値を含む行は集計しない
+        z = z[np.isfinite(z).all(axis=1)]
+        if len(z) == 0:
+            return self
+        mean = z.mean(axis=0)
+        d = z - mean
+        self._combine(len(z), mean, d.T @ d)
+        return self
+
+    def merge(self, other):
+        """別に集計した統計量を結合する"""
+        if other.n == 0:
+            return self
+        if self.columns is None:
+            self.columns = other.columns
+            self.targets = other.targets
+        self._combine(other.n, other.mean, other.comoment)
+        return self
+
+    def _combine(self, n, mean, comoment):
+        if self.n == 0:
+            self.n, self.mean, self.comoment = n, mean, comoment
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.comoment = self.comoment + comoment + np.outer(delta, delta) * self.n * n / total
+        self.mean = self.mean + delta * n / total
+        self.n = total
+
+    def fit_csv(self, file, xcols, tcol, chunksize=100000):
+        """CSVファイルをチャンク単位で読み込んで集計する（tcolがリストなら目的変数は2次元）"""
+        tcols = [tcol] if isinstance(tcol, str) else list(tcol)
+        for chunk in pd.read_csv(file, usecols=list(xcols) + tcols, chunksize=chunksize):
+            self.partial_fit(chunk[xcols], chunk[tcol])
+        return self
+
+    def coefficients(self):
+        """元の単位での回帰係数と切片を求める"""
+        k = len(self.mean) - 1
+        coef = np.linalg.solve(self.comoment[:k, :k], self.comoment[:k, k])
+        intercept = self.mean[k] - self.mean[:k] @ coef
+        return coef, intercept
+
+    def scalers(self):
+        """説明変数と目的変数のStandardScalerを統計量から作成する"""
+        var = np.diag(self.comoment) / self.n
+        k = len(self.mean) - 1
+        return self._scaler(self.mean[:k], var[:k], self.columns), \
+            self._scaler(self.mean[k:], var[k:], None)
+
+    def _scaler(self, mean, var, columns):
+        scaler = StandardScaler()
+        scaler.mean_ = mean
+        scaler.var_ = var
+        scaler.scale_ = np.where(var > 0, np.sqrt(var), 1.0)
+        scaler.n_samples_seen_ = self.n
+        scaler.n_features_in_ = len(mean)
+        if columns is not None:
+            scaler.feature_names_in_ = np.array(columns, dtype=object)
+        return scaler
+
+    def model(self, standardize=False):
+        """LinearRegressionを作成する（standardize=Trueなら標準化後の空間での係数）"""
+        coef, intercept = self.coefficients()
+        columns = self.columns
+        if standardize:
+            sc_x, sc_y = self.scalers()
+            coef = coef * sc_x.scale_ / sc_y.scale_[0]
+            intercept = 0.0
+            columns = None
+        model = LinearRegression()
+        if self.targets == 1:
+            model.coef_ = coef
+            model.intercept_ = intercept
+        else:
+            model.coef_ = coef.reshape(1, -1)
+            model.intercept_ = np.array([intercept])
+        model.n_features_in_ = len(coef)
+        if columns is not None:
+            model.feature_names_in_ = np.array(columns, dtype=object)
+        return model
+
+    def save(self, name, standardize=False, directory=None):
+        """Boston・Cinemaクラスが読み込む形式でモデルを保存する"""
+        directory = directory or path + '/model'
+        _dump(self.model(standardize), f'{directory}/{name}.pkl')
+        if standardize:
+            sc_x, sc_y = self.scalers()
+            _dump(sc_x, f'{directory}/{name}_scx.pkl')
+            _dump(sc_y, f'{directory}/{name}_scy.pkl')
+
+
+def _dump(obj, file):
+    """読み込み中のプロセスが壊れたファイルを見ないよう一時ファイル経由で保存"""
+    with open(file=file + '.tmp', mode='wb') as f:
+        pickle.dump(obj, f)
+    os.replace(file + '.tmp', file)
+
+
+class FeaturePipeline:
+    """学習と推論で共通に使う特徴量の変換
+
+    特徴量は{name, op, args}の宣言で定義し、JSONでモデルと一緒に保存する。
+    opはcolumn（そのまま）、power（累乗）、product（積）、equals（ダミー変数）。
+    変換はバッチ全体に対してベクトル演算で行い、確保済みの配列に書き込む。
+    """
+
+    ops = ('column', 'power', 'product', 'equals')
+
+    def __init__(self, inputs, features) -> None:
+        self.inputs = list(inputs)
+        self.features = [dict(f) for f in features]
+        self.names = [f['name'] for f in self.features]
+        self._compiled = []
+        for f in self.features:
+            if f['op'] not in self.ops:
+                raise ValueError(f"unknown op: {f['op']}")
+            if f['op'] == 'product':
+                args = [self.inputs.index(a) for a in f['args']]
+            else:
+                args = [self.inputs.index(f['args'][0])] + list(f['args'][1:])
+            self._compiled.append((f['op'], args))
+
+    def _columns(self, x):
+        if hasattr(x, 'columns'):
+            return [x[c].to_numpy() for c in self.inputs]
+        x = np.asarray(x)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        return [x[:, i] for i in range(len(self.inputs))]
+
+    def transform(self, x, out=None):
+        """入力（データフレームまたはinputs順の2次元配列）から特徴量の配列を作成"""
+        columns = self._columns(x)
+        if out is None:
+            out = np.empty((len(columns[0]), len(self._compiled)), order='F')
+        for j, (op, args) in enumerate(self._compiled):
+            if op == 'column':
+                out[:, j] = columns[args[0]]
+            elif op == 'power' and args[1] == 2:
+                np.square(columns[args[0]], out=out[:, j], dtype=float)
+            elif op == 'power':
+                np.power(columns[args[0]], args[1], out=out[:, j], dtype=float)
+            elif op == 'product':
+                np.multiply(columns[args[0]], columns[args[1]], out=out[:, j], dtype=float)
+            else:
+                out[:, j] = columns[args[0]] == args[1]
+        return out
+
+    def frame(self, x):
+        """変換結果を特徴量名を列名にしたデータフレームで返す"""
+        index = x.index if hasattr(x, 'index') else None
+        return pd.DataFrame(self.transform(x), columns=self.names, index=index)
+
+    def save(self, file):
+        with open(file=file, mode='w') as f:
+            json.dump({'inputs': self.inputs, 'features': self.features}, f,
+                      ensure_ascii=False, indent=2)
+
+    @staticmethod
+    def load(file):
+        with open(file=file, mode='r') as f:
+            spec = json.load(f)
+        return FeaturePipeline(spec['inputs'], spec['features'])
+
+
+BOSTON_FEATURES = FeaturePipeline(['RM', 'LSTAT', 'PTRATIO'], [
+    {'name': 'RM', 'op': 'column', 'args': ['RM']},
+    {'name': 'LSTAT', 'op': 'column', 'args': ['LSTAT']},
+    {'name': 'PTRATIO', 'op': 'column', 'args': ['PTRATIO']},
+    {'name': 'RM2', 'op': 'power', 'args': ['RM', 2]},
+    {'name': 'LSTAT2', 'op': 'power', 'args': ['LSTAT', 2]},
+    {'name': 'PTRATIO2', 'op': 'power', 'args': ['PTRATIO', 2]},
+    {'name': 'RM * LSTAT', 'op': 'product', 'args': ['RM', 'LSTAT']},
+])
+
+SURVIVED_FEATURES = FeaturePipeline(['Pclass', 'Age', 'SibSp', 'Parch', 'Fare', 'Sex'], [
+    {'name': 'Pclass', 'op': 'column', 'args': ['Pclass']},
+    {'name': 'Age', 'op': 'column', 'args': ['Age']},
+    {'name': 'SibSp', 'op': 'column', 'args': ['SibSp']},
+    {'name': 'Parch', 'op': 'column', 'args': ['Parch']},
+    {'name': 'Fare', 'op': 'column', 'args': ['Fare']},
+    {'name': 'male', 'op': 'equals', 'args': ['Sex', 'male']},
+])
+
+
+def cinema_features(df):
+    """Cinemaモデルの特徴量と目的変数"""
+    return df[['SNS1', 'SNS2', 'actor', 'original']], df['sales']
+
+
+def boston_features(df):
+    """Bostonモデルの特徴量（多項式・交互作用特徴量）と目的変数"""
+    return BOSTON_FEATURES.frame(df), df[['PRICE']]
+
+
+class IncrementalTrainer:
+    """学習状態を保存し、追加データの分だけでCinema・Bostonのモデルを更新する
+
+    追加データにはバッチの学習と同じ前処理（平均による欠損値埋めと、
+    model/{name}_outliers.jsonの外れ値のルールによる除外）を行ってから集計する。
+    欠損値を埋める値とiqr・madのルールの境界は最初のupdateのデータで求めて学習状態と一緒に保存する
+    （imputerに学習済みのGroupImputerを渡せばその値を使う）。
+
+    公開するモデルは毎回versions/以下の新しいディレクトリに書き、
+    currentのシンボリックリンクをos.replaceで一度に切り替える。
+    本番のAPI（Service）はmodel/のモデルを読むため、公開したモデルはオフラインでの検証用で、
+    Cinema(directory=trainer.current())のようにcurrent()で解決したディレクトリからすべてのファイルを読む。
+    """
+
+    models = {
+        'cinema': (cinema_features, False, None, ['SNS1', 'SNS2', 'actor', 'original', 'sales']),
+        'boston': (boston_features, True, BOSTON_FEATURES, ['RM', 'LSTAT', 'PTRATIO', 'PRICE']),
+    }
+
+    def __init__(self, name, directory=None, keep=3, imputer=None, outliers=None) -> None:
+        self.name = name
+        self.directory = directory or path + '/model/incremental'
+        self.keep = keep
+        self.features, self.standardize, self.spec, cols = self.models[name]
+        os.makedirs(f'{self.directory}/versions', exist_ok=True)
         self.load()
+        if self.imputer is None:
+            self.imputer = imputer or GroupImputer(keys=[], cols=cols, stat='mean')
+            self.outliers = outliers or OutlierFilter.load(path + f'/model/{name}_outliers.json')
 
     def load(self):
-        with open(file=path + '/model/iris.pkl', mode='rb') as f:
-            self.model = pickle.load(f)
+        file = f'{self.directory}/{self.name}_state.pkl'
+        self.imputer = self.outliers = None
+        if os.path.exists(file):
+            with open(file=file, mode='rb') as f:
+                saved = pickle.load(f)
+            self.state, self.imputer, self.outliers = saved['state'], saved['imputer'], saved['outliers']
+        else:
+            self.state = StreamingRegression()
+
+    def preprocess(self, df, count=True):
+        """バッチの学習と同じ欠損値埋めと外れ値の除外（最初の呼び出しで代表値と境界を求める）"""
+        if not hasattr(self.imputer, 'default'):
+            self.imputer.fit(df)
+        df = self.imputer.transform(df)
+        if any(r['method'] != 'expr' and 'lower' not in r for r in self.outliers.rules):
+            self.outliers.fit(df)
+        if count:
+            return self.outliers.transform(df)
+        drop = np.zeros(len(df), dtype=bool)
+        for mask in self.outliers.masks(df).values():
+            drop |= mask
+        return df[~drop]
+
+    def update(self, df):
+        """追加データを前処理し、統計量を学習状態に加える"""
+        x, t = self.features(self.preprocess(df))
+        self.state.partial_fit(x, t)
+        return self
+
+    def current(self):
+        """公開中のバージョンのディレクトリ（未公開ならNone）"""
+        link = f'{self.directory}/{self.name}'
+        return os.path.realpath(link) if os.path.lexists(link) else None
+
+    def publish(self):
+        """学習状態を保存し、更新したモデル一式を新しいバージョンとして公開してそのディレクトリを返す"""
+        _dump({'state': self.state, 'imputer': self.imputer, 'outliers': self.outliers},
+              f'{self.directory}/{self.name}_state.pkl')
+        version = tempfile.mkdtemp(prefix=f'{self.name}-{time.strftime("%Y%m%d%H%M%S")}-',
+                                   dir=f'{self.directory}/versions')
+        self.state.save(self.name, self.standardize, version)
+        if self.spec is not None:
+            self.spec.save(f'{version}/{self.name}_features.json')
+        link = f'{self.directory}/{self.name}'
+        os.symlink(os.path.relpath(version, self.directory), link + '.tmp')
+        os.replace(link + '.tmp', link)
+        self._prune()
+        return version
+
+    def _prune(self):
+        """公開中のものを除き、新しいkeep個より古いバージョンを削除"""
+        current = self.current()
+        versions = f'{self.directory}/versions'
+        names = [n for n in os.listdir(versions) if n.startswith(self.name + '-')]
+        names.sort(key=lambda n: os.stat(f'{versions}/{n}').st_mtime_ns)
+        for n in names[:-self.keep]:
+            if os.path.realpath(f'{versions}/{n}') != current:
+                shutil.rmtree(f'{versions}/{n}', ignore_errors=True)
+
+    def verify(self, df, rtol=1e-6):
+        """同じ前処理をした全データで学習し直した結果と係数が許容誤差内で一致するかを確認"""
+        x, t = self.features(self.preprocess(df, count=False))
+        data = pd.concat([x, t], axis=1).dropna()
+        x, t = data[x.columns], data[t.name] if t.ndim == 1 else data[t.columns]
+        if self.standardize:
+            sc_x = StandardScaler().fit(x)
+            sc_y = StandardScaler().fit(t)
+            expected = LinearRegression().fit(sc_x.transform(x), sc_y.transform(t))
+        else:
+            expected = LinearRegression().fit(x, t)
+        result = self.state.model(self.standardize)
+        return (self.state.n == len(data)
+                and np.allclose(result.coef_, expected.coef_, rtol=rtol)
+                and np.allclose(result.intercept_, expected.intercept_, rtol=rtol, atol=1e-9))
+
+
+def _digest_update(digest, value):
+    """データフレーム・配列・モデルと、それらを含むlist/tuple/dictの内容をハッシュに加える
+
+    内容から決まるハッシュを作れない型（reprにアドレスを含むオブジェクトなど）はTypeError。
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(pd.util.hash_pandas_object(value).to_numpy().tobytes())
+        columns = value.columns if isinstance(value, pd.DataFrame) else [value.name]
+        dtypes = value.dtypes if isinstance(value, pd.DataFrame) else [value.dtype]
+        digest.update(repr((list(columns), [str(d) for d in dtypes])).encode())
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.shape, str(value.dtype))).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif value is None or isinstance(value, (bool, int, float, str, bytes, np.generic)):
+        digest.update(repr((type(value).__name__, value)).encode())
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__}:{len(value)}'.encode())
+        for item in value:
+            _digest_update(digest, item)
+    elif isinstance(value, dict):
+        digest.update(f'dict:{len(value)}'.encode())
+        for key in sorted(value, key=repr):
+            _digest_update(digest, key)
+            _digest_update(digest, value[key])
+    elif hasattr(value, 'get_params'):
+        digest.update(type(value).__name__.encode())
+        _digest_update(digest, value.get_params(deep=False))
+    else:
+        raise TypeError(f'cannot hash {type(value).__name__} for the cache key')
+
+
+def _code_names(code):
+    # 関数内のラムダや内包表記で参照する名前も含める
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+    return names
+
+
+def _source(func):
+    """関数と、そこから参照する同じモジュールの関数・クラスのソース
+
+    呼び出し先（learnから呼ぶ_cross_validateなど）を変更してもキーが変わるよう、
+    同じモジュール内の参照をたどる。他のモジュールの変更はライブラリのバージョンでのみ反映される。
+    """
+    sources = []
+    stack, seen = [func], set()
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            source = ''
+        sources.append(f'{obj.__module__}.{obj.__qualname__}:{source}')
+        code = getattr(obj, '__code__', None)
+        if code is None:
+            continue
+        namespace = getattr(obj, '__globals__', {})
+        for name in sorted(_code_names(code), reverse=True):
+            value = namespace.get(name)
+            if ((inspect.isfunction(value) or inspect.isclass(value))
+                    and value.__module__ == obj.__module__):
+                stack.append(value)
+    return '\n'.join(sources)
+
+
+def _cache_entries(directory):
+    """保存済みの結果の(更新日時, サイズ, ファイル名)を古い順に返す"""
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith('.pkl'):
+            try:
+                stat = os.stat(f'{directory}/{name}')
+            except FileNotFoundError:
+                # 並列に実行している別のプロセスが削除した
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+    return sorted(entries)
+
+
+def _evict(directory, max_bytes, keep=()):
+    """合計サイズがmax_bytesを超えていれば、keep以外の古い結果から削除"""
+    entries = _cache_entries(directory)
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in entries:
+        if total <= max_bytes:
+            break
+        if name in keep:
+            continue
+        try:
+            os.remove(f'{directory}/{name}')
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+class TrainingCache:
+    """学習結果をデータ・パラメータ・ライブラリのハッシュをキーにディスクへ保存する
+
+    同じ入力での再実行は保存済みの結果を返す。合計サイズがmax_bytesを超えると
+    最も長く使われていない結果から削除する。キーに含める関数のソースは同じモジュールの
+    呼び出し先までで、他のモジュールの関数を変更したときはキャッシュを削除する。
+    複数のプロセスで同じディレクトリを共有できる。
+    """
+
+    def __init__(self, directory=None, max_bytes=512 * 1024 * 1024) -> None:
+        self.directory = directory or path + '/cache'
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, name, args, kwargs):
+        """引数の内容とライブラリのバージョンからキーを作成"""
+        digest = hashlib.sha256()
+        digest.update(name.encode())
+        for version in (sklearn.__version__, pd.__version__, np.__version__):
+            digest.update(version.encode())
+        for value in list(args) + sorted(kwargs.items()):
+            _digest_update(digest, value)
+        return digest.hexdigest()
+
+    def run(self, func, *args, **kwargs):
+        """保存済みの結果があれば返し、なければ実行して保存する"""
+        file = f'{self.directory}/{self.key(_source(func), args, kwargs)}.pkl'
+        try:
+            with open(file=file, mode='rb') as f:
+                result = pickle.load(f)
+        except FileNotFoundError:
+            # 未保存か、別のプロセスが削除した
+            pass
+        else:
+            try:
+                os.utime(file)
+            except FileNotFoundError:
+                pass
+            self.hits += 1
+            return result
+
+        result = func(*args, **kwargs)
+        _dump(result, file)
+        self.misses += 1
+        self.evict()
+        return result
+
+    def cached(self, func):
+        """関数の結果をキャッシュするラッパーを返す"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.run(func, *args, **kwargs)
+        return wrapper
+
+    def fit(self, model, x, t):
+        """未学習のモデルを学習し、同じ条件の学習済みモデルがあればそれを返す"""
+        return self.run(_fit, model, x, t)
+
+    def _entries(self):
+        return _cache_entries(self.directory)
+
+    def evict(self):
+        """合計サイズが上限を超えていれば古い結果から削除"""
+        _evict(self.directory, self.max_bytes)
+
+    def report(self):
+        """この実行でのキャッシュの利用状況"""
+        entries = self._entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+        }
+
+
+def _fit(model, x, t):
+    return model.fit(x, t)
+
+
+def _run_stage(task):
+    func, inputs, params = task
+    return func(*inputs, **params)
+
+
+class TrainingPipeline:
+    """学習の段階（読み込み→欠損値処理→外れ値除外→特徴量→分割→学習→評価→保存）を宣言して実行する
+
+    各段階の結果は関数・パラメータ・前段のキーから作ったキーでディスクに保存し、
+    変更した段階とその後段だけを再計算する。ファイル名のパラメータとdepends_onのファイルは
+    更新日時とサイズをキーに含め、ファイルを書き換えると再計算する。
+    依存関係のない段階（Takeごとの分岐など）はプロセスプールで並列に実行するため、
+    段階の関数はモジュールの関数で定義する。保存した結果の合計がmax_bytesを超えると、
+    最も長く使われていない結果から削除する。
+    """
+
+    def __init__(self, directory=None, workers=None, max_bytes=512 * 1024 * 1024) -> None:
+        self.directory = directory or path + '/cache/pipeline'
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.stages = {}
+        self.status = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    def stage(self, name, func, after=None, depends_on=None, **params):
+        """段階を追加（afterの段階の結果を引数としてfunc(*結果, **params)を実行）
+
+        depends_onには関数が読み込むファイル（パラメータで渡さないもの）を指定する。
+        """
+        if name in self.stages:
+            raise ValueError(f'duplicate stage: {name}')
+        after = [] if after is None else [after] if isinstance(after, str) else list(after)
+        for parent in after:
+            if parent not in self.stages:
+                raise ValueError(f'unknown stage: {parent}')
+        depends_on = ([] if depends_on is None else [depends_on] if isinstance(depends_on, str)
+                      else list(depends_on))
+        self.stages[name] = {'func': func, 'after': after, 'params': params, 'depends_on': depends_on}
+        return self
+
+    def keys(self):
+        """前段のキーを含めた各段階のキー"""
+        keys = {}
+        for name, stage in self.stages.items():
+            digest = hashlib.sha256(_source(stage['func']).encode())
+            for version in (sklearn.__version__, pd.__version__, np.__version__):
+                digest.update(version.encode())
+            for value in sorted(stage['params'].items()):
+                _digest_update(digest, value)
+            files = [v for v in stage['params'].values() if isinstance(v, str) and os.path.isfile(v)]
+            for file in files + stage['depends_on']:
+                stat = os.stat(file)
+                digest.update(repr((os.path.abspath(file), stat.st_mtime_ns, stat.st_size)).encode())
+            for parent in stage['after']:
+                digest.update(keys[parent].encode())
+            keys[name] = digest.hexdigest()
+        return keys
+
+    def run(self, targets=None):
+        """保存済みでない段階だけを実行し、targets（省略時は末端の段階）の結果を返す"""
+        files = {name: f'{self.directory}/{key}.pkl' for name, key in self.keys().items()}
+        compute = [name for name in self.stages if not os.path.exists(files[name])]
+        if targets is None:
+            parents = {p for stage in self.stages.values() for p in stage['after']}
+            targets = [name for name in self.stages if name not in parents]
+        self.status = {name: 'computed' if name in compute else 'cached' for name in self.stages}
+
+        results = {}
+        needed = set(targets) | {p for name in compute for p in self.stages[name]['after']}
+        for name in needed - set(compute):
+            with open(file=files[name], mode='rb') as f:
+                results[name] = pickle.load(f)
+            os.utime(files[name])
+
+        while compute:
+            ready = [name for name in compute
+                     if all(p in results for p in self.stages[name]['after'])]
+            tasks = [(self.stages[name]['func'],
+                      [results[p] for p in self.stages[name]['after']],
+                      self.stages[name]['params']) for name in ready]
+            if self.workers == 1 or len(tasks) == 1:
+                outputs = [_run_stage(task) for task in tasks]
+            else:
+                with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    outputs = list(executor.map(_run_stage, tasks))
+            for name, output in zip(ready, outputs):
+                _dump(output, files[name])
+                results[name] = output
+            compute = [name for name in compute if name not in results]
+
+        _evict(self.directory, self.max_bytes, keep={os.path.basename(f) for f in files.values()})
+        return {name: results[name] for name in targets}
+
+
+# ワーカープロセスごとに一度だけ受け渡す学習データ
+_sweep_data = {}
+
+
+def _init_sweep(x, t):
+    _sweep_data['x'] = x
+    _sweep_data['t'] = t
+
+
+def _run_sweep(task):
+    learner, name, cols, params = task
+    x = _sweep_data['x'][cols]
+    t = _sweep_data['t']
+    start = time.perf_counter()
+    if learner == 'tree':
+        train_score, test_score, _ = learn(x, t, **params)
+    else:
+        train_score, test_score = learn_with_std(x, t, **params)
+    fit_time = time.perf_counter() - start
+    return dict(features=name, **params, train_score=train_score,
+                test_score=test_score, fit_time=fit_time)
+
+
+def sweep(x, t, grid=None, features=None, learner='tree', workers=None):
+    """パラメータと特徴量の組み合わせを並列に学習して結果を表で返す
+
+    学習データはワーカーの初期化時に一度だけ渡し、タスクには列名とパラメータのみを送る。
+    featuresは{名前: 列名のリスト}、gridは{パラメータ名: 値のリスト}で指定する。
+    """
+    if learner not in ('tree', 'linear'):
+        raise ValueError(f'unknown learner: {learner}')
+    if features is None:
+        features = {'all': list(x.columns)}
+    tasks = [(learner, name, list(cols), params)
+             for name, cols in features.items()
+             for params in ParameterGrid(grid or {})]
+
+    if workers == 1:
+        _init_sweep(x, t)
+        results = [_run_sweep(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep,
+                                 initargs=(x, t)) as executor:
+            results = list(executor.map(_run_sweep, tasks))
+    return pd.DataFrame(results)
+
+
+def _onnx_features(features):
+    """FeaturePipelineの変換をONNXのノードにする（入力X、出力features）"""
+    from onnx import TensorProto, helper, numpy_helper
+
+    nodes = []
+    initializers = []
+    outputs = []
+
+    def constant(name, value, dtype):
+        initializers.append(numpy_helper.from_array(np.array(value, dtype=dtype), name))
+        return name
+
+    def column(j, k, i):
+        name = f'column{j}_{k}'
+        nodes.append(helper.make_node(
+            'Gather', ['X', constant(f'index{j}_{k}', [i], np.int64)], [name], axis=1))
+        return name
+
+    for j, (op, args) in enumerate(features._compiled):
+        x = column(j, 0, args[0])
+        name = f'feature{j}'
+        if op == 'column':
+            name = x
+        elif op == 'power' and args[1] == 2:
+            nodes.append(helper.make_node('Mul', [x, x], [name]))
+        elif op == 'power':
+            nodes.append(helper.make_node(
+                'Pow', [x, constant(f'exponent{j}', args[1], np.float64)], [name]))
+        elif op == 'product':
+            nodes.append(helper.make_node('Mul', [x, column(j, 1, args[1])], [name]))
+        else:
+            if isinstance(args[1], str):
+                raise ValueError('文字列との比較はONNXに変換できません')
+            nodes.append(helper.make_node(
+                'Equal', [x, constant(f'value{j}', args[1], np.float64)], [name + '_bool']))
+            nodes.append(helper.make_node('Cast', [name + '_bool'], [name], to=TensorProto.DOUBLE))
+        outputs.append(name)
+    nodes.append(helper.make_node('Concat', outputs, ['features'], axis=1))
+    return nodes, initializers
+
+
+def _onnx_linear(model, scaler=None, features=None, n_inputs=None):
+    """線形回帰（前段に特徴量の変換と標準化）を倍精度のONNXグラフにする"""
+    from onnx import TensorProto, helper, numpy_helper
+
+    nodes, initializers = _onnx_features(features) if features else ([], [])
+    x = 'features' if features else 'X'
+    if scaler is not None:
+        initializers += [numpy_helper.from_array(scaler.mean_, 'mean'),
+                         numpy_helper.from_array(scaler.scale_, 'scale')]
+        nodes += [helper.make_node('Sub', [x, 'mean'], ['centered']),
+                  helper.make_node('Div', ['centered', 'scale'], ['scaled'])]
+        x = 'scaled'
+    # 係数の形はsklearnに合わせる（1次元なら出力も1次元）
+    coef = model.coef_.T
+    initializers += [numpy_helper.from_array(np.ascontiguousarray(coef, dtype=np.float64), 'coef'),
+                     numpy_helper.from_array(np.asarray(model.intercept_, dtype=np.float64), 'intercept')]
+    nodes += [helper.make_node('MatMul', [x, 'coef'], ['product']),
+              helper.make_node('Add', ['product', 'intercept'], ['variable'])]
+    shape = [None] if coef.ndim == 1 else [None, coef.shape[1]]
+    graph = helper.make_graph(
+        nodes, 'linear', [helper.make_tensor_value_info('X', TensorProto.DOUBLE, [None, n_inputs])],
+        [helper.make_tensor_value_info('variable', TensorProto.DOUBLE, shape)], initializers)
+    return helper.make_model(graph, opset_imports=[helper.make_opsetid('', 17)], ir_version=8)
+
+
+def _onnx_tree(model):
+    """決定木を単精度入力のONNXグラフにする（sklearnの決定木も単精度で比較するため結果は一致する）"""
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+
+    return convert_sklearn(
+        model, initial_types=[('X', FloatTensorType([None, model.n_features_in_]))],
+        options={id(model): {'zipmap': False}}, target_opset={'': 17, 'ai.onnx.ml': 3})
+
+
+def export_onnx(name, directory=None):
+    """directoryの学習済みモデル（iris, cinema, survived, boston）を同じディレクトリにONNX形式で保存し、ファイル名を返す
+
+    bostonは同じディレクトリの特徴量の仕様と標準化もグラフに含める。
+    onnxとskl2onnx（推論にはonnxruntime）が必要（requirements.txt）。
+    """
+    directory = directory or path + '/model'
+    with open(file=directory + f'/{name}.pkl', mode='rb') as f:
+        model = pickle.load(f)
+    if isinstance(model, HistTreeClassifier):
+        raise ValueError('HistTreeClassifierのモデルはONNXに変換できません（learner="exact"で学習してください）')
+    if name == 'boston':
+        with open(file=directory + '/boston_scx.pkl', mode='rb') as f:
+            scaler = pickle.load(f)
+        features = FeaturePipeline.load(directory + '/boston_features.json')
+        onnx_model = _onnx_linear(model, scaler, features, len(features.inputs))
+    elif name == 'cinema':
+        onnx_model = _onnx_linear(model, n_inputs=model.n_features_in_)
+    else:
+        onnx_model = _onnx_tree(model)
+
+    file = os.path.join(directory, f'{name}.onnx')
+    tmp = file + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(onnx_model.SerializeToString())
+    os.replace(tmp, file)
+    return file
+
+
+class OnnxModel:
+    """ONNX Runtimeで推論するモデル（threadsで演算内の並列数を指定）"""
+
+    def __init__(self, file, threads=None) -> None:
+        import onnxruntime as rt
+
+        options = rt.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = rt.InferenceSession(file, options, providers=['CPUExecutionProvider'])
+        self.input = self.session.get_inputs()[0].name
+        self.output = self.session.get_outputs()[0].name
+        self.dtype = np.float32 if self.session.get_inputs()[0].type == 'tensor(float)' else np.float64
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=self.dtype)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        return self.session.run([self.output], {self.input: x})[0]
+
+
+def _load_model(name, backend, threads, directory):
+    if backend == 'onnx':
+        return OnnxModel(directory + f'/{name}.onnx', threads=threads)
+    with open(file=directory + f'/{name}.pkl', mode='rb') as f:
+        return pickle.load(f)
+
+
+def _benchmark_inputs(name):
+    """推論速度の比較に使う各モデルの入力"""
+    if name == 'iris':
+        df = pd.read_csv(path + '/data/iris.csv', encoding='utf-8-sig')
+        return df[['sepal_length', 'sepal_width', 'petal_length', 'petal_width']].dropna().to_numpy()
+    if name == 'cinema':
+        return cinema_features(pd.read_csv(path + '/data/cinema.csv').dropna())[0].to_numpy(dtype=float)
+    if name == 'survived':
+        df = pd.read_csv(path + '/data/Survived.csv')
+        df['Age'] = df['Age'].fillna(df['Age'].median())
+        return df[SURVIVED_FEATURES.inputs].to_numpy(dtype=object)
+    return pd.read_csv(path + '/data/Boston.csv')[['RM', 'LSTAT', 'PTRATIO']].dropna().to_numpy()
+
+
+def compare_backends(batch_sizes=(1, 64, 10000), rows=20000, threads=None):
+    """sklearnとONNX Runtimeで推論のレイテンシとスループットを比べる（1バッチあたりの中央値）"""
+    classes = {'iris': Iris, 'cinema': Cinema, 'survived': Survived, 'boston': Boston}
+    rng = np.random.default_rng(0)
+    results = []
+    # 特徴量名のない入力に対するsklearnの警告は計測から除く
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        for name, cls in classes.items():
+            results += _compare_backends(name, cls, batch_sizes, rows, threads, rng)
+    return pd.DataFrame(results)
+
+
+def _compare_backends(name, cls, batch_sizes, rows, threads, rng):
+    """1つのモデルについてバックエンドとバッチサイズごとに推論時間を計測"""
+    data = _benchmark_inputs(name)
+    results = []
+    for backend in ['sklearn', 'onnx']:
+        model = cls(backend=backend, threads=threads)
+        predict = (lambda x: model.predict(*x.T)) if name == 'boston' else model.predict
+        for batch in batch_sizes:
+            x = data[rng.integers(0, len(data), batch)]
+            predict(x)
+            times = []
+            for _ in range(max(1, rows // batch)):
+                start = time.perf_counter()
+                predict(x)
+                times.append(time.perf_counter() - start)
+            latency = float(np.median(times))
+            results.append({'model': name, 'backend': backend, 'batch': batch,
+                            'latency_ms': latency * 1000, 'rows_per_sec': batch / latency})
+    return results
+
+
+def _tree_contributions(model, names):
+    """決定木の各ノードへ進んだときの確率の変化を、分岐に使った特徴量の列に置いた行列
+
+    決定経路の指示行列との積が特徴量ごとの寄与になる（最後の列は根のノードの値）。
+    """
+    tree_ = model.tree_
+    value = tree_.value[:, 0, :]
+    probability = value[:, -1] / value.sum(axis=1)
+    matrix = np.zeros((tree_.node_count, len(names) + 1))
+    matrix[0, -1] = probability[0]
+    for parent in np.flatnonzero(tree_.children_left != -1):
+        for child in (tree_.children_left[parent], tree_.children_right[parent]):
+            matrix[child, tree_.feature[parent]] = probability[child] - probability[parent]
+    return matrix
+
+
+def _explanation(contributions, bias, names, index=None):
+    frame = pd.DataFrame(contributions, columns=names, index=index)
+    frame.insert(0, 'bias', bias)
+    return frame
+
+
+class Iris:
+    def __init__(self, backend='sklearn', threads=None, directory=None) -> None:
+        self.backend = backend
+        self.threads = threads
+        self.directory = directory or path + '/model'
+        self.load()
+
+    def load(self):
+        self.model = _load_model('iris', self.backend, self.threads, self.directory)
 
     def predict(self, x):
         return self.model.predict(x)
 
 
 class Cinema:
-    def __init__(self) -> None:
+    def __init__(self, backend='sklearn', threads=None, directory=None) -> None:
+        self.backend = backend
+        self.threads = threads
+        self.directory = directory or path + '/model'
         self.load()
 
     def load(self):
-        with open(file=path + '/model/cinema.pkl', mode='rb') as f:
-            self.model = pickle.load(f)
+        self.model = _load_model('cinema', self.backend, self.threads, self.directory)
 
     def predict(self, x):
         return self.model.predict(x)
 
+    def explain(self, x):
+        """係数×特徴量による各特徴量の寄与（biasは切片で、行の合計が予測値）"""
+        if self.backend == 'onnx':
+            raise ValueError('explainはsklearnのモデルでのみ使えます')
+        x = np.asarray(x, dtype=float).reshape(-1, len(self.model.coef_))
+        return _explanation(x * self.model.coef_, self.model.intercept_,
+                            list(self.model.feature_names_in_))
+
+
+# Sexのダミー変数（male）の値と学習データの値の対応
+SURVIVED_SEX = {0: 'female', 1: 'male'}
+
+
+def _sex_label(value):
+    if value in ('male', 'female'):
+        return value
+    if not isinstance(value, str) and value in SURVIVED_SEX:
+        return SURVIVED_SEX[value]
+    raise ValueError(f"Sexは'male'/'female'または1/0で指定してください: {value!r}")
+
 
 class Survived:
-    def __init__(self) -> None:
+    def __init__(self, backend='sklearn', threads=None, directory=None) -> None:
+        self.backend = backend
+        self.threads = threads
+        self.directory = directory or path + '/model'
         self.load()
 
     def load(self):
-        with open(file=path + '/model/survived.pkl', mode='rb') as f:
-            self.model = pickle.load(f)
+        self.model = _load_model('survived', self.backend, self.threads, self.directory)
+        self.features = FeaturePipeline.load(self.directory + '/survived_features.json')
+        # 寄与の計算に使うノードごとの値は読み込み時に一度だけ求める
+        self.contributions = None
+        if isinstance(self.model, tree.DecisionTreeClassifier):
+            self.contributions = _tree_contributions(self.model, list(self.model.feature_names_in_))
+
+    def transform(self, x):
+        """入力（データフレームまたはinputs順の行）を学習時と同じ特徴量に変換
+
+        Sexは'male'/'female'またはダミー変数の1（男性）/0（女性）で、それ以外はValueError。
+        """
+        if not hasattr(x, 'columns'):
+            x = pd.DataFrame(np.asarray(x, dtype=object).reshape(-1, len(self.features.inputs)),
+                             columns=self.features.inputs)
+        x = x.assign(Sex=[_sex_label(v) for v in x['Sex']])
+        if self.backend == 'onnx':
+            return self.features.transform(x)
+        return self.features.frame(x)
 
     def predict(self, x):
-        return self.model.predict(x)
+        return self.model.predict(self.transform(x))
+
+    def explain(self, x):
+        """決定経路に沿った各特徴量の寄与（biasは根のノードの値で、行の合計が生存の確率）"""
+        if isinstance(self.model, HistTreeClassifier):
+            raise ValueError('HistTreeClassifierのモデルではexplainを使えません（learner="exact"で学習してください）')
+        if self.contributions is None:
+            raise ValueError('explainはsklearnの決定木でのみ使えます')
+        result = (self.model.decision_path(self.transform(x)) @ self.contributions)
+        return _explanation(result[:, :-1], result[:, -1], list(self.model.feature_names_in_))
 
 
 class Boston:
-    def __init__(self) -> None:
+    def __init__(self, backend='sklearn', threads=None, directory=None) -> None:
+        self.backend = backend
+        self.threads = threads
+        self.directory = directory or path + '/model'
         self.load()
 
     def load(self):
-        with open(file=path + '/model/boston.pkl', mode='rb') as f:
-            self.model = pickle.load(f)
-        with open(file=path + '/model/boston_scx.pkl', mode='rb') as f:
+        self.model = _load_model('boston', self.backend, self.threads, self.directory)
+        with open(file=self.directory + '/boston_scx.pkl', mode='rb') as f:
             self.model_scx = pickle.load(f)
-        with open(file=path + '/model/boston_scy.pkl', mode='rb') as f:
+        with open(file=self.directory + '/boston_scy.pkl', mode='rb') as f:
             self.model_scy = pickle.load(f)
+        self.features = FeaturePipeline.load(self.directory + '/boston_features.json')
 
     def predict(self, rm, lstat, ptratio):
-        rm2 = rm ** 2
-        lstat2 = lstat ** 2
-        ptratio2 = ptratio ** 2
-        rm_lstat = rm * lstat
-        x_test = [[rm, lstat, ptratio, rm2, lstat2, ptratio2, rm_lstat]]
+        """スカラーまたは配列で受け取った入力をまとめて予測"""
+        if self.backend == 'onnx':
+            # 特徴量の変換と標準化はONNXのグラフに含まれる
+            return self.model.predict(np.column_stack([rm, lstat, ptratio]))
+        x_test = self.features.transform(np.column_stack([rm, lstat, ptratio]))
         sc_x_test = self.model_scx.transform(x_test)
         result = self.model.predict(sc_x_test)
 
         return result
+
+    def predict_price(self, rm, lstat, ptratio):
+        """目的変数の標準化を戻した価格で予測"""
+        result = np.reshape(self.predict(rm, lstat, ptratio), (-1, 1))
+        return self.model_scy.inverse_transform(result).reshape(-1)
+
+    def explain(self, rm, lstat, ptratio):
+        """各特徴量の寄与（標準化を係数に含め、学習データの平均からの差に掛ける）
+
+        biasは特徴量が平均のときの予測値で、行の合計が予測値になる。
+        """
+        if self.backend == 'onnx':
+            raise ValueError('explainはsklearnのモデルでのみ使えます')
+        x = self.features.transform(np.column_stack([rm, lstat, ptratio]))
+        coef = self.model.coef_.reshape(-1) / self.model_scx.scale_
+        contributions = (x - self.model_scx.mean_) * coef
+        return _explanation(contributions, np.ravel(self.model.intercept_)[0], self.features.names)
@@ -1,6 +1,27 @@
+import os
+import pickle
+import shutil
+import tempfile
 import unittest
 
-from domain import Boston, Iris, Cinema, Survived
+import numpy as np
+import pandas as pd
+from sklearn import tree
+from sklearn.linear_model import LinearRegression
+from sklearn.model_selection import RepeatedKFold, RepeatedStratifiedKFold, cross_val_score, train_test_split
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import LabelEncoder, StandardScaler
+
+from domain import (BOSTON_FEATURES, SURVIVED_FEATURES, Boston, Iris, Cinema, Survived,
+                    CategoricalData, CategoricalEncoder, DataVisualization, DatasetProfile,
+                    FeaturePipeline, GroupImputer, HistTreeClassifier,
+                    IncrementalTrainer, OnnxModel, OutlierFilter, StreamingRegression, SyntheticData,
+                    TrainingCache, TrainingPipeline,
+                    compare_backends, compare_tree_learners, convert_categoricals, cross_validate_learn,
+                    cross_validate_learn_with_std, drift_monitors, export_onnx, learn, learn_depths, profile_csv,
+                    learn_pruning_path, learn_with_std, sweep)
+
+path = os.path.dirname(os.path.abspath(__file__))
 
 
 class TestIris(unittest.TestCase):
@@ -29,6 +50,26 @@ class TestSurvived(unittest.TestCase):
         result = seruvived.predict(x)
         self.assertEqual(result[0], 0)
 
+    def test_predict_sex_label(self):
+        survived = Survived()
+        x = [[3, 22, 1, 0, 7.25, 1], [1, 38, 1, 0, 71.28, 0]]
+        labels = [[3, 22, 1, 0, 7.25, 'male'], [1, 38, 1, 0, 71.28, 'female']]
+        np.testing.assert_array_equal(survived.predict(labels), survived.predict(x))
+        self.assertEqual(list(survived.predict(x)), [0, 1])
+        for sex in ('M', 2):
+            with self.assertRaises(ValueError):
+                survived.predict([[3, 22, 1, 0, 7.25, sex]])
+
+    def test_training_parity(self):
+        # 推論時も保存した特徴量の仕様で変換し、学習時の特徴量と同じ予測になる
+        df = pd.read_csv(path + '/data/Survived.csv')
+        df['Age'] = df['Age'].fillna(df['Age'].median())
+        survived = Survived()
+        expected = survived.model.predict(SURVIVED_FEATURES.frame(df))
+        np.testing.assert_array_equal(survived.predict(df), expected)
+        rows = df[SURVIVED_FEATURES.inputs].to_numpy(dtype=object).tolist()
+        np.testing.assert_array_equal(survived.predict(rows), expected)
+
 
 class TestBoston(unittest.TestCase):
 
@@ -40,6 +81,850 @@ class TestBoston(unittest.TestCase):
         result = boston.predict(rm, lstat, ptratio)
         self.assertEqual(result[0][0], 0.21583895618321347)
 
+    def test_predict_batch(self):
+        boston = Boston()
+        rm = np.array([3.561, 5.95])
+        lstat = np.array([7.12, 27.71])
+        ptratio = np.array([20.2, 21])
+        result = boston.predict(rm, lstat, ptratio)
+        self.assertEqual(result.shape, (2, 1))
+        self.assertAlmostEqual(result[1][0], boston.predict(5.95, 27.71, 21)[0][0])
+
+
+class TestDataVisualization(unittest.TestCase):
+
+    def test_render_all(self):
+        df = pd.read_csv(path + '/data/iris.csv')
+        with tempfile.TemporaryDirectory() as tmp:
+            handles = DataVisualization(df).render_all('species', tmp, formats=('png', 'svg'))
+            self.assertEqual(list(handles), ['hist', 'scatter', 'box', 'pairplot'])
+            files = [file for handle in handles.values() for file in handle.result()]
+            self.assertEqual(sorted(files), sorted(tmp + '/' + name for name in os.listdir(tmp)))
+            self.assertEqual(len(files), 8)
+
+            handles = DataVisualization(df).render_all('species', tmp, formats=('png', 'svg'))
+            self.assertTrue(all(handle.done() for handle in handles.values()))
+            df.loc[0, 'sepal_length'] = 1.0
+            handles = DataVisualization(df).render_all('species', tmp, formats=('png',))
+            for handle in handles.values():
+                handle.result()
+            self.assertEqual(len(os.listdir(tmp)), 12)
+
+    def test_sampling(self):
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({'a': rng.normal(size=30000), 'b': rng.normal(size=30000),
+                           'c': rng.choice(['x', 'y', 'z'], p=[0.6, 0.3, 0.1], size=30000)})
+        dv = DataVisualization(df, max_rows=1000)
+        grid = dv.df_pairplot('c')
+        self.assertEqual(dv.sampling[0]['method'], 'stratified')
+        self.assertAlmostEqual(dv.sampling[0]['sampled'], 1000, delta=3)
+        counts = grid.data['c'].value_counts(normalize=True)
+        self.assertAlmostEqual(counts['z'], (df['c'] == 'z').mean(), places=2)
+
+        dv.df_scatter()
+        self.assertEqual(dv.sampling[1]['method'], 'random')
+        self.assertEqual(dv.sampling[1]['sampled'], 1000)
+
+        dense = DataVisualization(df, max_rows=1000, dense_rows=10000)
+        dense.df_scatter()
+        dense.df_pairplot('c')
+        self.assertEqual([r['method'] for r in dense.sampling], ['binned', 'binned'])
+
+        small = DataVisualization(df[:500], max_rows=1000)
+        small.df_scatter()
+        self.assertEqual(small.sampling, [])
+
+    def test_categorical_plot(self):
+        df = pd.read_csv(path + '/data/Survived.csv')
+        ticket = CategoricalData(df, 'Ticket', max_categories=20)
+        ax = ticket.plot()
+        self.assertEqual(len(ax.patches), 21)
+        self.assertEqual(ticket.sampling['others'], len(df) - df['Ticket'].value_counts()[:20].sum())
+
+
+class TestFeaturePipeline(unittest.TestCase):
+
+    def test_boston(self):
+        df = pd.read_csv(path + '/data/Boston.csv')
+        x = df.loc[:, ['RM', 'LSTAT', 'PTRATIO']]
+        x['RM2'] = x['RM'] ** 2
+        x['LSTAT2'] = x['LSTAT'] ** 2
+        x['PTRATIO2'] = x['PTRATIO'] ** 2
+        x['RM * LSTAT'] = x['RM'] * x['LSTAT']
+        pd.testing.assert_frame_equal(BOSTON_FEATURES.frame(df), x)
+
+        out = np.empty((len(df), len(BOSTON_FEATURES.names)))
+        result = BOSTON_FEATURES.transform(df[['RM', 'LSTAT', 'PTRATIO']].to_numpy(), out=out)
+        self.assertIs(result, out)
+        np.testing.assert_array_equal(result, x.to_numpy())
+
+    def test_survived(self):
+        df = pd.read_csv(path + '/data/Survived.csv')
+        x = df[['Pclass', 'Age', 'SibSp', 'Parch', 'Fare']]
+        male = pd.get_dummies(df['Sex'], drop_first=True)
+        expected = pd.concat([x, male], axis=1).astype(float)
+        pd.testing.assert_frame_equal(SURVIVED_FEATURES.frame(df), expected)
+
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            BOSTON_FEATURES.save(tmp + '/features.json')
+            loaded = FeaturePipeline.load(tmp + '/features.json')
+        self.assertEqual(loaded.names, BOSTON_FEATURES.names)
+        np.testing.assert_array_equal(loaded.transform([[6.0, 5.0, 15.0]]),
+                                      [[6.0, 5.0, 15.0, 36.0, 25.0, 225.0, 30.0]])
+
+    def test_unknown_op(self):
+        with self.assertRaises(ValueError):
+            FeaturePipeline(['a'], [{'name': 'a', 'op': 'log', 'args': ['a']}])
+
+
+class TestCategoricalEncoder(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(path + '/data/Survived.csv')
+        self.cols = ['Sex', 'Ticket', 'Cabin', 'Embarked']
+
+    def test_convert_categoricals(self):
+        original = self.df.copy()
+        result = convert_categoricals(self.df, self.cols)
+        for c in self.cols:
+            expected = LabelEncoder().fit_transform(self.df[c])
+            self.assertTrue((result[c].to_numpy() == expected).all())
+        pd.testing.assert_frame_equal(self.df, original)
+
+    def test_unknown(self):
+        encoder = CategoricalEncoder(['Sex', 'Embarked'], unknown=99).fit(self.df)
+        x = pd.DataFrame({'Sex': ['male', 'other'], 'Embarked': ['Q', None]})
+        result = encoder.transform(x)
+        self.assertEqual(list(result['Sex']), [1, 99])
+        self.assertEqual(list(result['Embarked']), [1, 3])
+
+
+class TestGroupImputer(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(path + '/data/Survived.csv')
+
+    def test_median(self):
+        imputer = GroupImputer(keys=['Pclass', 'Survived'], cols=['Age'])
+        result = imputer.fit_transform(self.df)
+        self.assertEqual(result['Age'].isnull().sum(), 0)
+        self.assertEqual(self.df['Age'].isnull().sum(), 177)
+        is_null = self.df['Age'].isnull()
+        group = (self.df['Pclass'] == 1) & (self.df['Survived'] == 0)
+        expected = self.df.loc[group, 'Age'].median()
+        self.assertTrue((result.loc[group & is_null, 'Age'] == expected).all())
+
+    def test_chunks(self):
+        imputer = GroupImputer(keys=['Pclass', 'Survived'], cols=['Age'], stat='mean')
+        expected = imputer.fit_transform(self.df)
+        result = pd.concat([imputer.transform(self.df[i:i + 100])
+                            for i in range(0, len(self.df), 100)])
+        pd.testing.assert_frame_equal(result, expected)
+
+    def test_truncate(self):
+        imputer = GroupImputer(keys=['Pclass', 'Survived'], cols=['Age'], stat='mean', truncate=True)
+        result = imputer.fit_transform(self.df)
+        self.assertEqual(list(imputer.values['Age']), [43, 35, 33, 25, 26, 20])
+        is_null = self.df['Age'].isnull()
+        group = (self.df['Pclass'] == 3) & (self.df['Survived'] == 1)
+        self.assertTrue((result.loc[group & is_null, 'Age'] == 20).all())
+        with self.assertRaises(ValueError):
+            GroupImputer(keys=['Pclass'], cols=['Embarked'], stat='mode', truncate=True)
+
+    def test_mode_and_unseen(self):
+        imputer = GroupImputer(keys=['Pclass'], cols=['Embarked'], stat='mode').fit(self.df)
+        x = pd.DataFrame({'Pclass': [1, 9], 'Embarked': [None, None]})
+        self.assertEqual(list(imputer.transform(x)['Embarked']), ['S', 'S'])
+
+    def test_save(self):
+        imputer = GroupImputer(keys=['Pclass'], cols=['Age']).fit(self.df)
+        with tempfile.TemporaryDirectory() as tmp:
+            imputer.save(tmp + '/imputer.pkl')
+            loaded = GroupImputer.load(tmp + '/imputer.pkl')
+        pd.testing.assert_frame_equal(loaded.transform(self.df), imputer.transform(self.df))
+
+
+class TestCrossValidation(unittest.TestCase):
+
+    def test_learn(self):
+        df = pd.read_csv(path + '/data/Survived.csv')
+        df['Age'] = df['Age'].fillna(df['Age'].median())
+        x = df[['Pclass', 'Age', 'SibSp', 'Parch', 'Fare']]
+        y = df['Survived']
+        result = cross_validate_learn(x, y, depth=5, cv=5, n_repeats=2)
+        self.assertEqual(result['n_splits'], 10)
+        expected = cross_val_score(
+            tree.DecisionTreeClassifier(max_depth=5, random_state=0, class_weight='balanced'),
+            x, y, cv=RepeatedStratifiedKFold(n_splits=5, n_repeats=2, random_state=0))
+        np.testing.assert_allclose(result['test_scores'], expected)
+        self.assertEqual(result['test_score'], round(expected.mean(), 3))
+        self.assertEqual(result['test_score_std'], round(expected.std(), 3))
+        self.assertEqual(cross_validate_learn(x, y, depth=5, cv=5, n_repeats=2, n_jobs=1)['test_scores'],
+                         result['test_scores'])
+
+    def test_learn_with_std(self):
+        df = pd.read_csv(path + '/data/Boston.csv').fillna(0)
+        x = df[['RM', 'LSTAT', 'PTRATIO']]
+        t = df[['PRICE']]
+        result = cross_validate_learn_with_std(x, t, cv=4)
+        self.assertEqual(result['n_splits'], 4)
+        self.assertIn('time', result)
+        expected = cross_val_score(make_pipeline(StandardScaler(), LinearRegression()), x, t,
+                                   cv=RepeatedKFold(n_splits=4, n_repeats=1, random_state=0))
+        np.testing.assert_allclose(result['test_scores'], expected)
+        self.assertAlmostEqual(result['test_score'], expected.mean())
+        self.assertEqual(len(learn_with_std(x, t)), 2)
+
+
+class TestStreamingRegression(unittest.TestCase):
+
+    def test_standardized(self):
+        df = pd.read_csv(path + '/data/Boston.csv').fillna(0)
+        x = df[['RM', 'LSTAT', 'PTRATIO']].copy()
+        x['RM2'] = x['RM'] ** 2
+        t = df[['PRICE']]
+        sc_x = StandardScaler().fit(x)
+        sc_y = StandardScaler().fit(t)
+        expected = LinearRegression().fit(sc_x.transform(x), sc_y.transform(t))
+
+        first = StreamingRegression()
+        for i in range(0, 63, 7):
+            first.partial_fit(x[i:i + 7], t[i:i + 7])
+        second = StreamingRegression()
+        for i in range(63, 100, 9):
+            second.partial_fit(x[i:i + 9], t[i:i + 9])
+        model = first.merge(second).model(standardize=True)
+        result_x, result_y = first.scalers()
+
+        np.testing.assert_allclose(result_x.mean_, sc_x.mean_)
+        np.testing.assert_allclose(result_x.scale_, sc_x.scale_)
+        np.testing.assert_allclose(result_y.scale_, sc_y.scale_)
+        np.testing.assert_allclose(model.coef_, expected.coef_)
+        np.testing.assert_allclose(
+            model.predict(result_x.transform(x)), expected.predict(sc_x.transform(x)))
+
+    def test_fit_csv(self):
+        cols = ['SNS1', 'SNS2', 'actor', 'original']
+        df = pd.read_csv(path + '/data/cinema.csv').dropna()
+        expected = LinearRegression().fit(df[cols], df['sales'])
+        model = StreamingRegression().fit_csv(
+            path + '/data/cinema.csv', cols, 'sales', chunksize=13).model()
+        np.testing.assert_allclose(model.coef_, expected.coef_)
+        self.assertAlmostEqual(model.intercept_, expected.intercept_)
+
+
+class TestIncrementalTrainer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cinema(self):
+        # 学習スクリプトと同じ前処理・分割の訓練データを追加すると保存済みのモデルと一致する
+        df = pd.read_csv(path + '/data/cinema.csv')
+        outliers = OutlierFilter.load(path + '/model/cinema_outliers.json')
+        df3 = outliers.fit_transform(df.fillna(df.mean()))
+        x_train, _ = train_test_split(df3, test_size=0.2, random_state=0)
+        imputer = GroupImputer(keys=[], cols=['SNS1', 'SNS2', 'actor', 'original', 'sales'], stat='mean').fit(df)
+        train = df.loc[x_train.index]
+        IncrementalTrainer('cinema', self.tmp.name, imputer=imputer).update(train[:40]).publish()
+        trainer = IncrementalTrainer('cinema', self.tmp.name).update(train[40:])
+        version = trainer.publish()
+        with open(path + '/model/cinema.pkl', 'rb') as f:
+            expected = pickle.load(f)
+        np.testing.assert_allclose(trainer.state.model().coef_, expected.coef_, rtol=1e-8)
+        self.assertAlmostEqual(Cinema(directory=trainer.current()).predict([[291, 1044, 8808.994, 0]])[0],
+                               9632.416575385569, places=6)
+        self.assertTrue(trainer.verify(train))
+        self.assertFalse(trainer.verify(train[:40]))
+        self.assertEqual(trainer.current(), os.path.realpath(version))
+
+    def test_boston(self):
+        df = pd.read_csv(path + '/data/Boston.csv')
+        imputer = GroupImputer(keys=[], cols=['RM', 'LSTAT', 'PTRATIO', 'PRICE'], stat='mean').fit(df)
+        trainer = IncrementalTrainer('boston', self.tmp.name, imputer=imputer)
+        for i in range(0, 100, 30):
+            trainer.update(df[i:i + 30])
+        version = trainer.publish()
+        self.assertTrue(IncrementalTrainer('boston', self.tmp.name).verify(df))
+        self.assertTrue(os.path.exists(self.tmp.name + '/boston_state.pkl'))
+        for name in ('boston.pkl', 'boston_scx.pkl', 'boston_scy.pkl', 'boston_features.json'):
+            self.assertTrue(os.path.exists(version + '/' + name))
+        self.assertEqual(len(Boston(directory=trainer.current()).predict(6.5, 5.0, 15.0)), 1)
+
+        # バッチのTrainingPipeline（欠損値埋め→外れ値除外→特徴量→学習）と同じモデルになる
+        pipeline = TrainingPipeline(self.tmp.name + '/pipeline', workers=1)
+        pipeline.stage('load', load_boston)
+        pipeline.stage('impute', fill_mean, after='load')
+        pipeline.stage('outlier', drop_outliers, after='impute',
+                       rules=OutlierFilter.load(path + '/model/boston_outliers.json').rules)
+        pipeline.stage('fit', fit_boston, after='outlier')
+        expected = pipeline.run()['fit']
+        np.testing.assert_allclose(trainer.state.model(standardize=True).coef_, expected.coef_, rtol=1e-8)
+        self.assertLess(trainer.state.n, len(df))
+
+    def test_publish_swaps_version(self):
+        # 公開済みのバージョンのファイルは書き換えず、参照先だけを切り替える
+        df = pd.read_csv(path + '/data/Boston.csv')
+        trainer = IncrementalTrainer('boston', self.tmp.name, keep=2)
+        first = trainer.update(df[:60]).publish()
+        with open(first + '/boston.pkl', 'rb') as f:
+            published = f.read()
+        second = trainer.update(df[60:]).publish()
+        self.assertNotEqual(first, second)
+        self.assertEqual(trainer.current(), os.path.realpath(second))
+        with open(first + '/boston.pkl', 'rb') as f:
+            self.assertEqual(f.read(), published)
+        trainer.update(df[:10]).publish()
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(len(os.listdir(self.tmp.name + '/versions')), 2)
+
+
+class TestTrainingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        df = pd.read_csv(path + '/data/Survived.csv')
+        df['Age'] = df['Age'].fillna(df['Age'].median())
+        self.x = df[['Pclass', 'Age', 'SibSp', 'Parch', 'Fare']]
+        self.y = df['Survived']
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cached(self):
+        cache = TrainingCache(self.tmp.name)
+        cached_learn = cache.cached(learn)
+        s1, s2, _ = cached_learn(self.x, self.y, depth=3)
+        self.assertEqual(cached_learn(self.x, self.y, depth=3)[:2], (s1, s2))
+        cached_learn(self.x, self.y, depth=4)
+        cached_learn(self.x[['Pclass', 'Age']], self.y, depth=3)
+        x = self.x.copy()
+        x.loc[0, 'Age'] = 99
+        cached_learn(x, self.y, depth=3)
+        report = cache.report()
+        self.assertEqual((report['hits'], report['misses'], report['entries']), (1, 4, 4))
+
+        other = TrainingCache(self.tmp.name)
+        self.assertEqual(other.cached(learn)(self.x, self.y, depth=3)[:2], (s1, s2))
+        self.assertEqual(other.report()['hits'], 1)
+
+    def test_fit(self):
+        cache = TrainingCache(self.tmp.name)
+        model = cache.fit(LinearRegression(), self.x, self.y)
+        self.assertEqual(list(cache.fit(LinearRegression(), self.x, self.y).coef_),
+                         list(model.coef_))
+        cache.fit(LinearRegression(fit_intercept=False), self.x, self.y)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_evict(self):
+        cache = TrainingCache(self.tmp.name, max_bytes=1)
+        cache.cached(learn)(self.x, self.y, depth=3)
+        self.assertEqual(cache.report()['entries'], 0)
+
+    def test_removed_by_other_process(self):
+        from unittest import mock
+
+        cache = TrainingCache(self.tmp.name, max_bytes=1)
+        with mock.patch('domain.os.remove', side_effect=FileNotFoundError):
+            cache.cached(learn)(self.x, self.y, depth=3)
+        with mock.patch('domain.os.stat', side_effect=FileNotFoundError):
+            self.assertEqual(cache.report()['entries'], 0)
+
+    def test_key_nested_params(self):
+        # list/tuple/dictの中のデータフレームや値もキーに反映し、ハッシュできない型はエラー
+        cache = TrainingCache(self.tmp.name)
+        x = self.x.copy()
+        x.loc[0, 'Age'] = 99
+        rules = {'Age': {'rule': 'iqr', 'k': 1.5}}
+        key = cache.key('f', ([self.x, self.y],), {'rules': rules})
+        self.assertEqual(key, cache.key('f', ([self.x, self.y],), {'rules': dict(rules)}))
+        self.assertNotEqual(key, cache.key('f', ([x, self.y],), {'rules': rules}))
+        self.assertNotEqual(key, cache.key('f', ([self.x, self.y],), {'rules': {'Age': {'rule': 'iqr', 'k': 3.0}}}))
+        self.assertNotEqual(cache.key('f', (['1'],), {}), cache.key('f', ([1],), {}))
+        with self.assertRaises(TypeError):
+            cache.key('f', ([object()],), {})
+
+    def test_source_includes_callees(self):
+        from domain import _source
+
+        source = _source(learn)
+        self.assertIn('def _tree_model(', source)
+        self.assertNotIn('def learn_with_std(', source)
+        self.assertIn('def _cross_validate(', _source(cross_validate_learn))
+
+
+def load_boston():
+    return pd.read_csv(path + '/data/Boston.csv')
+
+
+def fill_mean(df):
+    return df.fillna(df.mean(numeric_only=True))
+
+
+def select(df, cols):
+    return df[cols], df[['PRICE']]
+
+
+def fit_std(data):
+    return learn_with_std(*data)
+
+
+def drop_outliers(df, rules):
+    return OutlierFilter(rules).fit_transform(df)
+
+
+def fit_boston(df):
+    x, t = BOSTON_FEATURES.frame(df), df[['PRICE']]
+    return LinearRegression().fit(StandardScaler().fit_transform(x), StandardScaler().fit_transform(t))
+
+
+class TestTrainingPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def pipeline(self, take2):
+        pipeline = TrainingPipeline(self.tmp.name)
+        pipeline.stage('load', load_boston)
+        pipeline.stage('impute', fill_mean, after='load')
+        pipeline.stage('take1', select, after='impute', cols=['RM', 'LSTAT', 'PTRATIO'])
+        pipeline.stage('take2', select, after='impute', cols=take2)
+        pipeline.stage('fit1', fit_std, after='take1')
+        pipeline.stage('fit2', fit_std, after='take2')
+        return pipeline
+
+    def test_run(self):
+        pipeline = self.pipeline(['RM', 'LSTAT', 'PTRATIO', 'INDUS'])
+        result = pipeline.run()
+        self.assertEqual(list(result), ['fit1', 'fit2'])
+        self.assertEqual(set(pipeline.status.values()), {'computed'})
+        df = fill_mean(load_boston())
+        self.assertEqual(result['fit2'], learn_with_std(*select(df, ['RM', 'LSTAT', 'PTRATIO', 'INDUS'])))
+
+        pipeline = self.pipeline(['RM', 'LSTAT', 'PTRATIO', 'INDUS'])
+        self.assertEqual(pipeline.run(), result)
+        self.assertEqual(set(pipeline.status.values()), {'cached'})
+
+        pipeline = self.pipeline(['RM', 'LSTAT', 'PTRATIO', 'NOX'])
+        pipeline.run()
+        self.assertEqual([name for name, status in pipeline.status.items() if status == 'computed'],
+                         ['take2', 'fit2'])
+
+    def test_file_changed(self):
+        import shutil
+
+        file = self.tmp.name + '/Boston.csv'
+        shutil.copy(path + '/data/Boston.csv', file)
+        pipeline = TrainingPipeline(self.tmp.name + '/pipeline')
+        pipeline.stage('load', pd.read_csv, filepath_or_buffer=file)
+        pipeline.stage('other', load_boston, depends_on=file)
+        pipeline.run()
+        pipeline.run()
+        self.assertEqual(pipeline.status, {'load': 'cached', 'other': 'cached'})
+
+        keys = pipeline.keys()
+        with open(file, 'a') as f:
+            f.write('0,0,0,0,0,0,0,0,0,0,0,0,0,0\n')
+        pipeline.run()
+        self.assertEqual(pipeline.status, {'load': 'computed', 'other': 'computed'})
+        self.assertNotEqual(pipeline.keys(), keys)
+        self.assertEqual(len(pipeline.run()['load']), 101)
+
+    def test_evict(self):
+        pipeline = self.pipeline(['RM', 'LSTAT', 'PTRATIO', 'INDUS'])
+        pipeline.run()
+        pipeline = self.pipeline(['RM', 'LSTAT', 'PTRATIO', 'NOX'])
+        pipeline.max_bytes = 1
+        pipeline.run()
+        # 今回の段階の結果だけが残る
+        files = {f'{key}.pkl' for key in pipeline.keys().values()}
+        self.assertEqual(set(os.listdir(self.tmp.name)), files)
+
+    def test_unknown_stage(self):
+        with self.assertRaises(ValueError):
+            TrainingPipeline(self.tmp.name).stage('impute', fill_mean, after='load')
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        df = pd.read_csv(path + '/data/Survived.csv')
+        df['Age'] = df['Age'].fillna(df['Age'].median())
+        self.x = df[['Pclass', 'Age', 'SibSp', 'Parch', 'Fare']]
+        self.y = df['Survived']
+
+    def test_tree(self):
+        result = sweep(self.x, self.y, grid={'depth': [1, 2, 3]}, workers=2)
+        self.assertEqual(list(result['depth']), [1, 2, 3])
+        for _, row in result.iterrows():
+            s1, s2, _ = learn(self.x, self.y, depth=row['depth'])
+            self.assertEqual((row['train_score'], row['test_score']), (s1, s2))
+        self.assertTrue((result['fit_time'] > 0).all())
+
+    def test_features(self):
+        features = {'Take1': ['Pclass', 'Age'], 'Take2': ['Pclass', 'Age', 'Fare']}
+        result = sweep(self.x, self.y, grid={'depth': [2, 4]},
+                       features=features, workers=1)
+        self.assertEqual(list(result['features']),
+                         ['Take1', 'Take1', 'Take2', 'Take2'])
+
+    def test_linear(self):
+        df = pd.read_csv(path + '/data/Boston.csv').fillna(0)
+        x = df[['RM', 'LSTAT', 'PTRATIO', 'INDUS']]
+        t = df[['PRICE']]
+        features = {'Take0': ['RM', 'LSTAT', 'PTRATIO'],
+                    'Take1': ['RM', 'LSTAT', 'PTRATIO', 'INDUS']}
+        result = sweep(x, t, features=features, learner='linear', workers=2)
+        s1, s2 = learn_with_std(x, t)
+        self.assertAlmostEqual(result['train_score'][1], s1)
+        self.assertAlmostEqual(result['test_score'][1], s2)
+
+
+class TestLearnPruningPath(unittest.TestCase):
+
+    def test_matches_refit(self):
+        df = pd.read_csv(path + '/data/Survived.csv')
+        df['Age'] = df['Age'].fillna(df['Age'].median())
+        x = df[['Pclass', 'Age', 'SibSp', 'Parch', 'Fare']]
+        y = df['Survived']
+        table = learn_pruning_path(x, y)
+        self.assertEqual(table['ccp_alpha'][0], 0.0)
+        self.assertEqual(table['n_leaves'].iloc[-1], 1)
+
+        for _, row in table.iterrows():
+            s1, s2, model = learn(x, y, depth=None, ccp_alpha=row['ccp_alpha'])
+            self.assertEqual(row['train_score'], s1)
+            self.assertEqual(row['test_score'], s2)
+            self.assertEqual(row['depth'], model.get_depth())
+            self.assertEqual(row['n_leaves'], model.get_n_leaves())
+
+    def test_sklearn_path(self):
+        from sklearn import tree
+        from domain import _pruning_steps
+
+        df = pd.read_csv(path + '/data/Survived.csv')
+        x = df[['Pclass', 'SibSp', 'Parch', 'Fare']]
+        model = tree.DecisionTreeClassifier(random_state=0, class_weight='balanced').fit(x, df['Survived'])
+        steps, parent = _pruning_steps(model.tree_)
+        path_alphas = model.cost_complexity_pruning_path(x, df['Survived']).ccp_alphas
+        self.assertEqual(len(steps), len(path_alphas) - 1)
+        self.assertEqual(steps[-1], 0)
+
+
+class TestDatasetProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(path + '/data/Survived.csv')
+
+    def test_profile_csv(self):
+        profile = profile_csv(path + '/data/Survived.csv', chunksize=100)
+        expected = self.df.describe()
+        result = profile.describe()
+        for row in ['count', 'mean', 'std', 'min', 'max', '50%']:
+            np.testing.assert_allclose(result.loc[row], expected.loc[row])
+        np.testing.assert_allclose(profile.corr(), self.df.select_dtypes('number').corr(), atol=1e-12)
+
+        info = profile.info()
+        self.assertEqual(info['null'].to_dict(), self.df.isnull().sum().to_dict())
+        for c in ['Sex', 'Pclass', 'Embarked', 'Fare', 'Ticket']:
+            self.assertAlmostEqual(info['cardinality'][c], self.df[c].nunique(), delta=self.df[c].nunique() * 0.05)
+        self.assertEqual(profile.value_counts('Embarked').to_dict(), self.df['Embarked'].value_counts().to_dict())
+
+    def test_merge(self):
+        half = len(self.df) // 2
+        merged = DatasetProfile().partial_fit(self.df[:half]).merge(
+            DatasetProfile(random_state=1).partial_fit(self.df[half:]))
+        whole = DatasetProfile().partial_fit(self.df)
+        pd.testing.assert_frame_equal(merged.info(), whole.info())
+        pd.testing.assert_frame_equal(merged.describe(), whole.describe())
+        pd.testing.assert_series_equal(merged.value_counts('Sex'), whole.value_counts('Sex'))
+        np.testing.assert_allclose(merged.corr(), whole.corr())
+
+    def test_parallel(self):
+        profile = profile_csv(path + '/data/Survived.csv', chunksize=50, workers=2)
+        np.testing.assert_allclose(profile.corr(), self.df.select_dtypes('number').corr(), atol=1e-12)
+        self.assertEqual(profile.rows, len(self.df))
+
+    def test_corr_offset(self):
+        # 平均が標準偏差に比べて非常に大きい列でも桁落ちしない
+        rng = np.random.default_rng(0)
+        a = 1e9 + rng.standard_normal(10000)
+        df = pd.DataFrame({'a': a, 'b': a + rng.standard_normal(10000), 'c': rng.standard_normal(10000)})
+        df.loc[::7, 'b'] = np.nan
+        profile = DatasetProfile()
+        for i in range(0, len(df), 999):
+            profile.partial_fit(df[i:i + 999])
+        # 1e9を引く操作は誤差がないため、引いた後の相関係数を正解とする
+        expected = (df - [1e9, 1e9, 0]).corr()
+        np.testing.assert_allclose(profile.corr(), expected, atol=1e-12)
+
+
+class TestHistTreeClassifier(unittest.TestCase):
+
+    def setUp(self):
+        df = pd.read_csv(path + '/data/Survived.csv')
+        df = GroupImputer(keys=['Pclass', 'Survived'], cols=['Age']).fit_transform(df)
+        self.x = SURVIVED_FEATURES.frame(df)
+        self.y = df['Survived']
+
+    def test_learn_depths(self):
+        results = learn_depths(self.x, self.y, depths=range(1, 7))
+        self.assertEqual([r[0] for r in results], list(range(1, 7)))
+        for depth, s1, s2, model in results:
+            self.assertEqual(s1, learn(self.x, self.y, depth=depth)[0])
+            self.assertEqual(model.model_.n_iter_, 1)
+
+    def test_predict(self):
+        s1, s2, model = learn(self.x, self.y, depth=5, learner='hist')
+        self.assertGreater(s2, 0.8)
+        with tempfile.TemporaryDirectory() as directory:
+            file = directory + '/survived.pkl'
+            with open(file, 'wb') as f:
+                pickle.dump(model, f)
+            with open(file, 'rb') as f:
+                loaded = pickle.load(f)
+        x = self.x.copy()
+        x.loc[0, 'Age'] = np.nan
+        np.testing.assert_array_equal(loaded.predict(x), model.predict(x.to_numpy()))
+        self.assertTrue(set(model.predict(x)) <= {0, 1})
+
+    def test_compare(self):
+        result = compare_tree_learners(self.x, self.y, sizes=(1000, 2000), depth=3, threads=1)
+        self.assertEqual(len(result), 4)
+        self.assertEqual(list(result['learner']), ['exact', 'hist', 'exact', 'hist'])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            HistTreeClassifier().fit(self.x, np.arange(len(self.x)) % 3)
+        with self.assertRaises(ValueError):
+            learn(self.x, self.y, ccp_alpha=0.01, learner='hist')
+
+    def test_explain_and_export(self):
+        # 寄与の計算とONNXへの変換は決定木のモデルだけが対象
+        _, _, model = learn(self.x, self.y, depth=5, learner='hist')
+        with tempfile.TemporaryDirectory() as directory:
+            with open(directory + '/survived.pkl', 'wb') as f:
+                pickle.dump(model, f)
+            shutil.copy(path + '/model/survived_features.json', directory)
+            survived = Survived(directory=directory)
+            self.assertEqual(survived.predict([[3, 22, 1, 0, 7.25, 'male']]).shape, (1,))
+            with self.assertRaisesRegex(ValueError, 'HistTreeClassifier'):
+                survived.explain([[3, 22, 1, 0, 7.25, 'male']])
+            with self.assertRaisesRegex(ValueError, 'HistTreeClassifier'):
+                export_onnx('survived', directory)
+
+
+class TestOnnxBackend(unittest.TestCase):
+
+    def test_predict(self):
+        self.assertEqual(Iris(backend='onnx').predict([[1.4, 2.3, 4.4, 2.3]])[0], "Iris-virginica")
+        self.assertAlmostEqual(Cinema(backend='onnx').predict([[291, 1044, 8808.994, 0]])[0], 9632.416575385569)
+        self.assertEqual(Survived(backend='onnx').predict([[3, 22, 1, 0, 7.25, 'male']])[0], 0)
+        result = Boston(backend='onnx', threads=1).predict(3.561, 7.12, 20.2)
+        self.assertAlmostEqual(result[0][0], 0.21583895618321347)
+
+    def test_export(self):
+        df = pd.read_csv(path + '/data/Survived.csv')
+        df['Age'] = df['Age'].fillna(df['Age'].median())
+        x = SURVIVED_FEATURES.transform(df)
+        boston = pd.read_csv(path + '/data/Boston.csv')[['RM', 'LSTAT', 'PTRATIO']].to_numpy()
+        with tempfile.TemporaryDirectory() as directory:
+            for file in ['survived.pkl', 'survived_features.json', 'boston.pkl', 'boston_scx.pkl',
+                         'boston_scy.pkl', 'boston_features.json']:
+                shutil.copy(path + '/model/' + file, directory)
+            # 変換は指定したディレクトリのモデルとスケーラーから行う
+            with open(directory + '/boston_scx.pkl', 'rb') as f:
+                scaler = pickle.load(f)
+            scaler.mean_ = scaler.mean_ + 1
+            with open(directory + '/boston_scx.pkl', 'wb') as f:
+                pickle.dump(scaler, f)
+            survived = OnnxModel(export_onnx('survived', directory))
+            np.testing.assert_array_equal(survived.predict(x), Survived().model.predict(x))
+            result = OnnxModel(export_onnx('boston', directory)).predict(boston)
+            expected = Boston(directory=directory).predict(*boston.T)
+        np.testing.assert_allclose(result, expected)
+        self.assertFalse(np.allclose(result, Boston().predict(*boston.T)))
+
+    def test_compare_backends(self):
+        result = compare_backends(batch_sizes=(1, 64), rows=64)
+        self.assertEqual(len(result), 4 * 2 * 2)
+        self.assertTrue((result['rows_per_sec'] > 0).all())
+
+
+class TestExplain(unittest.TestCase):
+
+    def test_survived(self):
+        df = pd.read_csv(path + '/data/Survived.csv')
+        df['Age'] = df['Age'].fillna(df['Age'].median())
+        x = SURVIVED_FEATURES.frame(df)
+        survived = Survived()
+        result = survived.explain(df)
+        self.assertEqual(list(result.columns), ['bias', 'Pclass', 'Age', 'SibSp', 'Parch', 'Fare', 'male'])
+        np.testing.assert_allclose(result.sum(axis=1), survived.model.predict_proba(x)[:, 1], atol=1e-12)
+        self.assertEqual(result['bias'].nunique(), 1)
+
+    def test_cinema(self):
+        cinema = Cinema()
+        x = [[291, 1044, 8808.994, 0], [150, 2000, 500, 1]]
+        result = cinema.explain(x)
+        np.testing.assert_allclose(result.sum(axis=1), cinema.predict(x))
+
+    def test_boston(self):
+        boston = Boston()
+        rm = np.array([3.561, 5.95])
+        lstat = np.array([7.12, 27.71])
+        ptratio = np.array([20.2, 21])
+        result = boston.explain(rm, lstat, ptratio)
+        self.assertEqual(list(result.columns), ['bias'] + BOSTON_FEATURES.names)
+        np.testing.assert_allclose(result.sum(axis=1), boston.predict(rm, lstat, ptratio)[:, 0])
+
+    def test_onnx(self):
+        with self.assertRaises(ValueError):
+            Survived(backend='onnx').explain([[3, 22, 1, 0, 7.25, 'male']])
+
+
+class TestDriftMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.monitor = drift_monitors()['survived']
+        df = pd.read_csv(path + '/data/Survived.csv')
+        df = GroupImputer(keys=['Pclass', 'Survived'], cols=['Age'], stat='mean', truncate=True).fit_transform(df)
+        self.x = SURVIVED_FEATURES.transform(df)
+
+    def test_stable(self):
+        for row in self.x:
+            self.monitor.update(row)
+        scores = self.monitor.scores()
+        self.assertEqual(scores['Age']['count'], len(self.x))
+        self.assertEqual(scores['Age']['missing_rate'], 0.0)
+        self.assertEqual(scores['Age']['baseline_missing_rate'], 0.0)
+        for name in self.monitor.names:
+            self.assertLess(scores[name]['psi'], 1e-9)
+
+    def test_observed_rows(self):
+        # 欠損のない行だけを入力しても欠損の区間でずれにならない
+        df = pd.read_csv(path + '/data/Survived.csv').dropna(subset=['Age'])
+        self.monitor.update(SURVIVED_FEATURES.transform(df))
+        self.assertLess(self.monitor.scores()['Age']['psi'], 0.25)
+
+    def test_drift(self):
+        sizes = [len(c) for c in self.monitor.counts]
+        self.monitor.update(self.x[self.x[:, 5] == 1])
+        self.monitor.update(self.x[self.x[:, 5] == 1])
+        scores = self.monitor.scores()
+        self.assertGreater(scores['male']['psi'], 0.25)
+        self.assertLess(scores['Pclass']['psi'], 0.1)
+        self.assertEqual([len(c) for c in self.monitor.counts], sizes)
+
+        self.monitor.reset()
+        self.assertIsNone(self.monitor.scores()['male']['psi'])
+
+
+class TestOutlierFilter(unittest.TestCase):
+
+    def setUp(self):
+        df = pd.read_csv(path + '/data/cinema.csv')
+        self.df = df.fillna(df.mean())
+
+    def test_expr(self):
+        outliers = OutlierFilter([{'name': 'cinema', 'method': 'expr', 'expr': 'SNS2 > 1000 and sales < 8500'}])
+        result = outliers.fit_transform(self.df)
+        expected = self.df.drop(self.df[(self.df['SNS2'] > 1000) & (self.df['sales'] < 8500)].index)
+        pd.testing.assert_frame_equal(result, expected)
+        self.assertEqual(outliers.report(), {'rows': 100, 'dropped': {'cinema': 1}, 'dropped_total': 1})
+
+    def test_iqr_mad(self):
+        outliers = OutlierFilter([{'method': 'iqr', 'col': 'SNS1', 'k': 1.0},
+                                  {'method': 'mad', 'col': 'SNS1', 'k': 2.0}]).fit(self.df)
+        q1, q3 = self.df['SNS1'].quantile([0.25, 0.75])
+        self.assertAlmostEqual(outliers.rules[0]['upper'], q3 + (q3 - q1))
+        median = self.df['SNS1'].median()
+        mad = (self.df['SNS1'] - median).abs().median()
+        self.assertAlmostEqual(outliers.rules[1]['upper'], median + 2.0 * 1.4826 * mad)
+
+        result = outliers.transform(self.df)
+        report = outliers.report()
+        self.assertEqual(report['dropped_total'], len(self.df) - len(result))
+        self.assertEqual(set(report['dropped']), {'iqr(SNS1)', 'mad(SNS1)'})
+        self.assertTrue(result['SNS1'].between(outliers.rules[0]['lower'], outliers.rules[0]['upper']).all())
+
+    def test_mad_zero(self):
+        # 中央絶対偏差が0の列は四分位範囲を尺度にし、それも0ならルールを適用しない
+        df = pd.DataFrame({'a': [5.0] * 6 + [6.0, 7.0, 8.0, 100.0], 'b': [1.0] * 9 + [2.0]})
+        outliers = OutlierFilter([{'method': 'mad', 'col': 'a'}, {'method': 'mad', 'col': 'b'}]).fit(df)
+        q1, q3 = df['a'].quantile([0.25, 0.75])
+        self.assertAlmostEqual(outliers.rules[0]['upper'], 5.0 + 3.5 * (q3 - q1) / 1.349)
+        self.assertIsNone(outliers.rules[1]['lower'])
+        result = outliers.transform(df)
+        self.assertEqual(list(result['a']), [5.0] * 6 + [6.0, 7.0, 8.0])
+        self.assertEqual(outliers.report()['dropped'], {'mad(a)': 1, 'mad(b)': 0})
+        with tempfile.TemporaryDirectory() as tmp:
+            outliers.save(tmp + '/outliers.json')
+            self.assertEqual(len(OutlierFilter.load(tmp + '/outliers.json').transform(df)), 9)
+
+    def test_chunks(self):
+        outliers = OutlierFilter([{'method': 'iqr', 'col': 'sales'},
+                                  {'method': 'expr', 'expr': 'SNS2 > 1000 and sales < 8500'}]).fit(self.df)
+        expected = outliers.transform(self.df)
+        with tempfile.TemporaryDirectory() as directory:
+            outliers.save(directory + '/outliers.json')
+            loaded = OutlierFilter.load(directory + '/outliers.json')
+        chunks = (self.df[i:i + 30] for i in range(0, len(self.df), 30))
+        result = pd.concat(loaded.transform_chunks(chunks))
+        pd.testing.assert_frame_equal(result, expected)
+        self.assertEqual(loaded.report(), outliers.report())
+
+
+class TestSyntheticData(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.read_csv(path + '/data/Survived.csv')
+        self.synthetic = SyntheticData().fit(self.df)
+
+    def test_sample(self):
+        result = self.synthetic.sample(20000, seed=1)
+        self.assertEqual(list(result.columns), list(self.df.columns))
+        self.assertTrue((result.dtypes == self.df.dtypes).all())
+        self.assertEqual(list(result['PassengerId'][:3]), [1, 2, 3])
+        for c in ['Age', 'Cabin', 'Embarked']:
+            self.assertAlmostEqual(result[c].isnull().mean(), self.df[c].isnull().mean(), delta=0.01)
+        self.assertTrue(set(result['Embarked'].dropna()) <= set(self.df['Embarked'].dropna()))
+        self.assertAlmostEqual(result['Sex'].eq('male').mean(), self.df['Sex'].eq('male').mean(), delta=0.01)
+        # 性別と生存、客室等級と運賃の関係が保たれる
+        survived = result.groupby('Sex')['Survived'].mean()
+        self.assertGreater(survived['female'] - survived['male'], 0.4)
+        fare = result.groupby('Pclass')['Fare'].median()
+        self.assertTrue(fare.is_monotonic_decreasing)
+        pd.testing.assert_frame_equal(self.synthetic.sample(100, seed=1), result[:100])
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            report = self.synthetic.write(directory + '/serial.csv', 2500, seed=2, chunksize=1000)
+            self.synthetic.write(directory + '/parallel.csv', 2500, seed=2, chunksize=1000, workers=2)
+            self.synthetic.write(directory + '/parallel.parquet', 2500, seed=2, chunksize=1000,
+                                 workers=2, format='parquet')
+            serial = pd.read_csv(directory + '/serial.csv')
+            pd.testing.assert_frame_equal(pd.read_csv(directory + '/parallel.csv'), serial)
+            pd.testing.assert_frame_equal(pd.read_parquet(directory + '/parallel.parquet'), serial)
+
+            self.synthetic.save(directory + '/synthetic.pkl')
+            loaded = SyntheticData.load(directory + '/synthetic.pkl')
+        self.assertEqual(report['rows'], 2500)
+        self.assertEqual(serial['PassengerId'].iloc[-1], 2500)
+        self.assertEqual(len(set(serial['PassengerId'])), 2500)
+        pd.testing.assert_frame_equal(loaded.sample(1000, seed=2, start=1000),
+                                      pd.concat(self.synthetic.chunks(2000, seed=2, chunksize=1000))
+                                      .iloc[1000:].reset_index(drop=True))
+        with self.assertRaises(ValueError):
+            self.synthetic.write(directory + '/synthetic.json', 10, format='json')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -11,9 +11,11 @@ from typing import Any
 import unittest
 import doctest
 import os
-from domain import CategoricalData, DataVisualization, convert_categoricals
+from domain import CategoricalData, DataVisualization, convert_categoricals, export_onnx
 from app.repository import CSVRepository, SQLRepository
 
+# 環境変数VISUALIZATION=0でグラフの描画を省略する
+VISUALIZTION = os.environ.get('VISUALIZATION', '1') != '0'
 path = os.path.dirname(os.path.abspath(__file__))
 # repo = SQLRepository(table='Iris')
 repo = CSVRepository(file=path + '/data/iris.csv')
@@ -85,7 +87,8 @@ species = CategoricalData(df, 'species')
 species.show()
 
 # %%
-species.plot()
+if VISUALIZTION:
+    species.plot()
 
 # %% [markdown]
 # ### 種類カテゴリの数値変換
@@ -94,7 +97,8 @@ species.plot()
 categorical_cols = ['species']
 df_conv = convert_categoricals(df, categorical_cols)
 conv_species = CategoricalData(df_conv, 'species')
-conv_species.plot()
+if VISUALIZTION:
+    conv_species.plot()
 
 # %% [markdown]
 # ### ピボットテーブルによる集計
@@ -119,8 +123,9 @@ df_dummy
 # ### データの可視化
 
 # %%
-dv = DataVisualization(df)
-dv.df_all('species')
+if VISUALIZTION:
+    dv = DataVisualization(df)
+    dv.df_all('species')
 
 # %% [markdown]
 # # 分析の実施
@@ -239,6 +244,7 @@ model.score(x_test, y_test)
 # %%
 with open(path + '/model/iris.pkl', 'wb') as f:
     pickle.dump(model, f)
+export_onnx('iris')
 
 # %% [markdown]
 # ## 決定木における特徴量の考察
@@ -266,7 +272,8 @@ model.classes_
 # ### 決定木の可視化
 # %%
 
-plot_tree(model, feature_names=xcol, class_names=model.classes_, filled=True)
+if VISUALIZTION:
+    plot_tree(model, feature_names=xcol, class_names=model.classes_, filled=True)
 
 
 # %%
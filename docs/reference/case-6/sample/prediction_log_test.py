@@ -0,0 +1,91 @@
+import asyncio
+import glob
+import gzip
+import json
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+from app.prediction_log import PredictionLogWriter
+
+
+class TestPredictionLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_jsonl(self):
+        writer = PredictionLogWriter(self.tmp.name, batch_size=10, flush_interval=0.05,
+                                     max_records=25).start()
+        for i in range(60):
+            self.assertTrue(writer.log('survived', [3, 22, 1, 0, 7.25, i % 2], np.int64(i % 2)))
+        writer.stop()
+        stats = writer.stats()
+        self.assertEqual(stats['written'], 60)
+        self.assertEqual(stats['files'], 3)
+        self.assertGreaterEqual(stats['max_lag'], 0)
+
+        files = sorted(glob.glob(self.tmp.name + '/*.jsonl.gz'))
+        records = [json.loads(line) for f in files for line in gzip.open(f, 'rt')]
+        self.assertEqual([len(list(gzip.open(f, 'rt'))) for f in files], [25, 25, 10])
+        self.assertEqual(records[1]['inputs'], [3, 22, 1, 0, 7.25, 1])
+        self.assertEqual(records[1]['prediction'], 1)
+
+    def test_parquet(self):
+        import pandas as pd
+
+        writer = PredictionLogWriter(self.tmp.name, format='parquet', flush_interval=0.05).start()
+        writer.log('boston', [3.561, 7.12, 20.2], 0.21583895618321347)
+        writer.log('iris', [1, 2, 4, 2], 'Iris-virginica')
+        writer.stop()
+        df = pd.read_parquet(glob.glob(self.tmp.name + '/*.parquet')[0])
+        self.assertEqual(list(df['endpoint']), ['boston', 'iris'])
+        self.assertEqual(json.loads(df['prediction'][1]), 'Iris-virginica')
+
+    def test_drop(self):
+        writer = PredictionLogWriter(self.tmp.name, max_queue=5)
+        results = [writer.log('iris', [1, 2, 4, 2], 'Iris-virginica') for _ in range(8)]
+        self.assertEqual(results.count(False), 3)
+        writer.start()
+        writer.stop()
+        stats = writer.stats()
+        self.assertEqual(stats['dropped'], 3)
+        self.assertEqual(stats['written'], 5)
+
+    def test_block(self):
+        writer = PredictionLogWriter(self.tmp.name, max_queue=1, policy='block', block_timeout=0.01)
+        self.assertTrue(writer.log('iris', [1, 2, 4, 2], 'Iris-virginica'))
+        self.assertFalse(writer.log('iris', [1, 2, 4, 2], 'Iris-virginica'))
+        with self.assertRaises(ValueError):
+            PredictionLogWriter(self.tmp.name, policy='wait')
+        with self.assertRaises(ValueError):
+            PredictionLogWriter(self.tmp.name, policy='block')
+
+    def test_alog_does_not_block_loop(self):
+        # キューが空くのを待つ間もイベントループの他の処理は進む
+        writer = PredictionLogWriter(self.tmp.name, max_queue=1, policy='block', block_timeout=5)
+        writer.log('iris', [1, 2, 4, 2], 'Iris-virginica')
+        ticks = []
+
+        async def tick():
+            for _ in range(3):
+                ticks.append(writer.queue.qsize())
+                await asyncio.sleep(0.01)
+            threading.Thread(target=writer.queue.get).start()
+
+        async def main():
+            return await asyncio.gather(writer.alog('iris', [1, 2, 4, 2], 'Iris-virginica'), tick())
+
+        result, _ = asyncio.run(main())
+        self.assertTrue(result)
+        self.assertEqual(ticks, [1, 1, 1])
+        self.assertEqual(writer.stats()['enqueued'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
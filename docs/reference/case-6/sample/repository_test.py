@@ -0,0 +1,155 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from app.repository import CSVRepository, SQLBulkLoader, SQLRepository
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestSQLBulkLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.url = 'sqlite:///' + self.tmp.name + '/test.db'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_load(self):
+        loader = SQLBulkLoader(url=self.url, chunksize=100)
+        report = loader.load(path + '/data/Survived.csv', 'Survived')
+        self.assertEqual(report['rows'], 891)
+        self.assertGreater(report['rows_per_sec'], 0)
+
+        expected = CSVRepository(file=path + '/data/Survived.csv').get_data()
+        result = SQLRepository(table='Survived', url=self.url).get_data()
+        self.assertEqual(list(result.columns), list(expected.columns))
+        self.assertEqual(result['Age'].isnull().sum(), 177)
+        self.assertEqual(result['Cabin'].isnull().sum(), 687)
+        self.assertAlmostEqual(result['Fare'].sum(), expected['Fare'].sum())
+
+    def test_load_replace(self):
+        loader = SQLBulkLoader(url=self.url)
+        loader.load(path + '/data/iris.csv', 'Iris')
+        loader.load(path + '/data/iris.csv', 'Iris')
+        result = SQLRepository(table='Iris', url=self.url).get_data()
+        self.assertEqual(len(result), 150)
+
+    def test_load_all(self):
+        loader = SQLBulkLoader(url=self.url)
+        reports = loader.load_all(path + '/data')
+        tables = {r['table']: r['rows'] for r in reports}
+        self.assertEqual(
+            tables, {'Boston': 100, 'Survived': 891, 'Cinema': 100, 'Iris': 150})
+
+    def test_load_frames(self):
+        df = pd.read_csv(path + '/data/cinema.csv')
+        loader = SQLBulkLoader(url=self.url)
+        chunks = (df[i:i + 30] for i in range(0, len(df), 30))
+        report = loader.load_frames(chunks, 'Cinema', loader.infer_dtypes(path + '/data/cinema.csv'))
+        self.assertEqual(report['rows'], 100)
+        result = SQLRepository(table='Cinema', url=self.url).get_data()
+        self.assertEqual(result['sales'].sum(), df['sales'].sum())
+
+    def test_infer_dtypes_widen(self):
+        # 先頭のチャンクと後のチャンクで型が異なる列はすべての値を表せる型にする
+        file = self.tmp.name + '/mixed.csv'
+        rows = [f'{i},{i},True,,{i}' for i in range(10)] + ['1.5,x,1,3,10']
+        with open(file, 'w') as f:
+            f.write('\n'.join(['a,b,c,d,e'] + rows) + '\n')
+        loader = SQLBulkLoader(url=self.url, chunksize=4)
+        self.assertEqual(loader.infer_dtypes(file),
+                         {'a': 'float64', 'b': 'object', 'c': 'object', 'd': 'Int64', 'e': 'Int64'})
+        self.assertEqual(loader.infer_dtypes(file, nrows=8)['a'], 'Int64')
+        report = loader.load(file, 'Mixed')
+        self.assertEqual(report['rows'], 11)
+        result = SQLRepository(table='Mixed', url=self.url).get_data()
+        self.assertEqual(result['a'].iloc[-1], 1.5)
+        self.assertEqual(result['b'].iloc[-1], 'x')
+
+    def test_failed_load_keeps_table(self):
+        # 途中で失敗したときは作り直す前のテーブルが残る
+        loader = SQLBulkLoader(url=self.url)
+        loader.load(path + '/data/iris.csv', 'Iris')
+        df = pd.read_csv(path + '/data/iris.csv')
+
+        def chunks():
+            yield df[:50]
+            raise RuntimeError('broken chunk')
+
+        with self.assertRaises(RuntimeError):
+            loader.load_frames(chunks(), 'Iris', loader.infer_dtypes(path + '/data/iris.csv'))
+        self.assertEqual(len(SQLRepository(table='Iris', url=self.url).get_data()), 150)
+
+    def test_empty_string(self):
+        loader = SQLBulkLoader(url=self.url)
+        df = pd.DataFrame({'a': ['x', '', None], 'b': [1.5, None, 2.0]})
+        loader.load_frames([df], 'Strings', {'a': 'object', 'b': 'float64'})
+        result = SQLRepository(table='Strings', url=self.url).get_data()
+        self.assertEqual(list(result['a'][:2]), ['x', ''])
+        self.assertIsNone(result['a'][2])
+
+
+class TestPostgreSQLCopy(unittest.TestCase):
+
+    def copy(self, chunk, dtypes):
+        """COPYに渡すSQLと、PostgreSQLのcsv形式の規則で読み直したデータ"""
+        from sqlalchemy.dialects import postgresql
+
+        loader = SQLBulkLoader(url='postgresql://')
+        received = {}
+
+        def copy_expert(sql, buffer):
+            received['sql'] = sql
+            received['data'] = buffer.read()
+
+        cursor = mock.Mock()
+        cursor.copy_expert.side_effect = copy_expert
+        loader.insert(cursor, postgresql.dialect(), loader.table('T', dtypes), chunk)
+        null = received['sql'].split("NULL '")[1].split("'")[0]
+        result = pd.read_csv(io.StringIO(received['data']), header=None, names=list(chunk.columns),
+                             dtype=dtypes, na_values=[null], keep_default_na=False)
+        return received['sql'], result
+
+    def test_copy(self):
+        file = path + '/data/Survived.csv'
+        dtypes = SQLBulkLoader().infer_dtypes(file)
+        chunk = pd.read_csv(file, dtype=dtypes, nrows=20)
+        sql, result = self.copy(chunk, dtypes)
+        cols = ', '.join(f'"{c}"' for c in chunk.columns)
+        self.assertEqual(sql, f"COPY \"T\" ({cols}) FROM STDIN WITH (FORMAT csv, NULL '\\N')")
+        pd.testing.assert_frame_equal(result, chunk)
+
+    def test_null_and_empty_string(self):
+        # 空文字列は空文字列、欠損はNULLとしてSQLiteのexecutemanyと同じ値になる
+        chunk = pd.DataFrame({'a': ['x', '', None, '\\N'], 'b': [1.5, None, 2.0, 3.0]})
+        sql, result = self.copy(chunk, {'a': 'object', 'b': 'float64'})
+        self.assertIn("NULL '\\NN'", sql)
+        self.assertEqual(list(result['a'][:2]), ['x', ''])
+        self.assertTrue(pd.isna(result['a'][2]))
+        self.assertEqual(result['a'][3], '\\N')
+        self.assertTrue(pd.isna(result['b'][1]))
+
+    def test_rollback(self):
+        from sqlalchemy.dialects import postgresql
+
+        loader = SQLBulkLoader(url='postgresql://')
+        connection = mock.Mock()
+        connection.cursor.return_value.copy_expert.side_effect = RuntimeError('copy failed')
+        chunks = [pd.DataFrame({'a': [1, 2]})]
+        with self.assertRaises(RuntimeError):
+            loader.write(connection, postgresql.dialect(), loader.table('T', {'a': 'Int64'}), chunks, True)
+        connection.rollback.assert_called_once()
+        connection.commit.assert_not_called()
+        statements = [c.args[0] for c in connection.cursor.return_value.execute.call_args_list]
+        self.assertEqual([s.split('(')[0].strip() for s in statements],
+                         ['DROP TABLE IF EXISTS "T"', 'CREATE TABLE "T"'])
+
+
+if __name__ == '__main__':
+    unittest.main()
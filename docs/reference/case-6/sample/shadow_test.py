@@ -0,0 +1,65 @@
+import threading
+import unittest
+
+import numpy as np
+
+from app.shadow import ShadowScorer
+from domain import Boston, Survived
+
+
+class TestShadowScorer(unittest.TestCase):
+
+    def test_classification(self):
+        survived = Survived()
+        shadow = ShadowScorer(survived.predict, batch_size=8, dtype=object).start()
+        x = [[3, 22, 1, 0, 7.25, 'male'], [1, 38, 1, 0, 71.28, 'female']]
+        for i in range(20):
+            row = x[i % 2]
+            result = survived.predict([row])[0]
+            shadow.submit(row, result if i < 15 else 1 - result)
+        shadow.stop()
+        stats = shadow.stats()
+        self.assertEqual(stats['submitted'], 20)
+        self.assertEqual(stats['scored'], 20)
+        self.assertEqual(stats['disagreements'], 5)
+        self.assertEqual(stats['disagreement_rate'], 0.25)
+
+    def test_regression(self):
+        boston = Boston()
+        shadow = ShadowScorer(lambda x: boston.predict(*x.T), kind='regression', tolerance=0.5).start()
+        shadow.submit([3.561, 7.12, 20.2], 0.21583895618321347)
+        shadow.submit([3.561, 7.12, 20.2], 1.21583895618321347)
+        shadow.stop()
+        stats = shadow.stats()
+        self.assertEqual(stats['disagreements'], 1)
+        self.assertAlmostEqual(stats['max_abs_error'], 1.0)
+        self.assertAlmostEqual(stats['mean_abs_error'], 0.5)
+
+    def test_drop(self):
+        release = threading.Event()
+
+        def predict(x):
+            release.wait()
+            return np.zeros(len(x))
+
+        shadow = ShadowScorer(predict, maxsize=2, batch_size=1).start()
+        results = [shadow.submit([0], 0) for _ in range(10)]
+        release.set()
+        shadow.stop()
+        stats = shadow.stats()
+        self.assertIn(False, results)
+        self.assertEqual(stats['submitted'] + stats['dropped'], 10)
+        self.assertEqual(stats['scored'], stats['submitted'])
+
+    def test_error(self):
+        def predict(x):
+            raise ValueError('broken')
+
+        shadow = ShadowScorer(predict).start()
+        shadow.submit([0], 0)
+        shadow.stop()
+        self.assertEqual(shadow.stats()['errors'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+path = os.path.dirname(os.path.abspath(__file__))
+STUDIES = ['iris_test.py', 'cinema_test.py', 'survived_test.py', 'boston_test.py']
+
+
+def run_child(script, result_file):
+    """スクリプトを実行し、unittestとdoctestの結果をresult_fileにJSONで書き出す（子プロセス側）"""
+    import doctest
+    import runpy
+    import unittest
+
+    results = {'tests_run': 0, 'failures': 0, 'errors': 0, 'skipped': 0,
+               'doctests_attempted': 0, 'doctests_failed': 0}
+    unittest_main = unittest.main
+    testmod = doctest.testmod
+
+    def main(*args, **kwargs):
+        program = unittest_main(*args, **kwargs)
+        results['tests_run'] += program.result.testsRun
+        results['failures'] += len(program.result.failures)
+        results['errors'] += len(program.result.errors)
+        results['skipped'] += len(program.result.skipped)
+        return program
+
+    def doctest_testmod(*args, **kwargs):
+        failed, attempted = testmod(*args, **kwargs)
+        results['doctests_failed'] += failed
+        results['doctests_attempted'] += attempted
+        return doctest.TestResults(failed, attempted)
+
+    unittest.main = main
+    doctest.testmod = doctest_testmod
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    try:
+        runpy.run_path(script, run_name='__main__')
+    finally:
+        with open(result_file, 'w') as f:
+            json.dump(results, f)
+
+
+def run_study(script, visualization=True, timeout=None):
+    """スクリプトを別プロセスで実行し、テスト結果と所要時間を返す"""
+    env = dict(os.environ, MPLBACKEND='Agg', VISUALIZATION='1' if visualization else '0')
+    with tempfile.TemporaryDirectory() as directory:
+        result_file = os.path.join(directory, 'result.json')
+        start = time.perf_counter()
+        try:
+            process = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child', script, result_file],
+                cwd=os.path.dirname(os.path.abspath(script)), env=env,
+                capture_output=True, text=True, timeout=timeout)
+            returncode, output = process.returncode, process.stdout + process.stderr
+        except subprocess.TimeoutExpired as e:
+            returncode, output = None, (e.stdout or b'').decode() + (e.stderr or b'').decode()
+        seconds = time.perf_counter() - start
+        results = {}
+        if os.path.exists(result_file):
+            with open(result_file) as f:
+                results = json.load(f)
+
+    if returncode is None:
+        status = 'timeout'
+    elif returncode != 0:
+        status = 'error'
+    elif results.get('failures') or results.get('errors') or results.get('doctests_failed'):
+        status = 'failed'
+    else:
+        status = 'ok'
+    return dict({'script': os.path.basename(script), 'status': status, 'seconds': seconds,
+                 'returncode': returncode, 'output': output}, **results)
+
+
+def run_studies(scripts=None, visualization=True, workers=None, timeout=None):
+    """複数のスクリプトを並列に実行し、スクリプトごとの結果のリストを返す"""
+    scripts = [os.path.join(path, s) for s in scripts or STUDIES]
+    with ThreadPoolExecutor(max_workers=workers or len(scripts)) as executor:
+        futures = [executor.submit(run_study, s, visualization, timeout) for s in scripts]
+        return [f.result() for f in futures]
+
+
+def format_report(reports):
+    lines = [f"{'script':<20}{'status':<9}{'seconds':>9}{'tests':>7}{'fail':>6}{'doctest':>9}"]
+    for r in reports:
+        tests = r.get('tests_run', '-')
+        failed = r.get('failures', 0) + r.get('errors', 0) + r.get('doctests_failed', 0)
+        lines.append(f"{r['script']:<20}{r['status']:<9}{r['seconds']:>9.1f}{tests:>7}"
+                     f"{failed:>6}{r.get('doctests_attempted', '-'):>9}")
+    total = sum(r['seconds'] for r in reports)
+    lines.append(f'合計{total:.1f}秒（最長{max(r["seconds"] for r in reports):.1f}秒）')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='事例のスクリプトを並列に実行して結果をまとめる')
+    parser.add_argument('scripts', nargs='*', help='実行するスクリプト（省略時は4つすべて）')
+    parser.add_argument('--skip-visualization', action='store_true', help='グラフの描画を省略')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=None, help='スクリプトごとの制限時間（秒）')
+    parser.add_argument('--verbose', action='store_true', help='失敗したスクリプトの出力を表示')
+    args = parser.parse_args()
+
+    reports = run_studies(args.scripts, not args.skip_visualization, args.workers, args.timeout)
+    print(format_report(reports))
+    if args.verbose:
+        for r in reports:
+            if r['status'] != 'ok':
+                print(f"\n===== {r['script']} =====\n{r['output']}")
+    sys.exit(0 if all(r['status'] == 'ok' for r in reports) else 1)
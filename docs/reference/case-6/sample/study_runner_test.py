@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from study_runner import format_report, run_studies
+
+STUDY = '''
+import doctest
+import os
+import unittest
+
+import matplotlib
+
+VISUALIZTION = os.environ.get('VISUALIZATION', '1') != '0'
+
+
+def double(x):
+    """
+    >>> double(2)
+    4
+    """
+    return x * 2
+
+
+class TestDouble(unittest.TestCase):
+
+    def test_double(self):
+        self.assertEqual(double(3), {expected})
+
+
+print('backend', matplotlib.get_backend(), 'visualization', VISUALIZTION)
+doctest.testmod()
+unittest.main(argv=[''], exit=False)
+'''
+
+
+class TestStudyRunner(unittest.TestCase):
+
+    def test_run_studies(self):
+        with tempfile.TemporaryDirectory() as directory:
+            scripts = []
+            for name, expected in [('ok_test.py', 6), ('failed_test.py', 7)]:
+                scripts.append(os.path.join(directory, name))
+                with open(scripts[-1], 'w') as f:
+                    f.write(STUDY.format(expected=expected))
+            scripts.append(os.path.join(directory, 'error_test.py'))
+            with open(scripts[-1], 'w') as f:
+                f.write('raise RuntimeError()\n')
+
+            reports = run_studies(scripts, visualization=False)
+
+        self.assertEqual([r['status'] for r in reports], ['ok', 'failed', 'error'])
+        self.assertEqual(reports[0]['tests_run'], 1)
+        self.assertEqual(reports[0]['doctests_attempted'], 1)
+        self.assertEqual(reports[1]['failures'], 1)
+        self.assertIn('backend agg visualization false', reports[0]['output'].lower())
+        self.assertIn('failed_test.py', format_report(reports))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,12 +10,21 @@ import unittest
 import doctest
 import os
 
-from domain import CategoricalData, DataVisualization, convert_categoricals, learn
+from domain import (CategoricalData, DataVisualization, GroupImputer, SURVIVED_FEATURES,
+                    TrainingCache, compare_tree_learners, convert_categoricals, export_onnx,
+                    learn_depths)
+from domain import learn as learn_tree
 from app.repository import CSVRepository, SQLRepository
 
+# 環境変数VISUALIZATION=0でグラフの描画を省略する
+VISUALIZTION = os.environ.get('VISUALIZATION', '1') != '0'
+# 環境変数BENCHMARK=1で時間のかかる学習時間の比較を実行する
+BENCHMARK = os.environ.get('BENCHMARK', '0') == '1'
 path = os.path.dirname(os.path.abspath(__file__))
 # repo = SQLRepository(table='Survived')
 repo = CSVRepository(file=path + '/data/Survived.csv')
+cache = TrainingCache()
+learn = cache.cached(learn_tree)
 
 # %% [markdown]
 # ## データの内容
@@ -92,7 +101,8 @@ sex = CategoricalData(df, 'Sex')
 sex.show()
 
 # %%
-sex.plot()
+if VISUALIZTION:
+    sex.plot()
 
 # %% [markdown]
 # ### 性別カテゴリの数値変換
@@ -101,7 +111,8 @@ sex.plot()
 categorical_cols = ['Sex']
 df_conv = convert_categoricals(df, categorical_cols)
 conv_species = CategoricalData(df_conv, 'Sex')
-conv_species.plot()
+if VISUALIZTION:
+    conv_species.plot()
 
 # %% [markdown]
 # ### チケットIDカテゴリ
@@ -113,7 +124,8 @@ ticket = CategoricalData(df, 'Ticket')
 ticket.show()
 
 # %%
-ticket.plot()
+if VISUALIZTION:
+    ticket.plot()
 
 # %% [markdown]
 # ### チケットIDカテゴリの数値変換
@@ -122,7 +134,8 @@ ticket.plot()
 categorical_cols = ['Ticket']
 df_conv = convert_categoricals(df, categorical_cols)
 conv_species = CategoricalData(df_conv, 'Ticket')
-conv_species.plot()
+if VISUALIZTION:
+    conv_species.plot()
 
 # %% [markdown]
 # ### 部屋番号カテゴリ
@@ -134,7 +147,8 @@ cabin = CategoricalData(df, 'Cabin')
 cabin.show()
 
 # %%
-cabin.plot()
+if VISUALIZTION:
+    cabin.plot()
 
 # %% [markdown]
 # ### 部屋番号カテゴリの数値変換
@@ -143,7 +157,8 @@ cabin.plot()
 categorical_cols = ['Cabin']
 df_conv = convert_categoricals(df, categorical_cols)
 conv_species = CategoricalData(df_conv, 'Cabin')
-conv_species.plot()
+if VISUALIZTION:
+    conv_species.plot()
 
 
 # %% [markdown]
@@ -156,7 +171,8 @@ embarked = CategoricalData(df, 'Embarked')
 embarked.show()
 
 # %%
-embarked.plot()
+if VISUALIZTION:
+    embarked.plot()
 
 # %% [markdown]
 # ### 搭乗港カテゴリの数値変換
@@ -165,7 +181,8 @@ embarked.plot()
 categorical_cols = ['Embarked']
 df_conv = convert_categoricals(df, categorical_cols)
 conv_species = CategoricalData(df_conv, 'Embarked')
-conv_species.plot()
+if VISUALIZTION:
+    conv_species.plot()
 
 # %% [markdown]
 # ### ダミー変数化
@@ -178,8 +195,9 @@ df_dummy
 # ### データの可視化
 
 # %%
-dv = DataVisualization(df)
-dv.df_all('Survived')
+if VISUALIZTION:
+    dv = DataVisualization(df)
+    dv.df_all('Survived')
 
 # %% [markdown]
 # ## データの前処理
@@ -297,16 +315,9 @@ print(pd.pivot_table(df, index='Survived',
 
 # %%
 # 前処理
-is_null = df2['Age'].isnull()
-
-df2.loc[(df2['Pclass'] == 1) & (df2['Survived'] == 0) & (is_null), 'Age'] = 43
-df2.loc[(df2['Pclass'] == 1) & (df2['Survived'] == 1) & (is_null), 'Age'] = 35
-
-df2.loc[(df2['Pclass'] == 2) & (df2['Survived'] == 0) & (is_null), 'Age'] = 33
-df2.loc[(df2['Pclass'] == 2) & (df2['Survived'] == 1) & (is_null), 'Age'] = 25
-
-df2.loc[(df2['Pclass'] == 3) & (df2['Survived'] == 0) & (is_null), 'Age'] = 26
-df2.loc[(df2['Pclass'] == 3) & (df2['Survived'] == 1) & (is_null), 'Age'] = 20
+# 客室等級と生存の組み合わせごとの年齢の平均（小数点以下は切り捨て）で埋める
+imputer = GroupImputer(keys=['Pclass', 'Survived'], cols=['Age'], stat='mean', truncate=True)
+df2 = imputer.fit_transform(df2)
 
 col = ['Pclass', 'Age', 'SibSp', 'Parch', 'Fare']
 x = df2[col]
@@ -340,20 +351,13 @@ categorical_cols = ['Sex', 'Ticket', 'Cabin', 'Embarked']
 df_conv = convert_categoricals(df3, categorical_cols)
 sex = df_conv.groupby('Sex').mean()
 sex['Survived']
-sex['Survived'].plot(kind='bar')
+if VISUALIZTION:
+    sex['Survived'].plot(kind='bar')
 
 # %%
 # 前処理
-is_null = df3['Age'].isnull()
-
-df3.loc[(df3['Pclass'] == 1) & (df3['Survived'] == 0) & (is_null), 'Age'] = 43
-df3.loc[(df3['Pclass'] == 1) & (df3['Survived'] == 1) & (is_null), 'Age'] = 35
-
-df3.loc[(df3['Pclass'] == 2) & (df3['Survived'] == 0) & (is_null), 'Age'] = 33
-df3.loc[(df3['Pclass'] == 2) & (df3['Survived'] == 1) & (is_null), 'Age'] = 25
-
-df3.loc[(df3['Pclass'] == 3) & (df3['Survived'] == 0) & (is_null), 'Age'] = 26
-df3.loc[(df3['Pclass'] == 3) & (df3['Survived'] == 1) & (is_null), 'Age'] = 20
+imputer = GroupImputer(keys=['Pclass', 'Survived'], cols=['Age'], stat='mean', truncate=True)
+df3 = imputer.fit_transform(df3)
 
 col = ['Pclass', 'Age', 'SibSp', 'Parch', 'Fare', 'Sex']
 x = df3[col]
@@ -375,25 +379,13 @@ for j in range(1, 15):
 # %%
 # 前処理
 df = repo.get_data()
-is_null = df['Age'].isnull()
-
-df.loc[(df['Pclass'] == 1) & (df['Survived'] == 0) & (is_null), 'Age'] = 43
-df.loc[(df['Pclass'] == 1) & (df['Survived'] == 1) & (is_null), 'Age'] = 35
-
-df.loc[(df['Pclass'] == 2) & (df['Survived'] == 0) & (is_null), 'Age'] = 33
-df.loc[(df['Pclass'] == 2) & (df['Survived'] == 1) & (is_null), 'Age'] = 25
+# 正解ラベルをキーにするため学習データ専用（推論時の欠損埋めには使えないので保存しない）
+imputer = GroupImputer(keys=['Pclass', 'Survived'], cols=['Age'], stat='mean', truncate=True)
+df = imputer.fit_transform(df)
 
-df.loc[(df['Pclass'] == 3) & (df['Survived'] == 0) & (is_null), 'Age'] = 26
-df.loc[(df['Pclass'] == 3) & (df['Survived'] == 1) & (is_null), 'Age'] = 20
-
-col = ['Pclass', 'Age', 'SibSp', 'Parch', 'Fare', 'Sex']
-x = df[col]
+x_new = SURVIVED_FEATURES.frame(df)
 y = df['Survived']
 
-male = pd.get_dummies(df['Sex'], drop_first=True)
-x_temp = pd.concat([x, male], axis=1)
-x_new = x_temp.drop('Sex', axis=1)
-
 # モデルの作成と学習
 s1, s2, model = learn(x_new, y, depth=9)
 # モデルの評価
@@ -403,6 +395,21 @@ print(f'テストデータの精度:{s2}')
 # モデルの保存
 with open(path + '/model/survived.pkl', 'wb') as f:
     pickle.dump(model, f)
+SURVIVED_FEATURES.save(path + '/model/survived_features.json')
+export_onnx('survived')
+print(cache.report())
+
+# %% [markdown]
+# ### 行数が多い場合の学習（区間に分割した特徴量による決定木）
+# %%
+# 区間への変換は一度だけ行い、深さごとの学習で使い回す
+for j, s1, s2, m in learn_depths(x_new, y):
+    print(f'深さ{j}:訓練データの精度{s1}::テストデータの精度{s2}')
+
+# %%
+# 行数を増やしたときの学習時間と正解率の比較
+if BENCHMARK:
+    print(compare_tree_learners(x_new, y, sizes=(10000, 100000, 1000000), depth=9))
 
 # %% [markdown]
 # ## 決定木における特徴量の考察
@@ -0,0 +1,46 @@
+import argparse
+import os
+
+import pandas as pd
+
+from domain import SyntheticData
+
+path = os.path.dirname(os.path.abspath(__file__))
+DATASETS = ['iris', 'cinema', 'Survived', 'Boston']
+
+
+def fit_dataset(name):
+    """data/以下のデータセットの分布を学習"""
+    return SyntheticData().fit(pd.read_csv(os.path.join(path, 'data', name + '.csv')))
+
+
+def generate(name, rows, output, format='csv', seed=0, chunksize=100000, workers=1, url=None, table=None):
+    """データセットnameと同じ列の合成データをrows行、CSV・Parquetのファイルまたはテーブルに書き出す"""
+    synthetic = fit_dataset(name)
+    if format != 'sql':
+        return synthetic.write(output, rows, seed, chunksize, workers, format)
+    from app.repository import SQLBulkLoader
+
+    loader = SQLBulkLoader(url, chunksize)
+    return loader.load_frames(synthetic.chunks(rows, seed, chunksize, workers),
+                              table or name[0].upper() + name[1:], synthetic.dtypes())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ベンチマーク用に事例のデータセットと同じ列の合成データを生成する')
+    parser.add_argument('dataset', choices=DATASETS)
+    parser.add_argument('rows', type=int)
+    parser.add_argument('output', nargs='?', help='出力ファイル（formatがsqlのときは不要）')
+    parser.add_argument('--format', choices=['csv', 'parquet', 'sql'], default='csv')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--workers', type=int, default=None, help='並列数（省略時はCPU数）')
+    parser.add_argument('--url', default=None, help='投入先のデータベース（省略時はdatabase_url()）')
+    parser.add_argument('--table', default=None, help='投入先のテーブル（省略時はデータセット名）')
+    args = parser.parse_args()
+    if args.format != 'sql' and args.output is None:
+        parser.error('output is required')
+
+    report = generate(args.dataset, args.rows, args.output, args.format, args.seed,
+                      args.chunksize, args.workers or os.cpu_count(), args.url, args.table)
+    print('{rows}行 {seconds:.2f}秒 ({rows_per_sec:.0f}行/秒)'.format(**report))